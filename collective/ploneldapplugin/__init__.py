@@ -2,6 +2,7 @@ import sys
 import logging
 
 from AccessControl.Permissions import add_user_folders
+from Acquisition import aq_base
 
 from zope.i18nmessageid import MessageFactory
 
@@ -18,6 +19,13 @@ def logException(msg, context=None):
         if error_log is not None:
             error_log.raising(sys.exc_info())
 
+def getCacheKey(plugin):
+    """Plugin physical path, the same for all ZODB connections"""
+    key = getattr(aq_base(plugin), '_v_schema_cache_key', None)
+    if key is None:
+        key = plugin._v_schema_cache_key = '/'.join(plugin.getPhysicalPath())
+    return key
+
 from collective.ploneldapplugin.ldapplugin import EnhancedPloneLDAPMultiPlugin, \
     manage_addEnhancedPloneLDAPMultiPluginForm, \
     manage_addEnhancedPloneLDAPMultiPlugin
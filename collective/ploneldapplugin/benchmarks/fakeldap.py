@@ -0,0 +1,496 @@
+"""In-process stand-in for LDAPUserFolder, its LDAPDelegate and a python ldap
+connection with synthetic users, so benchmarks don't need a directory server.
+
+Every call which would be an LDAP round trip is counted in Stats.
+"""
+import re
+import time
+import random
+from datetime import datetime, timedelta
+
+import ldap
+from ldap.dn import escape_dn_chars
+
+from Products.LDAPUserFolder.utils import to_utf8
+
+from collective.ploneldapplugin.ldapplugin import EnhancedPloneLDAPMultiPlugin
+from collective.ploneldapplugin.ldapproperty import EnhancedLDAPPropertySheet
+from collective.ploneldapplugin.generalizedtime import formatGeneralizedTime
+
+SUBSCHEMA_DN = 'cn=Subschema'
+USERS_BASE = 'ou=people,dc=example,dc=com'
+# user ids searched for, searches match users by id only
+UID_FILTER = re.compile(r'\(uid=([^)]*)\)')
+
+SUBSCHEMA = {
+    'modifyTimestamp': ['20100101000000Z'],
+    'attributeTypes': [
+        "( 2.5.4.0 NAME 'objectClass' "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.38 )",
+        "( 2.5.4.41 NAME 'name' EQUALITY caseIgnoreMatch "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.15{32768} )",
+        "( 2.5.4.3 NAME ( 'cn' 'commonName' ) SUP name )",
+        "( 2.5.4.4 NAME ( 'sn' 'surname' ) SUP name )",
+        "( 2.5.4.11 NAME ( 'ou' 'organizationalUnitName' ) SUP name )",
+        "( 2.5.4.35 NAME 'userPassword' "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.40{128} )",
+        "( 0.9.2342.19200300.100.1.1 NAME ( 'uid' 'userid' ) "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.15{256} )",
+        "( 0.9.2342.19200300.100.1.3 NAME ( 'mail' 'rfc822Mailbox' ) "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.26{256} )",
+        "( 1.3.6.1.4.1.99999.1.1 NAME 'loginCount' "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.27 SINGLE-VALUE )",
+        "( 1.3.6.1.4.1.99999.1.2 NAME 'isActive' "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.7 SINGLE-VALUE )",
+        "( 1.3.6.1.4.1.99999.1.3 NAME 'lastLogin' "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.24 SINGLE-VALUE )",
+        "( 1.3.6.1.4.1.99999.1.4 NAME 'phoneExtension' "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.36 )",
+        "( 1.3.6.1.4.1.99999.1.5 NAME 'mailAlias' "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )",
+    ],
+    'objectClasses': [
+        "( 2.5.6.0 NAME 'top' ABSTRACT MUST objectClass )",
+        "( 2.5.6.6 NAME 'person' SUP top STRUCTURAL MUST ( sn $ cn ) "
+        "MAY userPassword )",
+        "( 1.3.6.1.4.1.99999.2.1 NAME 'benchPerson' SUP person STRUCTURAL "
+        "MAY ( uid $ mail $ ou $ loginCount $ isActive $ lastLogin $ "
+        "phoneExtension $ mailAlias ) )",
+    ],
+}
+
+# ldap name: (public name, multivalued)
+SCHEMA = {
+    'uid': ('', False),
+    'cn': ('fullname', False),
+    'sn': ('surname', False),
+    'mail': ('email', False),
+    'ou': ('department', False),
+    'loginCount': ('login_count', False),
+    'isActive': ('active', False),
+    'lastLogin': ('login_time', False),
+    'phoneExtension': ('extensions', True),
+    'mailAlias': ('mail_aliases', True),
+}
+
+DEPARTMENTS = ['Sales', 'Engineering', 'Support', 'Finance', 'Legal',
+               'Research', 'Marketing', 'Operations']
+
+
+class Stats(object):
+    """LDAP round trips counter"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+
+    def count(self, kind):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+class FakeDirectory(object):
+    """Synthetic users: {lowercased uid: (dn, {ldapname: [values]})}"""
+
+    def __init__(self, size, seed=42):
+        self.entries = {}
+        self.dns = {}
+        rand = random.Random(seed)
+        start = datetime(2010, 1, 1)
+        for index in range(size):
+            uid = 'user%06d' % index
+            dn = 'uid=%s,%s' % (uid, USERS_BASE)
+            attrs = {
+                'objectClass': ['top', 'person', 'benchPerson'],
+                'uid': [uid],
+                'cn': ['User %06d \xc3\xa9' % index],
+                'sn': ['%06d' % index],
+                'mail': ['%s@example.com' % uid],
+                'ou': [rand.choice(DEPARTMENTS)],
+                'loginCount': [str(rand.randint(0, 5000))],
+                'isActive': [rand.choice(['TRUE', 'FALSE'])],
+                'lastLogin': [formatGeneralizedTime(start +
+                    timedelta(seconds=rand.randint(0, 86400 * 365)))],
+                'phoneExtension': [str(rand.randint(1000, 9999))
+                    for i in range(rand.randint(0, 3))],
+                'mailAlias': ['%s.%d@example.com' % (uid, i)
+                    for i in range(rand.randint(0, 20))],
+            }
+            for key, values in attrs.items():
+                if not values:
+                    del attrs[key]
+            self.entries[uid] = (dn, attrs)
+            self.dns[dn] = uid
+
+    def uids(self):
+        return self.entries.keys()
+
+    def get(self, uid):
+        return self.entries.get(uid.lower())
+
+    def getByDN(self, dn):
+        uid = self.dns.get(dn)
+        return uid is not None and self.entries[uid] or None
+
+    def rename(self, dn, newrdn):
+        uid = self.dns.pop(dn)
+        old, attrs = self.entries[uid]
+        name, value = newrdn.split('=', 1)
+        attrs[name] = [value]
+        newdn = ','.join([newrdn] + dn.split(',')[1:])
+        self.entries[uid] = (newdn, attrs)
+        self.dns[newdn] = uid
+
+    def add(self, dn, attrs):
+        if dn in self.dns:
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists'})
+        uid = dn.split(',')[0].split('=', 1)[1].lower()
+        self.entries[uid] = (dn, dict([(key, list(values))
+            for key, values in attrs]))
+        self.dns[dn] = uid
+
+    def modify(self, dn, mod_list):
+        rdn_attr = dn.split('=', 1)[0]
+        dn, attrs = self.getByDN(dn)
+        for op, name, values in mod_list:
+            if name == rdn_attr and op == ldap.MOD_DELETE:
+                raise ldap.NOT_ALLOWED_ON_RDN({'desc': 'Cannot remove '
+                    'naming attribute %s' % name})
+        for op, name, values in mod_list:
+            if op == ldap.MOD_DELETE:
+                attrs.pop(name, None)
+            elif op == ldap.MOD_REPLACE:
+                attrs[name] = list(values)
+            elif op == ldap.MOD_ADD:
+                attrs.setdefault(name, []).extend(values)
+
+
+class FakeConnection(object):
+    """Python ldap connection talking to FakeDirectory"""
+
+    def __init__(self, directory, stats):
+        self.directory = directory
+        self.stats = stats
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, who='', cred=''):
+        self.stats.count('bind')
+
+    def search_subschemasubentry_s(self, dn=''):
+        self.stats.count('subschema')
+        return SUBSCHEMA_DN
+
+    def read_subschemasubentry_s(self, dn, attrs=None):
+        self.stats.count('subschema')
+        return dict([(key, list(values)) for key, values in SUBSCHEMA.items()])
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None):
+        self.stats.count('search')
+        if base == SUBSCHEMA_DN:
+            return [(base, {'modifyTimestamp':
+                list(SUBSCHEMA['modifyTimestamp'])})]
+        if scope == ldap.SCOPE_BASE:
+            found = [self.directory.getByDN(base)]
+        else:
+            found = [self.directory.get(uid)
+                for uid in UID_FILTER.findall(filterstr)]
+        results = []
+        for entry in found:
+            if entry is None:
+                continue
+            dn, values = entry
+            results.append((dn, dict([(key, list(value))
+                for key, value in values.items()
+                if not attrlist or key in attrlist])))
+        return results
+
+    def add(self, dn, modlist):
+        self.stats.count('add')
+        self.directory.add(dn, modlist)
+        return 0
+
+    def modify_s(self, dn, mod_list):
+        self.stats.count('modify')
+        self.directory.modify(dn, mod_list)
+
+    def modify(self, dn, mod_list):
+        self.modify_s(dn, mod_list)
+        return 0
+
+    def result(self, msgid):
+        return ldap.RES_MODIFY, []
+
+    def modrdn_s(self, dn, newrdn):
+        self.stats.count('modrdn')
+        self.directory.rename(dn, newrdn)
+
+    def unbind_s(self):
+        pass
+
+
+class FakeDelegate(object):
+    """LDAPDelegate stand-in"""
+
+    read_only = False
+    binduid_usage = 1
+
+    def __init__(self, directory, stats):
+        self.directory = directory
+        self.stats = stats
+
+    def getServers(self):
+        return [{'host': 'fake.example.com', 'port': 389,
+            'protocol': 'ldap', 'conn_timeout': -1, 'op_timeout': -1}]
+
+    def connect(self, bind_dn='', bind_pwd=''):
+        return FakeConnection(self.directory, self.stats)
+
+    def search(self, base, scope, filter='(objectClass=*)', attrs=[],
+               bind_dn='', bind_pwd='', convert_filter=True):
+        self.stats.count('search')
+        if scope == ldap.SCOPE_BASE:
+            found = [self.directory.getByDN(base)]
+        else:
+            found = [self.directory.get(uid)
+                for uid in UID_FILTER.findall(filter)]
+
+        results = []
+        for entry in found:
+            if entry is None:
+                continue
+            dn, values = entry
+            if attrs:
+                record = dict([(key, list(values[key]))
+                    for key in attrs if key in values])
+            else:
+                record = dict([(key, list(value))
+                    for key, value in values.items()])
+            record['dn'] = dn
+            results.append(record)
+        return {'exception': '', 'size': len(results), 'results': results}
+
+    def modify(self, dn, mod_type=None, attrs={}):
+        """Write changed attributes like LDAPDelegate.modify, renaming the
+        entry if its naming attribute changes. Errors are returned, not
+        raised.
+        """
+        if self.read_only:
+            return 'Running in read-only mode, modification is disabled'
+        dn = to_utf8(dn)
+        res = self.search(dn, ldap.SCOPE_BASE)
+        if not res['size']:
+            return 'LDAPDelegate.modify: Cannot find dn "%s"' % dn
+        current = res['results'][0]
+        mod_list = []
+        for key, values in attrs.items():
+            values = [to_utf8(value) for value in values if value != '']
+            if values and values != current.get(key):
+                mod_list.append((ldap.MOD_REPLACE, key, values))
+            elif not values and key in current:
+                mod_list.append((ldap.MOD_DELETE, key, None))
+
+        rdn_attr, rdn_value = dn.split(',')[0].split('=', 1)
+        new_rdn = attrs.get(rdn_attr, [''])
+        new_rdn = new_rdn and to_utf8(new_rdn[0]) or ''
+        connection = self.connect()
+        try:
+            if new_rdn and escape_dn_chars(new_rdn) != rdn_value:
+                rdn = '%s=%s' % (rdn_attr, escape_dn_chars(new_rdn))
+                connection.modrdn_s(dn, rdn)
+                dn = ','.join([rdn] + dn.split(',')[1:])
+            if mod_list:
+                connection.modify_s(dn, mod_list)
+        except ldap.LDAPError, e:
+            return 'LDAPDelegate.modify: %s' % str(e)
+        return ''
+
+
+class FakeLDAPUser(object):
+
+    def __init__(self, dn, properties):
+        self.dn = dn
+        self._properties = properties
+
+
+class FakeLDAPUserFolder(object):
+    """LDAPUserFolder stand-in without its user cache, every lookup is a
+    round trip
+    """
+
+    _uid_attr = 'uid'
+    _login_attr = 'uid'
+    _rdnattr = 'uid'
+    _user_objclasses = ['top', 'person', 'benchPerson']
+    _binduid = 'cn=Manager,dc=example,dc=com'
+    _bindpwd = 'secret'
+    users_base = USERS_BASE
+    users_scope = ldap.SCOPE_SUBTREE
+    read_only = False
+    _local_groups = False
+    _pwd_encryption = 'clear'
+
+    def __init__(self, directory, stats):
+        self.stats = stats
+        self._delegate = FakeDelegate(directory, stats)
+        self._groups_store = {}
+        # user dn: roles given through manage_editUserRoles
+        self.edited_roles = {}
+        self._schema = {}
+        for ldapname, (public, multivalued) in SCHEMA.items():
+            self._schema[ldapname] = {'ldap_name': ldapname,
+                'friendly_name': ldapname, 'public_name': public,
+                'multivalued': multivalued}
+
+    def getSchemaConfig(self):
+        return self._schema
+
+    def getServers(self):
+        return self._delegate.getServers()
+
+    def getUserById(self, uid):
+        res = self._delegate.search(self.users_base, self.users_scope,
+            '(uid=%s)' % uid, self._schema.keys())
+        if not res['size']:
+            return None
+        entry = res['results'][0]
+        properties = {}
+        for key, values in entry.items():
+            if key == 'dn' or self._schema.get(key, {}).get('multivalued'):
+                properties[key] = values
+            else:
+                properties[key] = values[0]
+        return FakeLDAPUser(entry['dn'], properties)
+
+    def _expireUser(self, name):
+        self.stats.count('expire')
+
+    def _clearCaches(self):
+        self.stats.count('clear')
+
+    def manage_editUserRoles(self, user_dn, role_dns=[], REQUEST=None):
+        self.edited_roles[user_dn] = role_dns
+
+    def getCacheTimeout(self, cache_type):
+        return 600
+
+
+class FakePlugin(object):
+    """Enhanced plugin stand-in sharing its implementation"""
+
+    id = 'ldap'
+    bulk_chunk_size = 100
+    schema_cache_ttl = 3600
+    use_schema_snapshot = False
+    schema_snapshot_dir = ''
+    dirty_tracking = True
+    volatile_properties = ()
+
+    _methods = EnhancedPloneLDAPMultiPlugin.__dict__
+    getLDAPAttrs = _methods['getLDAPAttrs']
+    getConversionPlan = _methods['getConversionPlan']
+    _getLDAPMetaData = _methods['_getLDAPMetaData']
+    _searchLDAPProperties = _methods['_searchLDAPProperties']
+    setPropertiesForUser = _methods['setPropertiesForUser']
+    del _methods
+
+    def __init__(self, acl, name):
+        self.acl = acl
+        self.name = name
+
+    def getId(self):
+        return self.id
+
+    def getPhysicalPath(self):
+        return ('', 'benchmarks', self.name)
+
+    def _getLDAPUserFolder(self):
+        return self.acl
+
+    # no cache manager is associated, every sheet is built anew
+    def ZCacheable_get(self, view_name='', keywords=None, mtime_func=None,
+                       default=None):
+        return default
+
+    def ZCacheable_set(self, data, view_name='', keywords=None,
+                       mtime_func=None):
+        pass
+
+    def ZCacheable_invalidate(self, view_name='', REQUEST=None):
+        self.acl.stats.count('invalidate')
+
+
+class CachingPlugin(FakePlugin):
+    """Fake plugin with a cache manager keeping plugin cache values in a
+    dictionary
+    """
+
+    def __init__(self, acl, name):
+        FakePlugin.__init__(self, acl, name)
+        self.cache = {}
+
+    def _key(self, view_name, keywords):
+        return (view_name, tuple(sorted((keywords or {}).items())))
+
+    def ZCacheable_get(self, view_name='', keywords=None, mtime_func=None,
+                       default=None):
+        entry = self.cache.get(self._key(view_name, keywords))
+        if entry is None:
+            return default
+        created, data = entry
+        # entries older than object modification are outdated
+        if mtime_func is not None and mtime_func() > created:
+            return default
+        return data
+
+    def ZCacheable_set(self, data, view_name='', keywords=None,
+                       mtime_func=None):
+        self.cache[self._key(view_name, keywords)] = (time.time(), data)
+
+    def ZCacheable_invalidate(self, view_name='', REQUEST=None):
+        FakePlugin.ZCacheable_invalidate(self, view_name, REQUEST)
+        self.cache.clear()
+
+
+class FakeUser(object):
+
+    def __init__(self, uid):
+        self.uid = uid
+
+    def getId(self):
+        return self.uid
+
+    def getUserName(self):
+        return self.uid
+
+
+class BenchPropertySheet(EnhancedLDAPPropertySheet):
+    """Property sheet bound to a fake plugin instead of acquiring it from
+    acl_users
+    """
+
+    def __init__(self, plugin, user, ldap_properties=None):
+        self.plugin = plugin
+        EnhancedLDAPPropertySheet.__init__(self, plugin.id, user,
+            ldap_properties)
+
+    def getLDAPMultiPlugin(self, user):
+        return self.plugin
+
+    def _getLDAPUserFolder(self, user):
+        return self.plugin.acl
+
+
+def setUp(size, seed=42):
+    """Return (plugin, directory, stats) for a directory of a given size"""
+    stats = Stats()
+    directory = FakeDirectory(size, seed)
+    acl = FakeLDAPUserFolder(directory, stats)
+    plugin = FakePlugin(acl, 'ldap-%d' % size)
+    return plugin, directory, stats
@@ -0,0 +1,122 @@
+"""Stand-in memcached server for trying shared property cache locally.
+
+Understands get, set, add, incr and delete commands of memcached text
+protocol, which is all MemcachedBackend uses. Listens on TCP port or unix
+socket:
+
+  bin/zopepy collective/ploneldapplugin/benchmarks/fakememcached.py 11211
+  bin/zopepy collective/ploneldapplugin/benchmarks/fakememcached.py \
+      unix:/tmp/ploneldap.sock
+
+and point plugin shared_cache_servers property to localhost:11211 or
+unix:/tmp/ploneldap.sock.
+"""
+import os
+import sys
+import time
+import threading
+import SocketServer
+
+
+class Storage(object):
+
+    def __init__(self):
+        # key: (expires, value)
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[0] and entry[0] < time.time():
+            self.data.pop(key, None)
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        self.data[key] = (ttl and time.time() + ttl or 0, value)
+
+storage = Storage()
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            storage.lock.acquire()
+            try:
+                if command == 'get':
+                    reply = ''
+                    for key in parts[1:]:
+                        value = storage.get(key)
+                        if value is not None:
+                            reply += 'VALUE %s 0 %d\r\n%s\r\n' % (key,
+                                len(value), value)
+                    self.wfile.write(reply + 'END\r\n')
+                elif command in ('set', 'add'):
+                    key, ttl, size = parts[1], int(parts[3]), int(parts[4])
+                    value = self.rfile.read(size + 2)[:size]
+                    if command == 'add' and storage.get(key) is not None:
+                        self.wfile.write('NOT_STORED\r\n')
+                    else:
+                        storage.set(key, value, ttl)
+                        self.wfile.write('STORED\r\n')
+                elif command == 'incr':
+                    key, delta = parts[1], int(parts[2])
+                    value = storage.get(key)
+                    if value is None:
+                        self.wfile.write('NOT_FOUND\r\n')
+                    else:
+                        value = str(int(value) + delta)
+                        storage.data[key] = (storage.data[key][0], value)
+                        self.wfile.write(value + '\r\n')
+                elif command == 'delete':
+                    if storage.data.pop(parts[1], None) is None:
+                        self.wfile.write('NOT_FOUND\r\n')
+                    else:
+                        self.wfile.write('DELETED\r\n')
+                else:
+                    self.wfile.write('ERROR\r\n')
+            finally:
+                storage.lock.release()
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class UnixServer(SocketServer.ThreadingMixIn,
+                 SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def makeServer(address):
+    """Return server for a port number or unix:/path address"""
+    if address.startswith('unix:'):
+        path = address[5:]
+        if os.path.exists(path):
+            os.unlink(path)
+        return UnixServer(path, Handler)
+    return TCPServer(('127.0.0.1', int(address)), Handler)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    address = argv and argv[0] or '11211'
+    server = makeServer(address)
+    print 'Serving memcached protocol on %s' % address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Compare GeneralizedTime parser with previous time.strptime based one.
+
+Run it with python having collective.ploneldapplugin dependencies on path:
+
+  bin/zopepy collective/ploneldapplugin/benchmarks/generalizedtime.py
+"""
+import time
+from timeit import Timer
+from datetime import datetime
+
+from collective.ploneldapplugin import generalizedtime
+from collective.ploneldapplugin.generalizedtime import \
+    parseGeneralizedTime, formatGeneralizedTime
+
+FORMAT = '%Y%m%d%H%M%SZ'
+
+VALUES = [
+    '20100102030405Z',
+    '20100102030405.123Z',
+    '20100102030405-0500',
+    '201001020304Z',
+]
+
+NUMBER = 100000
+
+
+def strptimeParse(value):
+    """DateTimeConverter implementation before GeneralizedTime parser"""
+    try:
+        return datetime(*time.strptime(value, FORMAT)[:6])
+    except ValueError, e:
+        return None
+
+def uncachedParse(value):
+    generalizedtime._cache.clear()
+    return parseGeneralizedTime(value)
+
+def strftimeFormat(value):
+    return value.strftime(FORMAT)
+
+def bench(func, value, number=NUMBER):
+    """Return operations per second"""
+    timer = Timer(lambda: func(value))
+    return number / min(timer.repeat(3, number))
+
+def main():
+    print '%-24s %14s %14s %14s' % ('value', 'strptime/s', 'parser/s',
+        'memoized/s')
+    for value in VALUES:
+        print '%-24s %14.0f %14.0f %14.0f' % (value,
+            bench(strptimeParse, value), bench(uncachedParse, value),
+            bench(parseGeneralizedTime, value))
+    print
+    print 'Values strptime can parse: %s' % ', '.join([
+        value for value in VALUES if strptimeParse(value) is not None])
+
+    now = datetime.utcnow()
+    print
+    print '%-24s %14s %14s' % ('format', 'strftime/s', 'formatter/s')
+    print '%-24s %14.0f %14.0f' % (now.isoformat(), bench(strftimeFormat, now),
+        bench(formatGeneralizedTime, now))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Memory benchmark of cached property sheets.
+
+Builds property sheets of many synthetic users, the way property sheet
+caches keep them, with compact_sheets off and on, and reports bytes per
+cached user:
+
+  bin/ploneldapplugin-memory-benchmark -u 10000
+
+Objects shared by all sheets, like plugin, layouts and interned values, are
+counted once and spread over all users.
+"""
+import sys
+import random
+from optparse import OptionParser
+
+from collective.ploneldapplugin.ldapproperty import CompactProperties
+from collective.ploneldapplugin.benchmarks import fakeldap
+from collective.ploneldapplugin.benchmarks.runner import registerConverters
+
+USERS = 10000
+
+# sheet attributes pointing to objects which are not part of the sheet
+SKIPPED = ('plugin',)
+
+
+def sizeOf(value, seen):
+    """Return bytes taken by value and objects it refers to, which aren't
+    in seen yet
+    """
+    if id(value) in seen:
+        return 0
+    seen[id(value)] = value
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sizeOf(key, seen) + sizeOf(item, seen)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += sizeOf(item, seen)
+    elif isinstance(value, CompactProperties):
+        for name in CompactProperties.__slots__:
+            size += sizeOf(getattr(value, name), seen)
+    elif hasattr(value, '__dict__') and not isinstance(value, type):
+        state = dict([(key, item) for key, item in value.__dict__.items()
+            if key not in SKIPPED])
+        size += sys.getsizeof(value.__dict__)
+        for key, item in state.items():
+            size += sizeOf(key, seen) + sizeOf(item, seen)
+    return size
+
+def measureSheets(plugin, uids):
+    """Return bytes per user of property sheets of given users"""
+    # plugin and its caches don't belong to the sheets
+    seen = {id(plugin): plugin}
+    sheets = [fakeldap.BenchPropertySheet(plugin, fakeldap.FakeUser(uid))
+        for uid in uids]
+    # class level defaults are shared too
+    seen[id(fakeldap.BenchPropertySheet)] = fakeldap.BenchPropertySheet
+    total = 0
+    for sheet in sheets:
+        total += sizeOf(sheet, seen)
+    return float(total) / len(sheets)
+
+def run(users=USERS, seed=42):
+    """Return {'default': bytes per user, 'compact': bytes per user}"""
+    registerConverters()
+    plugin, directory, stats = fakeldap.setUp(users, seed)
+    uids = directory.uids()
+    random.Random(seed).shuffle(uids)
+    results = {}
+    for name, compact in (('default', False), ('compact', True)):
+        plugin.compact_sheets = compact
+        results[name] = measureSheets(plugin, uids)
+    plugin.compact_sheets = False
+    return results
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-u', '--users', type='int', default=USERS,
+        help='number of cached users (default: %default)')
+    options, args = parser.parse_args(argv)
+
+    results = run(options.users)
+    print '%-20s %14s' % ('sheets', 'bytes per user')
+    for name in ('default', 'compact'):
+        print '%-20s %14.0f' % (name, results[name])
+    print 'Compact sheets take %.0f%% of default ones' % (
+        100.0 * results['compact'] / results['default'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
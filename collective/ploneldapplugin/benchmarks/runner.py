@@ -0,0 +1,248 @@
+"""Benchmark suite for property reads, writes, schema metadata and
+converters against an in-process fake LDAP directory.
+
+Reports operations per second and LDAP round trips per call for directories
+of 1k, 10k and 100k synthetic users. Results can be saved as baseline and
+later runs compared against it:
+
+  bin/ploneldapplugin-benchmark --save -b baselines.json
+  bin/ploneldapplugin-benchmark --compare -b baselines.json
+
+Exit status is 1 if some benchmark regressed or there is no baseline to
+compare with.
+"""
+import os
+import sys
+import time
+import random
+from optparse import OptionParser
+from datetime import datetime
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from ldap.schema.models import AttributeType
+from DateTime import DateTime
+
+from zope.component import provideAdapter
+
+from collective.ploneldapplugin import converters
+from collective.ploneldapplugin.interfaces import ILDAPAttributeConverter
+from collective.ploneldapplugin import schemacache
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+SIZES = (1000, 10000, 100000)
+
+# baselines file in the current directory by default
+BASELINE = 'ploneldapplugin-baselines.json'
+
+# allowed slowdown before a benchmark counts as regressed
+TOLERANCE = 0.2
+
+CONVERTERS = (
+    ('1.3.6.1.4.1.1466.115.121.1.24', converters.DateTimeConverter),
+    ('1.3.6.1.4.1.1466.115.121.1.15', converters.StringConverter),
+    ('1.3.6.1.4.1.1466.115.121.1.7', converters.BooleanConverter),
+    ('1.3.6.1.4.1.1466.115.121.1.27', converters.IntegerConverter),
+    ('1.3.6.1.4.1.1466.115.121.1.36', converters.NumericConverter),
+)
+
+# converter: (ldap value, python value)
+SAMPLES = (
+    (converters.DefaultConverter, 'Some \xc3\xa9 value', u'Some \xe9 value'),
+    (converters.NullConverter, 'value', 'value'),
+    (converters.StringConverter, 'Some \xc3\xa9 value', u'Some \xe9 value'),
+    (converters.IntegerConverter, '12345', 12345),
+    (converters.NumericConverter, '12.5', 12.5),
+    (converters.BooleanConverter, 'TRUE', True),
+    (converters.DateTimeConverter, '20100102030405Z',
+        datetime(2010, 1, 2, 3, 4, 5)),
+)
+
+
+def registerConverters():
+    """Register converters the way pas.zcml does"""
+    provideAdapter(converters.DefaultConverter,
+        provides=ILDAPAttributeConverter)
+    for oid, factory in CONVERTERS:
+        provideAdapter(factory, provides=ILDAPAttributeConverter, name=oid)
+
+def measure(func, duration, stats=None):
+    """Call func repeatedly for about duration seconds.
+
+    Returns {'ops': calls per second, 'roundtrips': LDAP round trips per
+    call}.
+    """
+    if stats is not None:
+        stats.reset()
+    calls = 0
+    start = time.time()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= duration:
+            break
+    result = {'ops': calls / elapsed}
+    if stats is not None:
+        result['roundtrips'] = float(stats.total()) / calls
+    return result
+
+def benchPlugin(size, duration):
+    """Plugin level benchmarks for a directory of a given size"""
+    results = {}
+    plugin, directory, stats = fakeldap.setUp(size)
+    uids = directory.uids()
+    rand = random.Random(size)
+    def user():
+        return fakeldap.FakeUser(rand.choice(uids))
+
+    # schema metadata, cached and parsed from scratch
+    results['getLDAPAttrs'] = measure(plugin.getLDAPAttrs, duration, stats)
+    def uncached():
+        schemacache.refreshLDAPAttrs(plugin)
+        schemacache._loaded.clear()
+        plugin.getLDAPAttrs()
+    results['_getLDAPMetaData'] = measure(uncached, duration, stats)
+
+    # property reads
+    results['fetchLdapProperties'] = measure(
+        lambda: fakeldap.BenchPropertySheet(plugin, user()), duration, stats)
+    # sheets of listings, only fullname and email are read
+    def listing():
+        sheet = fakeldap.BenchPropertySheet(plugin, user())
+        sheet.getProperty('fullname')
+        sheet.getProperty('email')
+    results['listing-eager'] = measure(listing, duration, stats)
+    plugin.lazy_conversion = True
+    results['listing-lazy'] = measure(listing, duration, stats)
+    plugin.lazy_conversion = False
+    chunk = [rand.choice(uids) for i in range(plugin.bulk_chunk_size)]
+    results['_searchLDAPProperties'] = measure(
+        lambda: plugin._searchLDAPProperties(chunk), duration, stats)
+
+    # property writes, unchanged and changed values
+    sheets = []
+    for i in range(100):
+        owner = user()
+        sheets.append((owner, fakeldap.BenchPropertySheet(plugin, owner)))
+    def unchanged():
+        owner, sheet = rand.choice(sheets)
+        sheet.setProperties(owner, dict(sheet.propertyItems()))
+    def changed():
+        owner, sheet = rand.choice(sheets)
+        sheet.setProperties(owner, {'department': rand.choice(
+            fakeldap.DEPARTMENTS), 'login_count': rand.randint(0, 5000)})
+    results['setProperties-unchanged'] = measure(unchanged, duration, stats)
+    results['setProperties-changed'] = measure(changed, duration, stats)
+
+    return dict([('%s/%d' % (name, size), value)
+        for name, value in results.items()])
+
+def benchConverters(duration):
+    """Single value and batch conversions of every bundled converter"""
+    results = {}
+    attribute = AttributeType("( 1.1 NAME 'attr' )")
+    info = ('attr', 'attr', 'string')
+    for factory, ldap_value, python_value in SAMPLES:
+        converter = factory(attribute)
+        name = factory.__name__
+        results['%s.fromLDAPValue' % name] = measure(
+            lambda: converter.fromLDAPValue(ldap_value, info), duration)
+        results['%s.toLDAPValue' % name] = measure(
+            lambda: converter.toLDAPValue(python_value, info), duration)
+
+        ldap_values = [ldap_value] * 1000
+        python_values = [python_value] * 1000
+        results['%s.fromLDAPValues[1000]' % name] = measure(
+            lambda: converter.fromLDAPValues(ldap_values, info), duration)
+        results['%s.toLDAPValues[1000]' % name] = measure(
+            lambda: converter.toLDAPValues(python_values, info), duration)
+
+    converter = converters.DateTimeConverter(attribute)
+    results['DateTimeConverter.toLDAPValue(DateTime)'] = measure(
+        lambda: converter.toLDAPValue(DateTime('2010/01/02 03:04:05 UTC'),
+            info), duration)
+    return results
+
+def run(sizes=SIZES, duration=1.0):
+    registerConverters()
+    results = benchConverters(duration)
+    for size in sizes:
+        results.update(benchPlugin(size, duration))
+    return results
+
+def compare(results, baselines, tolerance=TOLERANCE):
+    """Return list of regression descriptions"""
+    regressions = []
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        if result['ops'] < baseline['ops'] * (1 - tolerance):
+            regressions.append('%s: %.0f ops/s, baseline %.0f ops/s' % (
+                name, result['ops'], baseline['ops']))
+        if result.get('roundtrips', 0) > baseline.get('roundtrips', 0):
+            regressions.append('%s: %.2f round trips per call, baseline '
+                '%.2f' % (name, result['roundtrips'], baseline['roundtrips']))
+    return regressions
+
+def report(results, out=sys.stdout):
+    out.write('%-50s %14s %12s\n' % ('benchmark', 'ops/s', 'round trips'))
+    for name, result in sorted(results.items()):
+        roundtrips = result.get('roundtrips')
+        out.write('%-50s %14.0f %12s\n' % (name, result['ops'],
+            roundtrips is not None and '%.2f' % roundtrips or '-'))
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--size', dest='sizes', action='append',
+        type='int', help='directory size, may be repeated (default: %s)' %
+        ', '.join(map(str, SIZES)))
+    parser.add_option('-d', '--duration', type='float', default=1.0,
+        help='seconds to run each benchmark (default: %default)')
+    parser.add_option('-b', '--baseline', default=BASELINE,
+        help='baselines file (default: %default)')
+    parser.add_option('--save', action='store_true',
+        help='store results as new baselines')
+    parser.add_option('--compare', action='store_true',
+        help='compare results with baselines')
+    parser.add_option('-t', '--tolerance', type='float', default=TOLERANCE,
+        help='allowed slowdown ratio (default: %default)')
+    options, args = parser.parse_args(argv)
+    if options.compare and not os.path.exists(options.baseline):
+        print 'No baseline saved in %s, run with --save first' % \
+            options.baseline
+        return 1
+
+    results = run(options.sizes or SIZES, options.duration)
+    report(results)
+
+    if options.save:
+        f = open(options.baseline, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        print 'Baselines saved to %s' % options.baseline
+
+    if options.compare:
+        f = open(options.baseline)
+        try:
+            baselines = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baselines, options.tolerance)
+        if regressions:
+            print
+            print 'Regressions:'
+            for regression in regressions:
+                print '  %s' % regression
+            return 1
+        print 'No regressions'
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+"""LDAP connections outside of LDAPDelegate.
+
+Background workers can't use acquisition wrapped, persistent LDAPDelegate
+objects, so they get plain copy of LDAP user folder connection settings and
+open their own connections with it. The same settings back the per thread
+connection pool plugins use for their own LDAP operations.
+"""
+import time
+import threading
+from urllib import quote
+
+import ldap
+
+from Products.LDAPUserFolder.utils import to_utf8, from_utf8, \
+    BINARY_ATTRIBUTES
+
+from collective.ploneldapplugin.instrumentation import getRecorder
+from collective.ploneldapplugin import getCacheKey
+
+
+def getConnectionSettings(acl):
+    """Return plain data needed to connect and bind to LDAP servers of a given
+    LDAP user folder:
+
+    {
+      'servers': ((uri, connection timeout, operation timeout), ...),
+      'bind_dn': dn to bind with, empty binds anonymously,
+      'bind_pwd': its password,
+      'write': true if LDAPDelegate writes with the same credentials,
+      'read_only': true if LDAP user folder is in read-only mode,
+    }
+
+    Settings follow LDAPDelegate configuration. It binds with the manager dn
+    for everything if binduid_usage is 1, only for user lookups if it is 2
+    and as the logged in user otherwise. Connections made with these
+    settings aren't tied to a user, so they bind with the manager dn for
+    reads only where the delegate would and anonymously otherwise, and
+    they're used for writes only if the delegate writes as the manager.
+    """
+    delegate = acl._delegate
+    usage = int(getattr(delegate, 'binduid_usage', 1) or 0)
+    servers = []
+    for server in delegate.getServers():
+        protocol = server.get('protocol', 'ldap')
+        if protocol == 'ldapi':
+            uri = 'ldapi://%s' % quote(server['host'], '')
+        else:
+            # ldaps servers use python-ldap TLS options like LDAPDelegate
+            uri = '%s://%s:%s' % (protocol, server['host'], server['port'])
+        servers.append((uri, server.get('conn_timeout', -1),
+            server.get('op_timeout', -1)))
+    if usage > 0:
+        bind_dn = to_utf8(acl._binduid or '')
+        bind_pwd = to_utf8(acl._bindpwd or '')
+    else:
+        bind_dn = bind_pwd = ''
+    return {
+        'servers': tuple(servers),
+        'bind_dn': bind_dn,
+        'bind_pwd': bind_pwd,
+        'write': usage == 1,
+        'read_only': bool(getattr(delegate, 'read_only', False)),
+    }
+
+def _open(settings):
+    """Return (uri, connection) of connection opened and bound to the first
+    available server
+    """
+    error = None
+    for uri, conn_timeout, op_timeout in settings['servers']:
+        try:
+            connection = ldap.initialize(uri)
+            connection.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
+            connection.set_option(ldap.OPT_REFERRALS, 0)
+            if conn_timeout > 0:
+                connection.set_option(ldap.OPT_NETWORK_TIMEOUT, conn_timeout)
+            if op_timeout > 0:
+                connection.timeout = op_timeout
+            connection.simple_bind_s(settings['bind_dn'],
+                settings['bind_pwd'])
+            return uri, connection
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT,
+                ldap.INVALID_CREDENTIALS), e:
+            # LDAPDelegate tries next server on these too
+            error = e
+    raise error or ldap.SERVER_DOWN({'desc': 'No LDAP servers configured'})
+
+def connect(settings):
+    """Open and bind connection to the first available server"""
+    return _open(settings)[1]
+
+
+class ConnectionPool(object):
+    """Bound LDAP connections kept per worker thread.
+
+    Each thread reuses its own connection, so binds (and TLS handshakes of
+    ldaps servers) happen once per thread instead of once per operation.
+    Connections idle for longer than idle_timeout are reopened, servers
+    usually drop them anyway, others are checked with a root DSE read every
+    check_interval seconds. Connections dropped by server are reopened and
+    rebound once per operation.
+
+    settings - see getConnectionSettings
+    size - maximum number of kept connections per server, threads over it
+           get connections closed right after use
+    """
+
+    def __init__(self, settings, size=10, idle_timeout=300,
+                 check_interval=60):
+        self.settings = settings
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        # instrumentation recorder of the plugin, if recording is on
+        self.recorder = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # server uri: number of kept connections
+        self._kept = {}
+
+    def connection(self):
+        """Return live connection of the current thread"""
+        entry = getattr(self._local, 'entry', None)
+        now = time.time()
+        if entry is not None:
+            connection, used, checked, uri = entry
+            if used + self.idle_timeout < now:
+                self.discard()
+                entry = None
+            elif checked + self.check_interval < now:
+                try:
+                    connection.search_s('', ldap.SCOPE_BASE,
+                        '(objectClass=*)', ['1.1'])
+                    entry[2] = now
+                except ldap.LDAPError:
+                    self.discard()
+                    entry = None
+
+        if entry is None:
+            uri, connection = _open(self.settings)
+            self._count('ldap connect')
+            self._lock.acquire()
+            try:
+                keep = self._kept.get(uri, 0) < self.size
+                if keep:
+                    self._kept[uri] = self._kept.get(uri, 0) + 1
+            finally:
+                self._lock.release()
+            if not keep:
+                # returned to release, which closes it
+                return connection
+            entry = self._local.entry = [connection, now, now, uri]
+
+        entry[1] = now
+        return entry[0]
+
+    def release(self, connection):
+        """Close connection if it's not kept by the pool"""
+        entry = getattr(self._local, 'entry', None)
+        if entry is None or entry[0] is not connection:
+            try:
+                connection.unbind_s()
+            except ldap.LDAPError:
+                pass
+
+    def discard(self):
+        """Forget connection of the current thread"""
+        entry = getattr(self._local, 'entry', None)
+        if entry is None:
+            return
+        self._local.entry = None
+        self._lock.acquire()
+        try:
+            self._kept[entry[3]] -= 1
+        finally:
+            self._lock.release()
+        try:
+            entry[0].unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def run(self, func, *args, **kw):
+        """Call func with connection as first argument, on a connection
+        reopened and rebound if server dropped the previous one
+        """
+        connection = self.connection()
+        try:
+            try:
+                return func(connection, *args, **kw)
+            except ldap.SERVER_DOWN:
+                self.release(connection)
+                self.discard()
+                self._count('ldap reconnect')
+                connection = None
+                connection = self.connection()
+                return func(connection, *args, **kw)
+        finally:
+            if connection is not None:
+                self.release(connection)
+
+    def search(self, base, scope, filter, attrs=None):
+        """Search the same way LDAPDelegate.search does:
+
+        {
+          'exception': error description or '',
+          'size': number of results,
+          'results': [{'dn': dn, attribute: [values]}],
+        }
+
+        Like there, dn and values are decoded from utf-8, except values of
+        binary attributes.
+        """
+        def search(connection):
+            return connection.search_s(to_utf8(base), scope,
+                to_utf8(filter), attrs)
+        try:
+            res = self.run(search)
+        except ldap.NO_SUCH_OBJECT:
+            return {'exception': 'Cannot find %s under %s' % (filter, base),
+                'size': 0, 'results': []}
+        except ldap.LDAPError, e:
+            return {'exception': str(e), 'size': 0, 'results': []}
+
+        results = []
+        for dn, entry in res:
+            # skip referrals
+            if dn is None:
+                continue
+            for key, values in entry.items():
+                if key.lower() not in BINARY_ATTRIBUTES:
+                    entry[key] = [from_utf8(value) for value in values]
+            entry['dn'] = from_utf8(dn)
+            results.append(entry)
+        return {'exception': '', 'size': len(results), 'results': results}
+
+    def _count(self, name):
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.count(name)
+
+# plugin key: connection pool
+_pools = {}
+_pools_lock = threading.Lock()
+
+def getConnectionPool(plugin, write=False):
+    """Return connection pool of a given plugin or None if plugin
+    connection_pool_size is 0. With write, None is returned also if
+    LDAPDelegate doesn't write with the credentials pooled connections are
+    bound with, callers write through LDAPDelegate then.
+
+    Pool is replaced when LDAP servers or bind settings change.
+    """
+    size = int(getattr(plugin, 'connection_pool_size', 0) or 0)
+    if size <= 0:
+        return None
+    settings = getConnectionSettings(plugin._getLDAPUserFolder())
+    if write and not settings['write']:
+        return None
+    key = getCacheKey(plugin)
+    pool = _pools.get(key)
+    if pool is None or pool.settings != settings:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(key)
+            if pool is None or pool.settings != settings:
+                pool = _pools[key] = ConnectionPool(settings)
+        finally:
+            _pools_lock.release()
+    pool.size = size
+    pool.idle_timeout = getattr(plugin, 'connection_idle_timeout', 300)
+    pool.check_interval = getattr(plugin, 'connection_check_interval', 60)
+    pool.recorder = getRecorder(plugin)
+    return pool
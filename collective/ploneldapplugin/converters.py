@@ -8,12 +8,15 @@ from DateTime import DateTime
 from zope.interface import implements
 from zope.component import adapts
 
-from collective.ploneldapplugin.interfaces import ILDAPAttributeConverter
+from collective.ploneldapplugin.interfaces import \
+    IBatchLDAPAttributeConverter
+from collective.ploneldapplugin.generalizedtime import \
+    parseGeneralizedTime, formatGeneralizedTime
 
 class BaseConverter(object):
     """Abstract converter class to perform some common routine"""
     
-    implements(ILDAPAttributeConverter)
+    implements(IBatchLDAPAttributeConverter)
     adapts(AttributeType)
     
     def __init__(self, attribute):
@@ -24,6 +27,16 @@ class BaseConverter(object):
         """
         self.attribute = attribute    
 
+    def fromLDAPValues(self, values, info):
+        """See interface"""
+        convert = self.fromLDAPValue
+        return [convert(value, info) for value in values]
+
+    def toLDAPValues(self, values, info):
+        """See interface"""
+        convert = self.toLDAPValue
+        return [convert(value, info) for value in values]
+
 class DefaultConverter(BaseConverter):
     """Makes sure everything going into ldap is a string."""
     
@@ -81,6 +94,23 @@ class StringConverter(BaseConverter):
             value = value.encode('utf-8')
         return value
 
+    def fromLDAPValues(self, values, info):
+        """See interface"""
+        # python ldap gives us strings only, unicode() refuses to decode
+        # anything else
+        try:
+            return [unicode(value, 'utf-8') for value in values]
+        except TypeError:
+            return BaseConverter.fromLDAPValues(self, values, info)
+
+    def toLDAPValues(self, values, info):
+        """See interface"""
+        # encoding works for unicode and ascii strings
+        try:
+            return [value.encode('utf-8') for value in values]
+        except (UnicodeError, AttributeError):
+            return BaseConverter.toLDAPValues(self, values, info)
+
 class IntegerConverter(BaseConverter):
     """Handles ldap integer syntaxes"""
     
@@ -96,6 +126,14 @@ class IntegerConverter(BaseConverter):
             value = str(value)
         return value
 
+    def fromLDAPValues(self, values, info):
+        """See interface"""
+        return map(int, values)
+
+    def toLDAPValues(self, values, info):
+        """See interface"""
+        return map(str, values)
+
 class NumericConverter(BaseConverter):
     """Handles ldap integer syntaxes"""
     
@@ -111,6 +149,14 @@ class NumericConverter(BaseConverter):
             value = str(value)
         return value
 
+    def fromLDAPValues(self, values, info):
+        """See interface"""
+        return map(float, values)
+
+    def toLDAPValues(self, values, info):
+        """See interface"""
+        return map(str, values)
+
 class BooleanConverter(BaseConverter):
     """Handles ldap boolean syntaxes"""
     
@@ -128,6 +174,14 @@ class BooleanConverter(BaseConverter):
             value = 'FALSE'
         return value
 
+    def fromLDAPValues(self, values, info):
+        """See interface"""
+        return [value == 'TRUE' for value in values]
+
+    def toLDAPValues(self, values, info):
+        """See interface"""
+        return [value and 'TRUE' or 'FALSE' for value in values]
+
 class DateTimeConverter(BaseConverter):
     """Handles ldap datetime syntaxes.
     
@@ -142,31 +196,40 @@ class DateTimeConverter(BaseConverter):
     
     def fromLDAPValue(self, value, info):
         """See interface"""
-        # check that we return datetimes in instance timezone
-        try:
-            value = datetime(*time.strptime(value, self.format)[:6])
-        except ValueError, e:
-            return None
+        value = self._parse(value)
         # TODO: temporarily workaround for login time attribute
         #       we need a way to distinguish between python and
         #       zope datetime objects, when to return which one
-        if info[1] == 'login_time':
+        if value is not None and info[1] == 'login_time':
             value = DateTime(value.isoformat())
         return value
+
+    def fromLDAPValues(self, values, info):
+        """See interface"""
+        parse = self._parse
+        values = [parse(value) for value in values]
+        if info[1] == 'login_time':
+            values = [value is not None and DateTime(value.isoformat()) or
+                None for value in values]
+        return values
+
+    def _parse(self, value):
+        # check that we return datetimes in instance timezone
+        return parseGeneralizedTime(value)
     
     def toLDAPValue(self, value, info):
         """See interface.
         
         It's required to keep time attributes inside ldap in
         Universal timezones."""
-        # TODO: make sure python datetime is saved in UTC timezone
+        # naive python datetimes are expected to be in UTC already
         if isinstance(value, DateTime):
             value = value.toZone('UTC')
             value = "%0.4d%0.2d%0.2d%0.2d%0.2d%0.2dZ" % (
                 value._year, value._month, value._day,
                 value._hour, value._minute, value._second)
         elif isinstance(value, (datetime, date)):
-            value = value.strftime(self.format)
+            value = formatGeneralizedTime(value)
         elif isinstance(value, time.struct_time):
             value = time.strftime(self.format, value)
         elif value is None:
@@ -0,0 +1,220 @@
+"""Streaming export of all LDAP users with converted properties.
+
+Users are read with RFC 2696 paged results control, one page at a time,
+requesting only attributes of property sheet schema, and rows are yielded
+one by one so memory use doesn't grow with directory size.
+
+Export from command line with zope configuration:
+
+  bin/ploneldapplugin-export -C parts/instance/etc/zope.conf \\
+      /plone/acl_users/ldap-plugin -f csv -o users.csv
+
+or within running instance:
+
+  bin/instance run collective/ploneldapplugin/export.py \\
+      /plone/acl_users/ldap-plugin -f jsonl -o users.jsonl
+"""
+import sys
+import csv
+import types
+from optparse import OptionParser
+from datetime import datetime, date
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import filter_format
+
+from DateTime import DateTime
+
+from Products.LDAPUserFolder.utils import to_utf8
+
+from collective.ploneldapplugin.connection import connect, \
+    getConnectionSettings, getConnectionPool
+from collective.ploneldapplugin.ldapproperty import getSheetSchema
+
+PAGED_RESULTS_OID = '1.2.840.113556.1.4.319'
+
+# entries per page if plugin has no export_page_size
+PAGE_SIZE = 500
+
+
+def _pageControl(size, cookie=''):
+    try:
+        # python-ldap 2.4
+        return SimplePagedResultsControl(True, size=size, cookie=cookie)
+    except TypeError:
+        return SimplePagedResultsControl(PAGED_RESULTS_OID, True,
+            (size, cookie))
+
+def _pageCookie(serverctrls):
+    for control in serverctrls or ():
+        if control.controlType == PAGED_RESULTS_OID:
+            cookie = getattr(control, 'cookie', None)
+            if cookie is None:
+                cookie = control.controlValue[1]
+            return cookie
+    return ''
+
+def iterPages(connection, base, scope, filter, attrs, page_size):
+    """Yield lists of (dn, entry) of paged search results"""
+    cookie = ''
+    while True:
+        msgid = connection.search_ext(base, scope, filter, attrs,
+            serverctrls=[_pageControl(page_size, cookie)])
+        rtype, rdata, rmsgid, serverctrls = connection.result3(msgid)
+        # skip referrals
+        yield [(dn, entry) for dn, entry in rdata if dn is not None]
+        cookie = _pageCookie(serverctrls)
+        if not cookie:
+            break
+
+def exportUsers(plugin, page_size=None):
+    """Yield {'id': user id, 'dn': dn, zopename: converted value} of all
+    plugin users
+    """
+    acl = plugin._getLDAPUserFolder()
+    uid_attr = acl._uid_attr
+    page_size = page_size or getattr(plugin, 'export_page_size', PAGE_SIZE)
+
+    plan = plugin.getConversionPlan(getSheetSchema(acl))
+    attrs = [entry[0] for entry in plan.entries]
+    if uid_attr != 'dn' and uid_attr not in attrs:
+        attrs.append(uid_attr)
+
+    filter = '(&%s)' % ''.join([filter_format('(objectClass=%s)', (oc,))
+        for oc in acl._user_objclasses])
+
+    # keep one connection for the whole export, paged results cookie is
+    # only valid on the connection it was issued on
+    pool = getConnectionPool(plugin)
+    if pool is not None:
+        connection = pool.connection()
+    else:
+        connection = connect(getConnectionSettings(acl))
+    try:
+        for page in iterPages(connection, to_utf8(acl.users_base),
+                              acl.users_scope, filter, attrs, page_size):
+            for dn, entry in page:
+                yield convertEntry(plan, uid_attr, dn, entry)
+    finally:
+        if pool is not None:
+            pool.release(connection)
+        else:
+            connection.unbind_s()
+
+def convertEntry(plan, uid_attr, dn, entry):
+    """Convert raw search result entry with plugin conversion plan"""
+    # attribute names in results keep server case
+    values = dict([(name.lower(), value) for name, value in entry.items()])
+    if uid_attr == 'dn':
+        uid = dn
+    else:
+        uid = (values.get(uid_attr.lower()) or [''])[0]
+    row = {'id': uid, 'dn': dn}
+    for ldapname, zopename, type, converter in plan.entries:
+        value = values.get(ldapname.lower())
+        info = (ldapname, zopename, type)
+        if not value:
+            row[zopename] = type == 'lines' and [] or None
+        elif type == 'lines':
+            convert = getattr(converter, 'fromLDAPValues', None)
+            if convert is not None:
+                row[zopename] = convert(value, info)
+            else:
+                row[zopename] = [converter.fromLDAPValue(v, info)
+                    for v in value]
+        else:
+            row[zopename] = converter.fromLDAPValue(value[0], info)
+    return row
+
+def serialize(value):
+    """Return value JSON can take"""
+    if isinstance(value, (types.ListType, types.TupleType)):
+        return [serialize(v) for v in value]
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, DateTime):
+        return value.ISO8601()
+    if isinstance(value, str):
+        return unicode(value, 'utf-8', 'replace')
+    return value
+
+def writeJSONLines(rows, out):
+    count = 0
+    for row in rows:
+        for key, value in row.items():
+            row[key] = serialize(value)
+        out.write(json.dumps(row) + '\n')
+        count += 1
+    return count
+
+def writeCSV(rows, out, fields):
+    """Write rows as CSV, multiple values are separated by new lines"""
+    writer = csv.writer(out)
+    writer.writerow(fields)
+    count = 0
+    for row in rows:
+        record = []
+        for field in fields:
+            value = serialize(row.get(field))
+            if isinstance(value, types.ListType):
+                value = u'\n'.join([unicode(v) for v in value])
+            if value is None:
+                value = u''
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            record.append(value)
+        writer.writerow(record)
+        count += 1
+    return count
+
+def export(plugin, out, format='jsonl', page_size=None):
+    """Write all plugin users to a file like object, return their count"""
+    rows = exportUsers(plugin, page_size)
+    if format == 'csv':
+        plan = plugin.getConversionPlan(getSheetSchema(
+            plugin._getLDAPUserFolder()))
+        fields = ['id', 'dn'] + [entry[1] for entry in plan.entries]
+        return writeCSV(rows, out, fields)
+    return writeJSONLines(rows, out)
+
+def main(argv=None, app=None):
+    parser = OptionParser(usage='%prog [options] plugin-path')
+    parser.add_option('-C', '--config', help='zope configuration file, not '
+        'needed when run with bin/instance run')
+    parser.add_option('-f', '--format', choices=['jsonl', 'csv'],
+        default='jsonl', help='jsonl or csv (default: %default)')
+    parser.add_option('-o', '--output', help='output file (default: stdout)')
+    parser.add_option('-p', '--page-size', type='int', dest='page_size',
+        help='entries per LDAP page (default: plugin export_page_size)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('plugin path expected')
+
+    if app is None:
+        if not options.config:
+            parser.error('zope configuration file expected')
+        import Zope2
+        Zope2.configure(options.config)
+        app = Zope2.app()
+    plugin = app.unrestrictedTraverse(args[0])
+
+    if options.output:
+        out = open(options.output, 'wb')
+    else:
+        out = sys.stdout
+    try:
+        count = export(plugin, out, options.format, options.page_size)
+    finally:
+        if options.output:
+            out.close()
+    sys.stderr.write('Exported %d users\n' % count)
+    return 0
+
+if __name__ == '__main__':
+    # bin/instance run puts zope application into globals
+    sys.exit(main(sys.argv[1:], globals().get('app')))
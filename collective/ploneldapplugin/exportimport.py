@@ -28,6 +28,13 @@ CACHE_MAPPING = {
     'negative_cache_seconds': 'negative'
 }
 
+# cache settings kept as properties of enhanced plugins
+PLUGIN_CACHE_PROPERTIES = (
+    'stale_while_revalidate',
+    'stale_soft_ttl',
+    'stale_hard_ttl',
+)
+
 
 class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
     """ XML im/exporter for Plone LDAP settings
@@ -52,7 +59,12 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
         return node
 
     def _importNode(self, node):
-        """Import the object from the DOM node"""
+        """Import the object from the DOM node.
+
+        Only settings differing from current ones are changed and notified,
+        descriptions of the changes are kept in changes list.
+        """
+        self.changes = []
         if self.environ.shouldPurge():
             self._purgeSettings()
 
@@ -63,7 +75,20 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
         self._initLDAPSchema(node)
         self._initCacheSettings(node)
 
-        self._logger.info('Plone LDAP settings imported.')
+        if self.changes:
+            self._logger.info('Plone LDAP settings imported, %d changes: %s.'
+                % (len(self.changes), '; '.join(self.changes)))
+        else:
+            self._logger.info('Plone LDAP settings imported, nothing '
+                'changed.')
+
+    def _changed(self, old, new, fields):
+        """Return names of fields differing in two objects, compared as
+        they are exported
+        """
+        return [fname for fname in fields if
+            self._toString(getattr(old, fname, None)) !=
+            self._toString(getattr(new, fname, None))]
 
     def _purgeSettings(self):
         """Purge all settings before applying them"""
@@ -129,7 +154,8 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
         """Extract ldap cache settings"""
         fragment = self._doc.createDocumentFragment()
         node = self._doc.createElement('cache-settings')
-        luf = getLDAPPlugin()._getLDAPUserFolder()
+        plugin = getLDAPPlugin()
+        luf = plugin._getLDAPUserFolder()
 
         for cache_value_name, cache_type in CACHE_MAPPING.items():
             child = self._doc.createElement('property')
@@ -137,6 +163,14 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
             value = luf.getCacheTimeout(cache_type)
             child.appendChild(self._doc.createTextNode(self._toString(value)))
             node.appendChild(child)
+        for name in PLUGIN_CACHE_PROPERTIES:
+            if not plugin.hasProperty(name):
+                continue
+            child = self._doc.createElement('property')
+            child.setAttribute('name', name)
+            value = plugin.getProperty(name)
+            child.appendChild(self._doc.createTextNode(self._toString(value)))
+            node.appendChild(child)
         fragment.appendChild(node)
 
         return fragment
@@ -172,8 +206,12 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
             # unicode attributes
             elif attr_name in ('ldap_type',):
                 value = safe_unicode(value)
-            
+
+            current = getattr(self.context, attr_name, None)
+            if self._toString(current) == self._toString(value):
+                continue
             setattr(self.context, attr_name, value)
+            self.changes.append('%s modified' % attr_name)
             updated = True
         
         if updated:
@@ -191,12 +229,10 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
             if child.nodeName != 'servers':
                 continue
 
-            # if to purge existing servers
+            # if to purge existing servers, those missing in xml are removed
+            # after the rest is applied
             purge = self._convertToBoolean(child.getAttribute('purge') or '0')
-            if purge and servers:
-                storage.__init__()
-                storage._p_changed = True
-                servers = {}
+            listed = set()
 
             for gchild in child.childNodes:
                 if gchild.nodeName != 'server':
@@ -216,22 +252,41 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
                     operation_timeout=operation_timeout,
                     enabled=enabled)
                 server_key = (server.server, server.port)
-                
+                name = '%s:%s' % server_key
+
                 # remove="True" in xml file to delete server
                 remove = self._convertToBoolean(get('remove') or 'false')
                 if remove:
                     if server_key in servers:
-                        notify(ObjectRemovedEvent(servers[server_key]))
-                        del storage[servers[server_key]]
-                        del servers[server_key]
+                        sid = servers.pop(server_key)
+                        notify(ObjectRemovedEvent(storage[sid]))
+                        del storage[sid]
+                        self.changes.append('server %s removed' % name)
+                    continue
+
+                listed.add(server_key)
+                if server_key in servers:
+                    sid = servers[server_key]
+                    if not self._changed(storage[sid], server,
+                                         ILDAPServerConfiguration):
+                        continue
+                    del storage[sid]
+                    storage[sid] = server
+                    notify(ObjectModifiedEvent(server))
+                    self.changes.append('server %s modified' % name)
                 else:
-                    if server_key in servers:
-                        del storage[servers[server_key]]
-                        storage[servers[server_key]] = server
-                        notify(ObjectModifiedEvent(server))
-                    else:
-                        storage.addItem(server)
-                        notify(ObjectCreatedEvent(server))
+                    storage.addItem(server)
+                    notify(ObjectCreatedEvent(server))
+                    self.changes.append('server %s added' % name)
+
+            if purge:
+                for server_key, sid in servers.items():
+                    if server_key not in listed:
+                        notify(ObjectRemovedEvent(storage[sid]))
+                        del storage[sid]
+                        del servers[server_key]
+                        self.changes.append('server %s:%s removed'
+                            % server_key)
 
     def _initLDAPSchema(self, node):
         """Initialize LDAP schema information"""
@@ -245,12 +300,10 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
             if child.nodeName != 'schema':
                 continue
 
-            # if to purge schema properties
+            # if to purge schema properties, those missing in xml are removed
+            # after the rest is applied
             purge = self._convertToBoolean(child.getAttribute('purge') or '0')
-            if purge and props:
-                schema.__init__()
-                schema._p_changed = True
-                props = {}
+            listed = set()
 
             for gchild in child.childNodes:
                 if gchild.nodeName != 'schema-item':
@@ -265,6 +318,8 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
                         notify(ObjectRemovedEvent(schema[props[ldap_name]]))
                         del schema[props[ldap_name]]
                         del props[ldap_name]
+                        self.changes.append('schema item %s removed'
+                            % ldap_name)
                 else:
                     # TODO: add 'binary' attribute to property when this is
                     #       implemented by plone.app.ldap package
@@ -273,18 +328,37 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
                         plone_name=get('plone_name') or '',
                         description=safe_unicode(get('description') or ''),
                         multi_valued=self._convertToBoolean(get('multi_valued'))
-                    )                        
+                    )
+                    listed.add(ldap_name)
                     if ldap_name in props:
-                        del schema[props[ldap_name]]
-                        schema[props[ldap_name]] = prop
+                        pid = props[ldap_name]
+                        if not self._changed(schema[pid], prop,
+                                             ILDAPPropertyConfiguration):
+                            continue
+                        del schema[pid]
+                        schema[pid] = prop
                         notify(ObjectModifiedEvent(prop))
+                        self.changes.append('schema item %s modified'
+                            % ldap_name)
                     else:
                         schema.addItem(prop)
                         notify(ObjectCreatedEvent(prop))
+                        self.changes.append('schema item %s added'
+                            % ldap_name)
+
+            if purge:
+                for ldap_name, pid in props.items():
+                    if ldap_name not in listed:
+                        notify(ObjectRemovedEvent(schema[pid]))
+                        del schema[pid]
+                        del props[ldap_name]
+                        self.changes.append('schema item %s removed'
+                            % ldap_name)
 
     def _initCacheSettings(self, node):
         """Initialize cache settings"""
-        luf = getLDAPPlugin()._getLDAPUserFolder()
+        plugin = getLDAPPlugin()
+        luf = plugin._getLDAPUserFolder()
         
         for child in node.childNodes:
             if child.nodeName != 'cache-settings':
@@ -297,8 +371,22 @@ class PloneLDAPSettingsXMLAdapter(XMLAdapterBase):
                 value = self._getNodeText(gchild)
                 attr_name = gchild.getAttribute('name')
                 if attr_name in CACHE_MAPPING:
-                    luf.setCacheTimeout(cache_type=CACHE_MAPPING[attr_name],
+                    cache_type = CACHE_MAPPING[attr_name]
+                    if luf.getCacheTimeout(cache_type) == int(value):
+                        continue
+                    luf.setCacheTimeout(cache_type=cache_type,
                                         timeout=int(value))
+                    self.changes.append('%s modified' % attr_name)
+                elif attr_name in PLUGIN_CACHE_PROPERTIES and \
+                     plugin.hasProperty(attr_name):
+                    if plugin.getPropertyType(attr_name) == 'boolean':
+                        value = self._convertToBoolean(value)
+                    else:
+                        value = int(value)
+                    if plugin.getProperty(attr_name) == value:
+                        continue
+                    plugin._updateProperty(attr_name, value)
+                    self.changes.append('%s modified' % attr_name)
 
     def _toString(self, value):
         if not isinstance(value, types.StringTypes):
@@ -0,0 +1,90 @@
+"""GeneralizedTime (RFC 4517, 3.3.13) parser and formatter.
+
+Handles all legal forms, e.g. 199412161032Z, 19941216103245.5Z,
+20100102030405.123-0500 or 2010010203+02, way faster than time.strptime.
+Parsed values are naive datetime objects in UTC.
+"""
+import re
+from datetime import datetime, date, timedelta
+
+_pattern = re.compile(
+    r'^(\d{4})(\d{2})(\d{2})(\d{2})'    # century, year, month, day, hour
+    r'(?:(\d{2})(\d{2})?)?'             # optional minute and second
+    r'(?:[.,](\d+))?'                   # optional fraction
+    r'(Z|[+-]\d{2}(?:\d{2})?)?$')       # time zone
+
+# recently parsed values, many entries share the same timestamps
+_cache = {}
+CACHE_SIZE = 10000
+
+
+def parseGeneralizedTime(value):
+    """Return naive UTC datetime for a given GeneralizedTime string or None
+    if it's not valid. Values without time zone are taken as they are.
+    """
+    result = _cache.get(value)
+    if result is not None:
+        return result
+
+    try:
+        # the most common form: YYYYMMDDHHMMSSZ
+        if len(value) == 15 and value[14] == 'Z' and value[:14].isdigit() \
+           and value[12:14] != '60':
+            result = datetime(int(value[0:4]), int(value[4:6]),
+                int(value[6:8]), int(value[8:10]), int(value[10:12]),
+                int(value[12:14]))
+        else:
+            result = _parse(value)
+    except ValueError:
+        return None
+
+    if result is not None:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[value] = result
+    return result
+
+def _parse(value):
+    match = _pattern.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+
+    # leap second can't be represented by datetime
+    leap = second == '60'
+    if leap:
+        second = '59'
+    result = datetime(int(year), int(month), int(day), int(hour),
+        int(minute or 0), int(second or 0))
+
+    # fraction belongs to the last given unit
+    if fraction:
+        fraction = float('0.' + fraction)
+        if second is not None:
+            result += timedelta(microseconds=int(fraction * 1000000))
+        elif minute is not None:
+            result += timedelta(seconds=fraction * 60)
+        else:
+            result += timedelta(seconds=fraction * 3600)
+    if leap:
+        result = result.replace(microsecond=999999)
+
+    if zone and zone != 'Z':
+        offset = timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5] or 0))
+        if zone[0] == '+':
+            result -= offset
+        else:
+            result += offset
+    return result
+
+def formatGeneralizedTime(value):
+    """Return GeneralizedTime string in UTC for python date or datetime"""
+    if isinstance(value, datetime):
+        offset = value.utcoffset()
+        if offset:
+            value -= offset
+        return '%04d%02d%02d%02d%02d%02dZ' % (value.year, value.month,
+            value.day, value.hour, value.minute, value.second)
+    elif isinstance(value, date):
+        return '%04d%02d%02d000000Z' % (value.year, value.month, value.day)
+    raise TypeError('date or datetime expected, got %r' % (value,))
@@ -0,0 +1,173 @@
+"""Hot path instrumentation of LDAP plugins.
+
+While plugin record_metrics property is on, counters and latency histograms
+of LDAP round trips, attribute conversions, cache lookups and cache
+expirations are kept in memory, shared by all threads of the process. Code
+paths get recorder with getRecorder(plugin) which returns None when
+recording is off, so the only cost then is a property lookup.
+"""
+import time
+import threading
+from bisect import bisect_left
+
+from collective.ploneldapplugin import getCacheKey
+
+# upper bounds of latency histogram buckets in milliseconds
+BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class Timer(object):
+    """Latency statistics and histogram of one operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, elapsed):
+        elapsed = elapsed * 1000
+        self.count += 1
+        self.total += elapsed
+        if self.min is None or elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.buckets[bisect_left(BUCKETS, elapsed)] += 1
+
+    def info(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.count and self.total / self.count or 0.0,
+            'min_ms': self.min or 0.0,
+            'max_ms': self.max,
+            'histogram': [[bound, count] for bound, count in
+                zip(BUCKETS + (None,), self.buckets)],
+        }
+
+class Recorder(object):
+    """Thread safe metrics of one plugin
+
+    counters - {name: count}
+    timers - {group: {name: Timer}}, groups are 'ldap' and 'conversion'
+    caches - {name: [hits, misses]}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.started = time.time()
+            self.counters = {}
+            self.timers = {}
+            self.caches = {}
+        finally:
+            self._lock.release()
+
+    def count(self, name, value=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+
+    def record(self, group, name, elapsed):
+        """Add elapsed seconds of a given operation"""
+        self._lock.acquire()
+        try:
+            timers = self.timers.setdefault(group, {})
+            timer = timers.get(name)
+            if timer is None:
+                timer = timers[name] = Timer()
+            timer.add(elapsed)
+        finally:
+            self._lock.release()
+
+    def hit(self, name):
+        self._cache(name, 0)
+
+    def miss(self, name):
+        self._cache(name, 1)
+
+    def _cache(self, name, index):
+        self._lock.acquire()
+        try:
+            stats = self.caches.get(name)
+            if stats is None:
+                stats = self.caches[name] = [0, 0]
+            stats[index] += 1
+        finally:
+            self._lock.release()
+
+    def info(self):
+        """Return metrics as mapping of plain python types"""
+        self._lock.acquire()
+        try:
+            timers = {}
+            for group, values in self.timers.items():
+                timers[group] = dict([(name, timer.info())
+                    for name, timer in values.items()])
+            caches = {}
+            for name, (hits, misses) in self.caches.items():
+                total = hits + misses
+                caches[name] = {'hits': hits, 'misses': misses,
+                    'ratio': total and float(hits) / total or 0.0}
+            return {
+                'started': self.started,
+                'elapsed': time.time() - self.started,
+                'counters': dict(self.counters),
+                'timers': timers,
+                'caches': caches,
+            }
+        finally:
+            self._lock.release()
+
+def timed(recorder, group, name, func, *args, **kw):
+    """Call func recording its latency if there is a recorder"""
+    if recorder is None:
+        return func(*args, **kw)
+    start = time.time()
+    try:
+        return func(*args, **kw)
+    finally:
+        recorder.record(group, name, time.time() - start)
+
+# plugin key: recorder
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+def getRecorder(plugin):
+    """Return metrics recorder of a given plugin or None if recording is
+    off
+    """
+    if not getattr(plugin, 'record_metrics', False):
+        return None
+    key = getCacheKey(plugin)
+    recorder = _recorders.get(key)
+    if recorder is None:
+        _recorders_lock.acquire()
+        try:
+            recorder = _recorders.get(key)
+            if recorder is None:
+                recorder = _recorders[key] = Recorder()
+        finally:
+            _recorders_lock.release()
+    return recorder
+
+def getMetrics(plugin):
+    """Return recorded metrics of a given plugin, see Recorder.info"""
+    recorder = _recorders.get(getCacheKey(plugin))
+    if recorder is None:
+        return {'started': None, 'elapsed': 0.0, 'counters': {},
+            'timers': {}, 'caches': {}}
+    return recorder.info()
+
+def resetMetrics(plugin):
+    recorder = _recorders.get(getCacheKey(plugin))
+    if recorder is not None:
+        recorder.reset()
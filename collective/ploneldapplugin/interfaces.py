@@ -24,3 +24,59 @@ class ILDAPAttributeConverter(Interface):
         info - tuple containing zope related vars:
         (ldap name, zope name, type (lines|string))
         """
+
+
+class IBatchLDAPAttributeConverter(ILDAPAttributeConverter):
+    """LDAP Attribute Values Converter able to convert many values at once.
+
+    Optional, multivalued attributes of converters which only provide
+    ILDAPAttributeConverter are converted value by value.
+    """
+
+    def fromLDAPValues(values, info):
+        """Converts list of ldap attribute values to list of python values.
+
+        info - tuple containing zope related vars:
+        (ldap name, zope name, type (lines|string))
+        """
+
+    def toLDAPValues(values, info):
+        """Converts list of python values to list of ldap attribute strings.
+
+        info - tuple containing zope related vars:
+        (ldap name, zope name, type (lines|string))
+        """
+
+
+class ISharedCacheBackend(Interface):
+    """Key/value store shared by all ZEO clients, e.g. memcached.
+
+    Keys and values are strings. Failures are not raised, they are reported
+    as missing values or False.
+    """
+
+    def get(key):
+        """Return value or None"""
+
+    def set(key, value, ttl=0):
+        """Store value for ttl seconds, 0 means no expiry"""
+
+    def add(key, value, ttl=0):
+        """Store value only if key is not there yet, return True if stored"""
+
+    def incr(key, delta=1):
+        """Increment numeric value, return new value or None if key is not
+        there
+        """
+
+    def delete(key):
+        """Remove key"""
+
+
+class ISharedCacheBackendFactory(Interface):
+    """Utility making ISharedCacheBackend for given servers"""
+
+    def __call__(servers):
+        """Return ISharedCacheBackend for a sequence of server addresses
+        taken from plugin shared_cache_servers property
+        """
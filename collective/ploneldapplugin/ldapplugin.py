@@ -1,19 +1,43 @@
 import logging
-from ldap import schema
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 from zope.interface import implementedBy, classImplements
 
 from AccessControl import ClassSecurityInfo
 from Globals import InitializeClass
 from Acquisition import aq_base
-from persistent.mapping import PersistentMapping
 
 from Products.PageTemplates.PageTemplateFile import PageTemplateFile
+from Products.PluggableAuthService.permissions import ManageUsers
 from Products.PloneLDAP.plugins.ldap import PloneLDAPMultiPlugin
 from Products.PloneLDAP.factory import genericPluginCreation
 
-from collective.ploneldapplugin.ldapproperty import EnhancedLDAPPropertySheet
-from collective.ploneldapplugin import logException
+from collective.ploneldapplugin.ldapproperty import \
+    EnhancedLDAPPropertySheet, getConversionPlan, getPropertySheet, \
+    getCachedPropertySheets, cachePropertySheets, forgetPropertySheet, \
+    prefetchProperties
+from collective.ploneldapplugin.schemacache import getLDAPAttrs, \
+    getLDAPMetaData, refreshLDAPAttrs
+from collective.ploneldapplugin.schemasnapshot import getSnapshotDirectory
+from collective.ploneldapplugin.connection import getConnectionPool
+from collective.ploneldapplugin.propertysearch import getPropertyQuery, \
+    getHeavyAttributes, searchProperties
+from collective.ploneldapplugin.export import exportUsers
+from collective.ploneldapplugin.provisioning import addUsers, \
+    importGroups
+from collective.ploneldapplugin.sharedcache import \
+    invalidateSharedProperties
+from collective.ploneldapplugin.warmcache import forgetWarmProperties
+from collective.ploneldapplugin.negativecache import isAbsentUser, \
+    addAbsentUser
+from collective.ploneldapplugin.stalecache import getStaleCache, \
+    lookupUser, forgetUserLookups
+from collective.ploneldapplugin.instrumentation import getRecorder, \
+    getMetrics, resetMetrics
 
 
 manage_addEnhancedPloneLDAPMultiPluginForm = PageTemplateFile(
@@ -48,6 +72,149 @@ class EnhancedPloneLDAPMultiPlugin(PloneLDAPMultiPlugin):
     security = ClassSecurityInfo()
     meta_type = "Enhanced Plone LDAP plugin"
 
+    # maximum number of user ids put into one OR-filtered LDAP search
+    bulk_chunk_size = 100
+    # seconds to keep LDAP schema attributes metadata in memory
+    schema_cache_ttl = 3600
+    # keep parsed LDAP schema on disk to start without reading it from LDAP,
+    # snapshots go to zope client home unless directory is given
+    use_schema_snapshot = True
+    schema_snapshot_dir = ''
+    # write only changed attributes and keep caches if nothing changed
+    dirty_tracking = True
+    # properties written in background by write-behind queue, e.g. login_time
+    volatile_properties = ()
+    write_behind_interval = 30
+    write_behind_max = 10000
+    # collect hot path metrics shown in Metrics tab
+    record_metrics = False
+    # return the same property sheet of a user for the rest of the request
+    cache_sheets_per_request = False
+    # memcached servers ('host:port' or 'unix:/path') sharing raw LDAP
+    # properties between ZEO clients
+    shared_cache_servers = ()
+    shared_cache_ttl = 600
+    # read properties of users found by member searches in bulk, at most
+    # bulk_chunk_size of them
+    prefetch_enumerated_users = False
+    # entries per LDAP page when exporting all users
+    export_page_size = 500
+    # LDAP writes in flight when adding users or groups in bulk
+    bulk_add_window = 20
+    # bound LDAP connections kept per thread and server, 0 turns pool off
+    connection_pool_size = 10
+    # seconds after which idle pooled connections are reopened
+    connection_idle_timeout = 300
+    # seconds between liveness checks of pooled connections
+    connection_check_interval = 60
+    # raw LDAP properties of recently used users kept in memory and in a
+    # snapshot restarted processes start with, 0 turns it off; snapshots go
+    # to zope client home unless directory is given
+    warm_cache_size = 0
+    warm_cache_ttl = 300
+    warm_snapshot_interval = 0
+    warm_snapshot_dir = ''
+    # remember ids of users not in LDAP, 0 turns it off. Users added to LDAP
+    # in other ways or through other ZEO clients are found only after ttl.
+    negative_cache_size = 0
+    negative_cache_ttl = 300
+    # read users with a search of property sheet attributes only instead of
+    # LDAP user folder getUserById, its user cache is bypassed then
+    projected_reads = False
+    # attributes read when first asked for instead of with other properties,
+    # those of binary syntaxes too unless lazy_binary_attributes is off
+    heavy_attributes = ()
+    lazy_binary_attributes = True
+    # keep raw LDAP values in property sheets and convert each property on
+    # first access
+    lazy_conversion = False
+    # keep property sheet values in layouts shared per plugin and intern
+    # short string values
+    compact_sheets = False
+    # serve expired user lookups and warm cache properties until hard ttl
+    # while they are refreshed in background
+    stale_while_revalidate = False
+    stale_soft_ttl = 60
+    stale_hard_ttl = 3600
+
+    _properties = PloneLDAPMultiPlugin._properties + (
+        {'id': 'bulk_chunk_size', 'type': 'int', 'mode': 'w',
+         'label': 'Users per LDAP search in bulk property reads'},
+        {'id': 'schema_cache_ttl', 'type': 'int', 'mode': 'w',
+         'label': 'LDAP schema metadata cache timeout (seconds)'},
+        {'id': 'use_schema_snapshot', 'type': 'boolean', 'mode': 'w',
+         'label': 'Keep LDAP schema snapshot on disk'},
+        {'id': 'schema_snapshot_dir', 'type': 'string', 'mode': 'w',
+         'label': 'LDAP schema snapshot directory'},
+        {'id': 'dirty_tracking', 'type': 'boolean', 'mode': 'w',
+         'label': 'Write only changed properties to LDAP'},
+        {'id': 'volatile_properties', 'type': 'lines', 'mode': 'w',
+         'label': 'Properties written in background (e.g. login_time)'},
+        {'id': 'write_behind_interval', 'type': 'int', 'mode': 'w',
+         'label': 'Seconds between background writes'},
+        {'id': 'write_behind_max', 'type': 'int', 'mode': 'w',
+         'label': 'Maximum number of users waiting for background write'},
+        {'id': 'record_metrics', 'type': 'boolean', 'mode': 'w',
+         'label': 'Record performance metrics'},
+        {'id': 'cache_sheets_per_request', 'type': 'boolean', 'mode': 'w',
+         'label': 'Cache property sheets for the rest of the request'},
+        {'id': 'shared_cache_servers', 'type': 'lines', 'mode': 'w',
+         'label': 'Shared property cache servers (host:port or unix:/path)'},
+        {'id': 'shared_cache_ttl', 'type': 'int', 'mode': 'w',
+         'label': 'Shared property cache timeout (seconds)'},
+        {'id': 'prefetch_enumerated_users', 'type': 'boolean', 'mode': 'w',
+         'label': 'Prefetch properties of users found by searches'},
+        {'id': 'export_page_size', 'type': 'int', 'mode': 'w',
+         'label': 'LDAP page size of users export'},
+        {'id': 'bulk_add_window', 'type': 'int', 'mode': 'w',
+         'label': 'LDAP writes in flight when adding users or groups in '
+                  'bulk'},
+        {'id': 'connection_pool_size', 'type': 'int', 'mode': 'w',
+         'label': 'Pooled LDAP connections per server (0 turns pool off)'},
+        {'id': 'connection_idle_timeout', 'type': 'int', 'mode': 'w',
+         'label': 'Reopen pooled connections idle for (seconds)'},
+        {'id': 'connection_check_interval', 'type': 'int', 'mode': 'w',
+         'label': 'Check pooled connections every (seconds)'},
+        {'id': 'warm_cache_size', 'type': 'int', 'mode': 'w',
+         'label': 'Users kept in warm property cache (0 turns it off)'},
+        {'id': 'warm_cache_ttl', 'type': 'int', 'mode': 'w',
+         'label': 'Warm property cache timeout (seconds)'},
+        {'id': 'warm_snapshot_interval', 'type': 'int', 'mode': 'w',
+         'label': 'Save warm property snapshot every (seconds, 0 only on '
+                  'shutdown)'},
+        {'id': 'warm_snapshot_dir', 'type': 'string', 'mode': 'w',
+         'label': 'Warm property snapshot directory'},
+        {'id': 'negative_cache_size', 'type': 'int', 'mode': 'w',
+         'label': 'User ids not in LDAP to remember (0 turns it off)'},
+        {'id': 'negative_cache_ttl', 'type': 'int', 'mode': 'w',
+         'label': 'Remember user ids not in LDAP for (seconds)'},
+        {'id': 'projected_reads', 'type': 'boolean', 'mode': 'w',
+         'label': 'Read only property sheet attributes of users'},
+        {'id': 'heavy_attributes', 'type': 'lines', 'mode': 'w',
+         'label': 'Attributes read when first asked for'},
+        {'id': 'lazy_binary_attributes', 'type': 'boolean', 'mode': 'w',
+         'label': 'Read binary attributes when first asked for'},
+        {'id': 'lazy_conversion', 'type': 'boolean', 'mode': 'w',
+         'label': 'Convert properties on first access'},
+        {'id': 'compact_sheets', 'type': 'boolean', 'mode': 'w',
+         'label': 'Keep property sheets in compact form'},
+        {'id': 'stale_while_revalidate', 'type': 'boolean', 'mode': 'w',
+         'label': 'Serve expired users and properties while refreshing '
+                  'them'},
+        {'id': 'stale_soft_ttl', 'type': 'int', 'mode': 'w',
+         'label': 'Refresh cached users and properties after (seconds)'},
+        {'id': 'stale_hard_ttl', 'type': 'int', 'mode': 'w',
+         'label': 'Stop serving expired users and properties after '
+                  '(seconds)'},
+    )
+
+    manage_options = PloneLDAPMultiPlugin.manage_options + (
+        {'label': 'Metrics', 'action': 'manage_metrics'},
+    )
+
+    security.declareProtected(ManageUsers, 'manage_metrics')
+    manage_metrics = PageTemplateFile('www/metrics', globals())
+
     security.declarePrivate('getLDAPAttrs')
     def getLDAPAttrs(self):
         """Return LDAP Schema Attributes Mapping:
@@ -56,24 +223,69 @@ class EnhancedPloneLDAPMultiPlugin(PloneLDAPMultiPlugin):
           (ldapname, zopename, type): (Attribute, Syntax OID),
         }
         """
-        # add attribute if needed
-        if not hasattr(aq_base(self), '_ldapattrs'):
-            self._ldapattrs = PersistentMapping()
-        
-        # fill it in if it's empty
-        if not self._ldapattrs:
-            acl = self._getLDAPUserFolder()
-            meta = self._getLDAPMetaData(acl)
-            if meta:
-                for info in acl.getSchemaConfig().values():
-                    ldapname, zopename, type = (info['ldap_name'],
-                        info['public_name'], info['multivalued'] and 'lines' or
-                        'string')
-                    if not zopename or not meta.has_key(ldapname):
-                        continue
-                    self._ldapattrs[(ldapname, zopename, type)] = meta[ldapname]
-        
-        return self._ldapattrs
+        return getLDAPAttrs(self, getRecorder(self))
+
+    security.declareProtected(ManageUsers, 'manage_refreshSchema')
+    def manage_refreshSchema(self, REQUEST=None):
+        """Re-read LDAP schema attributes metadata on next access"""
+        refreshLDAPAttrs(self)
+
+        # drop metadata persisted by previous versions
+        if hasattr(aq_base(self), '_ldapattrs'):
+            del self._ldapattrs
+
+        if REQUEST is not None:
+            return REQUEST["RESPONSE"].redirect(
+                "%s/manage_workspace?manage_tabs_message=LDAP+schema+"
+                "metadata+refreshed" % self.absolute_url())
+
+    security.declareProtected(ManageUsers, 'getMetrics')
+    def getMetrics(self):
+        """Return recorded metrics:
+
+        {
+          'started': recording start time,
+          'elapsed': seconds since recording start,
+          'counters': {name: count},
+          'timers': {group: {name: {'count', 'total_ms', 'mean_ms',
+                     'min_ms', 'max_ms', 'histogram': [[bound, count]]}}},
+          'caches': {name: {'hits', 'misses', 'ratio'}},
+        }
+        """
+        return getMetrics(self)
+
+    security.declareProtected(ManageUsers, 'manage_metricsJSON')
+    def manage_metricsJSON(self, REQUEST=None):
+        """Return recorded metrics as JSON"""
+        if REQUEST is not None:
+            REQUEST.RESPONSE.setHeader('Content-Type', 'application/json')
+            REQUEST.RESPONSE.setHeader('Cache-Control', 'no-cache')
+        return json.dumps(self.getMetrics())
+
+    security.declareProtected(ManageUsers, 'manage_setRecording')
+    def manage_setRecording(self, enabled=False, REQUEST=None):
+        """Switch metrics recording on or off"""
+        self.record_metrics = bool(enabled)
+        if REQUEST is not None:
+            return REQUEST["RESPONSE"].redirect(
+                "%s/manage_metrics?manage_tabs_message=Recording+%s" % (
+                self.absolute_url(), enabled and 'started' or 'stopped'))
+
+    security.declareProtected(ManageUsers, 'manage_resetMetrics')
+    def manage_resetMetrics(self, REQUEST=None):
+        """Forget recorded metrics"""
+        resetMetrics(self)
+        if REQUEST is not None:
+            return REQUEST["RESPONSE"].redirect(
+                "%s/manage_metrics?manage_tabs_message=Metrics+reset" %
+                self.absolute_url())
+
+    security.declarePrivate('getConversionPlan')
+    def getConversionPlan(self, ldapschema):
+        """Return compiled conversion plan for a given property sheet
+        schema: [(ldapname, zopename, type), ...]
+        """
+        return getConversionPlan(self, ldapschema)
 
     def _getLDAPMetaData(self, acl):
         """Return ldap attributes metadata
@@ -82,46 +294,175 @@ class EnhancedPloneLDAPMultiPlugin(PloneLDAPMultiPlugin):
           ldapname: (attribute, syntax oid),
         }
         """
-        try:
-            connection = acl._delegate.connect()
-            subentrydn = connection.search_subschemasubentry_s()
-            entry = connection.read_subschemasubentry_s(subentrydn)
-            subschema = schema.SubSchema(entry)
-            must, may = subschema.attribute_types(acl._user_objclasses)
-        except Exception, e:
-            logException(u"Error while trying to gather LDAP Attributes Schema"
-                         " Metadata", acl)
-            return {}
-        
-        # gets attribute type syntax oid recursively if needed
-        def _get_syntax_oid(attr, default=None):
-            oid = attr.syntax
-            if not oid:
-                for sup in attr.sup:
-                    parent = subschema.get_inheritedobj(schema.AttributeType,
-                        sup)
-                    oid = _get_syntax_oid(parent, default)
-            return oid or default
-        
-        data = {}
-        for attribute in must.values() + may.values():
-            oid = _get_syntax_oid(attribute)            
-            for name in attribute.names:
-                data[name] = (attribute, oid)
-        return data
+        return getLDAPMetaData(acl, getSnapshotDirectory(self),
+            getRecorder(self), getConnectionPool(self))
+
+    security.declarePrivate('enumerateUsers')
+    def enumerateUsers(self, id=None, login=None, exact_match=0,
+                       sort_by=None, max_results=None, **kw):
+        """Fullfill UserEnumerationPlugin requirements.
+
+        With prefetch_enumerated_users on, properties of users found by
+        inexact searches, e.g. member searches, are read with a bulk search
+        right away, as they are usually asked for one by one next. Only the
+        first bulk_chunk_size users are read, so large listings don't cost
+        more than one extra search.
+
+        With stale_while_revalidate on, lookups of a single user by id or
+        login are cached and served stale while being refreshed.
+        """
+        def search():
+            return PloneLDAPMultiPlugin.enumerateUsers(self, id=id,
+                login=login, exact_match=exact_match, sort_by=sort_by,
+                max_results=max_results, **kw)
+        if exact_match and not kw and (id is None) != (login is None) and \
+           isinstance(id or login, basestring) and \
+           getStaleCache(self) is not None:
+            if id is not None:
+                return lookupUser(self, search, 'id', id)
+            return lookupUser(self, search, 'login', login)
+        result = search()
+        if not exact_match and len(result) > 1 and \
+           getattr(self, 'prefetch_enumerated_users', False):
+            limit = getattr(self, 'bulk_chunk_size', 100)
+            prefetchProperties(self, [info['id']
+                for info in result[:limit]])
+        return result
 
     security.declarePrivate('getPropertiesForUser')
     def getPropertiesForUser(self, user, request=None):
         """Fullfill PropertiesPlugin requirements"""
-        try:
-            return EnhancedLDAPPropertySheet(self.id, user)
-        except KeyError:
-            return None
+        return getPropertySheet(self, user, request)
+
+    security.declarePrivate('getPropertiesForUsers')
+    def getPropertiesForUsers(self, users, request=None):
+        """Return property sheets for many users at once.
+
+        Instead of one LDAP lookup per user, users are resolved with
+        OR-filtered searches holding at most bulk_chunk_size ids each.
+
+        Returns mapping of user id to property sheet, None for users
+        not found in LDAP.
+        """
+        users = dict([(user.getId(), user) for user in users])
+        cached = getCachedPropertySheets(self, users.keys(), request)
+        recorder = getRecorder(self)
+        absent = dict([(uid, None) for uid in users.keys()
+            if uid not in cached and isAbsentUser(self, uid, recorder)])
+        failed = []
+        found = self._searchLDAPProperties([uid for uid in users.keys()
+            if uid not in cached and uid not in absent], failed)
+
+        sheets = {}
+        for uid, user in users.items():
+            if uid in cached:
+                continue
+            ldap_properties = found.get(uid)
+            if ldap_properties is None:
+                # only completed searches tell user is not in LDAP
+                if uid not in absent and uid not in failed:
+                    addAbsentUser(self, uid)
+                sheets[uid] = None
+                continue
+            sheets[uid] = EnhancedLDAPPropertySheet(self.id, user,
+                ldap_properties=ldap_properties)
+        cachePropertySheets(self, sheets, request)
+        sheets.update(cached)
+        return sheets
+
+    security.declarePrivate('exportUsers')
+    def exportUsers(self, page_size=None):
+        """Yield all users with converted properties:
+
+        {'id': user id, 'dn': dn, zopename: value, ...}
+
+        Users are read page by page with LDAP paged results control,
+        export_page_size entries per page by default.
+        """
+        return exportUsers(self, page_size)
+
+    def _searchLDAPProperties(self, uids, failed=None):
+        """Return raw ldap properties of given users in the same form
+        LDAPUser._properties keeps them:
+
+        {
+          user id: {ldapname: value or list of values},
+        }
+
+        Ids which may be in LDAP, but couldn't be looked up, are added to
+        failed list.
+        """
+        acl = self._getLDAPUserFolder()
+        if not uids:
+            return {}
+
+        # can't OR-filter on dn, fallback to lookups one by one
+        if acl._uid_attr == 'dn':
+            result = {}
+            for uid in uids:
+                ldap_user = acl.getUserById(uid)
+                if ldap_user is not None:
+                    result[uid] = ldap_user._properties
+                elif failed is not None:
+                    # getUserById returns None on errors too
+                    failed.append(uid)
+            return result
+
+        pool = getConnectionPool(self)
+        search = pool is not None and pool.search or acl._delegate.search
+        return searchProperties(search, getPropertyQuery(acl,
+            getHeavyAttributes(self)), uids,
+            getattr(self, 'bulk_chunk_size', 100), getRecorder(self), failed)
 
     security.declarePrivate('setPropertiesForUser')
     def setPropertiesForUser(self, user, propertysheet):
-        """Use here propertysheet API thus avoiding code duplication"""
-        propertysheet.setProperties(user, propertysheet._properties)
+        """Use here propertysheet API thus avoiding code duplication.
+
+        Properties of LDAP sheets not read or converted yet are left out,
+        reading them just to find they didn't change is costly for heavy
+        ones.
+        """
+        items = getattr(propertysheet, 'loadedPropertyItems',
+            propertysheet.propertyItems)
+        propertysheet.setProperties(user, dict(items()))
+        forgetPropertySheet(self, user)
+
+    security.declarePrivate('addUsers')
+    def addUsers(self, entries, window=None, roles=()):
+        """Add many users at once.
+
+        entries - iterable of (login, password, {zopename: value})
+        window - LDAP adds in flight, bulk_add_window by default
+        roles - roles given to every added user
+
+        Returns list of {'login', 'id', 'dn', 'ok', 'error'} in entries
+        order.
+        """
+        return addUsers(self, entries, window, roles)
+
+    security.declarePrivate('importGroups')
+    def importGroups(self, groups, window=None, dry_run=False):
+        """Create groups and add members to them.
+
+        groups - iterable of (group id, [member user ids])
+        window - LDAP writes in flight, bulk_add_window by default
+        dry_run - only report what would change
+
+        Returns list of {'group', 'dn', 'action', 'members', 'unknown', 'ok',
+        'error'} in groups order.
+        """
+        return importGroups(self, groups, window, dry_run)
+
+    security.declarePrivate('doDeleteUser')
+    def doDeleteUser(self, userid):
+        """Remove user and publish its removal to other ZEO clients"""
+        result = PloneLDAPMultiPlugin.doDeleteUser(self, userid)
+        invalidateSharedProperties(self, userid)
+        forgetWarmProperties(self, userid)
+        forgetUserLookups(self, userid)
+        if result:
+            addAbsentUser(self, userid)
+        return result
 
 classImplements(EnhancedPloneLDAPMultiPlugin,
     *implementedBy(PloneLDAPMultiPlugin))
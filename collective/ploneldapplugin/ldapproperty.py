@@ -1,11 +1,31 @@
+import time
 import types
 
 from zope.interface import implements
 from zope.component import queryAdapter
 
+from Acquisition import aq_base
+
+from Products.LDAPUserFolder.utils import to_utf8
 from Products.PloneLDAP.property import LDAPPropertySheet
 
 from collective.ploneldapplugin.interfaces import ILDAPAttributeConverter
+from collective.ploneldapplugin.connection import getConnectionSettings, \
+    getConnectionPool, ConnectionPool
+from collective.ploneldapplugin.propertysearch import getPropertyQuery, \
+    getHeavyAttributes, getAttribute, searchProperties
+from collective.ploneldapplugin.instrumentation import getRecorder, timed
+from collective.ploneldapplugin.requestcache import getRequestCache, \
+    forgetMemberSheets
+from collective.ploneldapplugin.sharedcache import getSharedCache, \
+    invalidateSharedProperties, DEFAULT_TTL as SHARED_CACHE_TTL
+from collective.ploneldapplugin.negativecache import isAbsentUser, \
+    addAbsentUser, getNegativeCache
+from collective.ploneldapplugin.warmcache import getWarmCache, \
+    revalidateWarmProperties, forgetWarmProperties
+from collective.ploneldapplugin.writebehind import getWriteBehindQueue, \
+    getPendingProperties, getWriteTime
+from collective.ploneldapplugin import logger, getCacheKey
 
 class DefaultLDAPAttributeConverter(object):
     """This default converter replicates PloneLDAP user property plugin
@@ -36,76 +56,822 @@ class DefaultLDAPAttributeConverter(object):
         """
         return value.strip()
 
+def getConverter(attr, name):
+    """Return converter for a given python ldap attribute and its syntax
+    oid
+    """
+    converter = None
+    if attr is not None:
+        # check for named adapter
+        if name:
+            converter = queryAdapter(attr, ILDAPAttributeConverter,
+                name=name)
+        # if not found, fallback to default converter
+        if converter is None:
+            converter = queryAdapter(attr, ILDAPAttributeConverter,
+                name=u"")
+
+    # if still no luck, get our own converter
+    if converter is None:
+        converter = DefaultLDAPAttributeConverter(attr)
+
+    return converter
+
+def fromLDAPValues(converter, values, info):
+    """Convert list of ldap values with converter batch method, value by value
+    if converter has no one
+    """
+    convert = getattr(converter, 'fromLDAPValues', None)
+    if convert is not None:
+        return convert(values, info)
+    convert = converter.fromLDAPValue
+    return [convert(value, info) for value in values]
+
+def toLDAPValues(converter, values, info):
+    """Convert list of python values with converter batch method, value by
+    value if converter has no one
+    """
+    convert = getattr(converter, 'toLDAPValues', None)
+    if convert is not None:
+        return convert(values, info)
+    convert = converter.toLDAPValue
+    return [convert(value, info) for value in values]
+
+# incremented each time converter registrations change, so compiled
+# conversion plans know they are outdated
+_registrations = [0]
+
+def convertersChanged(registration, event):
+    """Subscriber for adapter registration events"""
+    if registration.provided.isOrExtends(ILDAPAttributeConverter):
+        _registrations[0] += 1
+
+class ConversionPlan(object):
+    """Precompiled conversion rules of plugin schema attributes.
+
+    entries - ordered tuple of (ldapname, zopename, type, converter)
+    index - entries by zopename
+    attrs - schema attributes mapping plan was compiled from
+    labels - converter class and syntax oid by zopename, for instrumentation
+    """
+
+    def __init__(self, entries, attrs=None, key=None, labels=None):
+        self.entries = tuple(entries)
+        self.index = dict([(entry[1], entry) for entry in self.entries])
+        self.attrs = attrs
+        self.key = key
+        self.labels = labels or {}
+        self.layout = SheetLayout(self.entries)
+
+# longest string values compact sheets intern and number of distinct values
+# of a property after which it doesn't count as having common values
+INTERN_LENGTH = 64
+INTERN_SIZE = 1000
+
+class SheetLayout(object):
+    """Property positions and schema shared by compact sheets of one
+    conversion plan, together with interned common values like departments
+    """
+
+    def __init__(self, entries):
+        self.names = tuple([entry[1] for entry in entries])
+        self.positions = dict([(name, position) for position, name in
+            enumerate(self.names)])
+        self.ldapschema = [tuple(entry[:3]) for entry in entries]
+        self.schema = tuple([(entry[1], entry[2]) for entry in entries])
+        # per property {(type, value): value}, None for properties with
+        # mostly distinct values like names, interning them costs more
+        # than it saves
+        self._interned = [{} for name in self.names]
+
+    def intern(self, position, value):
+        """Return shared copy of a short string, or of a list of them, of
+        property at a given position
+        """
+        interned = self._interned[position]
+        if interned is None:
+            return value
+        if isinstance(value, types.StringTypes):
+            if len(value) > INTERN_LENGTH:
+                return value
+            key = (type(value), value)
+            shared = interned.get(key)
+            if shared is None:
+                if len(interned) >= INTERN_SIZE:
+                    self._interned[position] = None
+                    return value
+                shared = interned[key] = value
+            return shared
+        if isinstance(value, types.ListType):
+            return [self.intern(position, item) for item in value]
+        return value
+
+_absent = object()
+
+class CompactProperties(object):
+    """Property values of one user kept by their position in a shared
+    layout instead of in a dictionary of their own, with the dictionary
+    methods property sheets use
+    """
+
+    __slots__ = ('_layout', '_values', '_extra')
+
+    def __init__(self, layout, properties=None):
+        self._layout = layout
+        self._values = [_absent] * len(layout.names)
+        # values of properties missing in layout
+        self._extra = None
+        for key, value in (properties or {}).items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        position = self._layout.positions.get(key)
+        if position is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        value = self._values[position]
+        if value is _absent:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        position = self._layout.positions.get(key)
+        if position is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        else:
+            self._values[position] = self._layout.intern(position, value)
+
+    def __delitem__(self, key):
+        position = self._layout.positions.get(key)
+        if position is None or self._values[position] is _absent:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+        else:
+            self._values[position] = _absent
+
+    def get(self, key, default=None):
+        position = self._layout.positions.get(key)
+        if position is None:
+            if self._extra is None:
+                return default
+            return self._extra.get(key, default)
+        value = self._values[position]
+        if value is _absent:
+            return default
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _absent) is not _absent
+
+    has_key = __contains__
+
+    def keys(self):
+        keys = [name for name, value in zip(self._layout.names,
+            self._values) if value is not _absent]
+        if self._extra:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def items(self):
+        items = [(name, value) for name, value in zip(self._layout.names,
+            self._values) if value is not _absent]
+        if self._extra:
+            items.extend(self._extra.items())
+        return items
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        return dict(self.items())
+
+    # ram cache managers pickle cached values to tell their size
+    def __getstate__(self):
+        return (self._layout, dict(self.items()))
+
+    def __setstate__(self, state):
+        layout, properties = state
+        self.__init__(layout, properties)
+
+def compileConversionPlan(ldapschema, attrs, key=None):
+    """Build conversion plan for given sheet schema
+
+    ldapschema - sequence of (ldapname, zopename, type)
+    attrs - plugin LDAP schema attributes mapping, see getLDAPAttrs
+    """
+    # converters cache
+    converters = {}
+    entries = []
+    labels = {}
+    for info in ldapschema:
+        ldapname, zopename, type = info
+        attr, name = attrs.get(info, (None, None))
+        converter = converters.get(name)
+        if converter is None:
+            converters[name] = converter = getConverter(attr, name)
+        entries.append((ldapname, zopename, type, converter))
+        labels[zopename] = '%s %s' % (converter.__class__.__name__,
+            name or '-')
+    return ConversionPlan(entries, attrs, key, labels)
+
+def getConversionPlan(plugin, ldapschema):
+    """Return plugin conversion plan for given sheet schema.
+
+    Plan is compiled once and kept as volatile plugin attribute until LDAP
+    schema configuration, its metadata or converter registrations change.
+    """
+    attrs = plugin.getLDAPAttrs()
+    key = (tuple(ldapschema), _registrations[0])
+    plan = getattr(aq_base(plugin), '_v_conversion_plan', None)
+    recorder = getRecorder(plugin)
+    if plan is None or plan.key != key or plan.attrs is not attrs:
+        if recorder is not None:
+            recorder.miss('conversion plan')
+        old, plan = plan, compileConversionPlan(ldapschema, attrs, key)
+        # compact sheets built before and after keep sharing their layout
+        if old is not None and old.layout.ldapschema == plan.layout.ldapschema:
+            plan.layout = old.layout
+        plugin._v_conversion_plan = plan
+    elif recorder is not None:
+        recorder.hit('conversion plan')
+    return plan
+
+def getSheetSchema(acl):
+    """Property sheet schema of a given LDAP user folder, the same
+    LDAPPropertySheet builds: [(ldapname, zopename, type), ...]
+    """
+    return [(x['ldap_name'], x['public_name'],
+             x['multivalued'] and 'lines' or 'string')
+            for x in acl.getSchemaConfig().values() if x['public_name']]
+
+def _getSheetCache(plugin, request=None):
+    """Request cache of plugin property sheets, None if it's turned off"""
+    if not getattr(plugin, 'cache_sheets_per_request', False):
+        return None
+    return getRequestCache(plugin, request)
+
+def getPropertySheet(plugin, user, request=None):
+    """Return LDAP property sheet of a given user or None if user is not in
+    LDAP.
+
+    With plugin cache_sheets_per_request property on, the same sheet is
+    returned for the rest of the request.
+    """
+    cache = _getSheetCache(plugin, request)
+    if cache is None:
+        return _makePropertySheet(plugin, user, request)
+
+    recorder = getRecorder(plugin)
+    key = ('sheet', plugin.getId(), user.getId())
+    if key in cache:
+        if recorder is not None:
+            recorder.hit('request sheet')
+        return cache[key]
+    if recorder is not None:
+        recorder.miss('request sheet')
+    sheet = cache[key] = _makePropertySheet(plugin, user, request)
+    return sheet
+
+def _makePropertySheet(plugin, user, request=None):
+    """Build sheet out of properties prefetched in the request if there
+    are some, None if user is not in LDAP
+    """
+    ldap_properties = None
+    if getattr(plugin, 'prefetch_enumerated_users', False):
+        cache = getRequestCache(plugin, request)
+        if cache is not None:
+            ldap_properties = cache.get(('prefetched', plugin.getId(),
+                user.getId()))
+    if ldap_properties is None and isAbsentUser(plugin, user.getId(),
+                                                getRecorder(plugin)):
+        return None
+    try:
+        return EnhancedLDAPPropertySheet(plugin.getId(), user,
+            ldap_properties=ldap_properties)
+    except UserNotFound:
+        addAbsentUser(plugin, user.getId())
+        return None
+    except KeyError:
+        # lookup failed, user may still be in LDAP
+        return None
+
+def prefetchProperties(plugin, uids, request=None):
+    """Read raw ldap properties of given users with bulk searches and keep
+    them in the request, so the following getPropertiesForUser calls don't
+    go to LDAP one by one
+    """
+    cache = getRequestCache(plugin, request)
+    if cache is None:
+        return
+    pid = plugin.getId()
+    uids = [uid for uid in uids if ('prefetched', pid, uid) not in cache
+        and ('sheet', pid, uid) not in cache and not isAbsentUser(plugin,
+        uid)]
+    if not uids:
+        return
+    found = plugin._searchLDAPProperties(uids)
+    for uid, ldap_properties in found.items():
+        cache[('prefetched', pid, uid)] = ldap_properties
+    recorder = getRecorder(plugin)
+    if recorder is not None:
+        recorder.count('prefetched users', len(found))
+
+def cachePropertySheets(plugin, sheets, request=None):
+    """Keep {user id: sheet} for the rest of the request if plugin
+    cache_sheets_per_request property is on
+    """
+    cache = _getSheetCache(plugin, request)
+    if cache is not None:
+        for uid, sheet in sheets.items():
+            cache[('sheet', plugin.getId(), uid)] = sheet
+
+def getCachedPropertySheets(plugin, uids, request=None):
+    """Return {user id: sheet} of given users cached in the request"""
+    cache = _getSheetCache(plugin, request)
+    if not cache:
+        return {}
+    result = {}
+    for uid in uids:
+        key = ('sheet', plugin.getId(), uid)
+        if key in cache:
+            result[uid] = cache[key]
+    return result
+
+def forgetPropertySheet(plugin, user, request=None):
+    """Drop request cached sheet, prefetched properties and member sheets
+    of a given user
+    """
+    cache = getRequestCache(plugin, request)
+    if cache is not None:
+        cache.pop(('sheet', plugin.getId(), user.getId()), None)
+        cache.pop(('prefetched', plugin.getId(), user.getId()), None)
+    forgetMemberSheets(plugin, user.getId(), request)
+
+_missing = object()
+
+# shared by compact sheets instead of their own empty dictionaries, never
+# written to
+_nothing = {}
+
+def _makeLoader(plugin, uid, recorder=None):
+    """Return function reading raw value of a single attribute of a given
+    user, through shared cache if plugin has one.
+
+    It keeps no persistent objects, so sheets can use it after the request
+    they were made in.
+    """
+    acl = plugin._getLDAPUserFolder()
+    query = getPropertyQuery(acl)
+    pool = getConnectionPool(plugin)
+    if pool is None:
+        # connections of size 0 pool are closed after each search
+        pool = ConnectionPool(getConnectionSettings(acl), 0)
+    shared = getSharedCache(plugin)
+    ttl = getattr(plugin, 'shared_cache_ttl', SHARED_CACHE_TTL)
+
+    def load(ldapname):
+        version = None
+        if shared is not None:
+            version = shared.getVersion(uid)
+            value = shared.get(uid, version, ldapname)
+            if value is not None:
+                return value
+        attrs = [ldapname]
+        if query['uid_attr'] != 'dn':
+            attrs.append(query['uid_attr'])
+        found = searchProperties(pool.search, dict(query, attrs=attrs),
+            [uid], 1, recorder)
+        value = getAttribute(found.get(uid, {}), ldapname)
+        if shared is not None and value is not None:
+            shared.set(uid, version, value, ttl, ldapname)
+        if recorder is not None:
+            recorder.count('lazy attribute reads')
+        return value
+    return load
+
+def _makeInvalidator(plugin):
+    """Return function dropping shared and warm cache properties of given
+    user ids, for write-behind queue to call once their changes are written.
+
+    It keeps no persistent objects, so queue worker thread can use it.
+    """
+    shared = getSharedCache(plugin)
+    warm = getWarmCache(plugin)
+
+    def invalidate(uids):
+        for uid in uids:
+            if shared is not None:
+                shared.invalidate(uid)
+            if warm is not None:
+                warm.forget(uid)
+    return invalidate
+
+class UserNotFound(KeyError):
+    """Raised when a completed LDAP search found no entry of the user"""
+
+
 class EnhancedLDAPPropertySheet(LDAPPropertySheet):
-    
+
+    # compact sheets leave these out of their instance dictionary
+    _ldap_properties = None
+    _loader = None
+    _recorder = None
+    _labels = None
+    _layout = None
+    # raw ldap properties the sheet was built from, kept until they're put
+    # into plugin cache
+    _fetched = None
+
+    def __init__(self, id, user, ldap_properties=None):
+        """ldap_properties - raw ldap attribute values of the user if they
+        were already fetched, e.g. by the plugin bulk search
+        """
+        self._ldap_properties = ldap_properties
+        # (name, charset): property value encoded to charset
+        self._encoded = {}
+        # zopename: conversion plan entry of heavy properties not read yet
+        # and function reading them
+        self._lazy = {}
+        self._loader = None
+        # zopename: (conversion plan entry, raw value) of properties not
+        # converted yet in lazy conversion mode
+        self._pending = {}
+        self._recorder = None
+        self._labels = None
+        # layout of compact sheets
+        self._layout = None
+        LDAPPropertySheet.__init__(self, id, user)
+        self._ldap_properties = None
+        self.__dict__.pop('_fetched', None)
+        if self._layout is not None:
+            self._compact()
+
+    def _compact(self):
+        """Keep values in layout shared by sheets of the same plugin, drop
+        per sheet schema copies and empty bookkeeping
+        """
+        layout = self._layout
+        if list(self._ldapschema) == layout.ldapschema:
+            self._ldapschema = layout.ldapschema
+        if tuple(getattr(self, '_schema', ())) == layout.schema:
+            self._schema = layout.schema
+        self._properties = CompactProperties(layout, self._properties)
+        # nothing is ever added to these after the sheet is built
+        if not self._lazy:
+            self._lazy = _nothing
+        if not self._pending:
+            self._pending = _nothing
+        if not self._encoded:
+            self._encoded = None
+        for name in ('_ldap_properties', '_loader', '_recorder', '_labels'):
+            if self.__dict__.get(name, 0) is None:
+                del self.__dict__[name]
+
     def fetchLdapProperties(self, user):
-        acl = self._getLDAPUserFolder(user)
-        ldap_user = acl.getUserById(user.getId())
-        properties = {}
+        plugin = self.getLDAPMultiPlugin(user)
+        recorder = getRecorder(plugin)
+        ldap_properties = self._ldap_properties
+        if ldap_properties is None:
+            warm = getWarmCache(plugin)
+            if warm is not None:
+                ldap_properties, stale = warm.get(user.getId())
+                if stale:
+                    revalidateWarmProperties(plugin, warm, user.getId())
+            if ldap_properties is None:
+                ldap_properties = self._fetchProperties(plugin, user,
+                    recorder)
+                if warm is not None:
+                    warm.remember(user.getId(), ldap_properties)
+        elif recorder is not None:
+            recorder.hit('property sheet')
+        self._fetched = ldap_properties
+        return self._convertProperties(plugin, user, ldap_properties,
+            recorder)
 
-        # Do not pretend to have any properties if the user is not in LDAP
-        if ldap_user is None:
-            raise KeyError, "User not in LDAP"
-
-        # converters cache
-        converters = {}
-        attrs = self.getLDAPMultiPlugin(user).getLDAPAttrs()
-        for info in self._ldapschema:
-            # trying to convert ldap attribute values to python
-            # data types properly
-            ldapname, zopename, type = info
-            attr, name = attrs.get(info, (None, None))
-            converter = converters.get(name)
-            if converter is None:
-                converters[name] = converter = self._getConverter(attr, name)
-            
+    def _convertProperties(self, plugin, user, ldap_properties,
+                           recorder=None):
+        """Return sheet properties converted from raw ldap properties,
+        setting up per sheet bookkeeping of properties read or converted on
+        first access
+        """
+        properties = {}
+        plan = plugin.getConversionPlan(self._ldapschema)
+        heavy = getHeavyAttributes(plugin)
+        lazy = getattr(plugin, 'lazy_conversion', False)
+        if getattr(plugin, 'compact_sheets', False):
+            self._layout = plan.layout
+        for entry in plan.entries:
+            ldapname, zopename, type, converter = entry
             # convert ldap attribute value or set a default value
             # if there is no value provided for this user yet
-            if ldap_user._properties.get(ldapname, None) is not None:
-                properties[zopename] = self._fromLDAPValue(converter,
-                    ldap_user._properties[ldapname], info)
+            value = ldap_properties.get(ldapname, None)
+            if value is None and ldapname.lower() in heavy:
+                # left out by property search, read on first access
+                value = getAttribute(ldap_properties, ldapname)
+                if value is None:
+                    self._lazy[zopename] = entry
+            if value is not None and lazy:
+                # converted on first access, None holds its place meanwhile
+                self._pending[zopename] = (entry, value)
+                properties[zopename] = None
+            elif value is not None:
+                info = (ldapname, zopename, type)
+                if recorder is None:
+                    properties[zopename] = self._fromLDAPValue(converter,
+                        value, info)
+                else:
+                    start = time.time()
+                    properties[zopename] = self._fromLDAPValue(converter,
+                        value, info)
+                    recorder.record('conversion', plan.labels[zopename],
+                        time.time() - start)
             else:
                 if type == 'lines':
                     properties[zopename] = []
                 else:
                     properties[zopename] = None #converter.default
 
+        if self._lazy:
+            self._loader = _makeLoader(plugin, user.getId(), recorder)
+        if self._lazy or self._pending:
+            self._recorder = recorder
+            self._labels = plan.labels
+
+        # show values still waiting in write-behind queue
+        if getattr(plugin, 'volatile_properties', ()):
+            pending = getPendingProperties(getCacheKey(plugin), user.getId())
+            if pending:
+                properties.update(pending)
+                for key in pending.keys():
+                    self._pending.pop(key, None)
+
         return properties
 
+    def _getCacheViewName(self, plugin):
+        return plugin.getId() + '_fetchLdapProperties'
+
+    def _getCache(self, user):
+        """Return properties converted from raw ldap properties kept in
+        plugin cache, None if they aren't there.
+
+        Plugin cache holds raw values instead of converted properties, as
+        sheets keep their own record of properties not read or converted
+        yet. Entries cached before write-behind queue wrote changes of the
+        user are outdated.
+        """
+        if self._ldap_properties is not None:
+            # fetched for this sheet, they go to the cache instead
+            return None
+        plugin = self.getLDAPMultiPlugin(user)
+        mtime_func = None
+        if getattr(plugin, 'volatile_properties', ()):
+            key, uid = getCacheKey(plugin), user.getId()
+            mtime_func = lambda: getWriteTime(key, uid)
+        ldap_properties = plugin.ZCacheable_get(
+            view_name=self._getCacheViewName(plugin),
+            keywords={'user': user.getId()}, mtime_func=mtime_func,
+            default=None)
+        if ldap_properties is None:
+            return None
+        recorder = getRecorder(plugin)
+        if recorder is not None:
+            recorder.hit('property sheet')
+        return self._convertProperties(plugin, user, ldap_properties,
+            recorder)
+
+    def _setCache(self, user, properties):
+        """Keep raw ldap properties the sheet was built from in plugin
+        cache
+        """
+        ldap_properties = self.__dict__.pop('_fetched', None)
+        if ldap_properties is None:
+            return
+        plugin = self.getLDAPMultiPlugin(user)
+        # values may have been read before queued changes of the user were
+        # written
+        if getattr(plugin, 'volatile_properties', ()) and \
+           getPendingProperties(getCacheKey(plugin), user.getId()):
+            return
+        plugin.ZCacheable_set(ldap_properties,
+            view_name=self._getCacheViewName(plugin),
+            keywords={'user': user.getId()})
+
+    def _invalidateCache(self, user):
+        plugin = self.getLDAPMultiPlugin(user)
+        plugin.ZCacheable_invalidate(
+            view_name=self._getCacheViewName(plugin))
+
+    def _fetchProperties(self, plugin, user, recorder=None):
+        """Return raw ldap properties from shared cache or LDAP user
+        folder
+        """
+        shared = getSharedCache(plugin)
+        if shared is not None:
+            return self._fetchSharedProperties(plugin, shared, user,
+                recorder)
+        if recorder is not None:
+            recorder.miss('property sheet')
+        if getattr(plugin, 'projected_reads', False):
+            return self._searchProperties(plugin, user.getId())
+
+        acl = self._getLDAPUserFolder(user)
+        ldap_user = timed(recorder, 'ldap', 'getUserById',
+            acl.getUserById, user.getId())
+        if ldap_user is not None and ldap_user._properties:
+            return ldap_user._properties
+        # getUserById returns None on LDAP errors too, the miss is checked
+        # with a search before negative cache remembers it
+        if getNegativeCache(plugin) is not None:
+            return self._searchProperties(plugin, user.getId())
+        # Do not pretend to have any properties if the user is not in
+        # LDAP
+        raise KeyError, "User not in LDAP"
+
+    def _searchProperties(self, plugin, uid):
+        """Return raw ldap properties of a user read with property search.
+
+        Raises UserNotFound if search found no entry and KeyError if it
+        failed.
+        """
+        failed = []
+        found = plugin._searchLDAPProperties([uid], failed)
+        if uid in found:
+            return found[uid]
+        if failed:
+            raise KeyError, "User lookup in LDAP failed"
+        raise UserNotFound, "User not in LDAP"
+
+    def _fetchSharedProperties(self, plugin, shared, user, recorder=None):
+        """Return raw ldap properties from shared cache, read them directly
+        from LDAP, bypassing LDAP user folder cache, if they are not there
+        """
+        uid = user.getId()
+        version = timed(recorder, 'shared cache', 'version',
+            shared.getVersion, uid)
+        ldap_properties = timed(recorder, 'shared cache', 'get', shared.get,
+            uid, version)
+        if ldap_properties is not None:
+            if recorder is not None:
+                recorder.hit('shared cache')
+            return ldap_properties
+        if recorder is not None:
+            recorder.miss('shared cache')
+
+        # Do not pretend to have any properties if the user is not in LDAP
+        ldap_properties = self._searchProperties(plugin, uid)
+        shared.set(uid, version, ldap_properties,
+            getattr(plugin, 'shared_cache_ttl', SHARED_CACHE_TTL))
+        return ldap_properties
+
     # def hasProperty(self, name):
     #     value = self._properties.get(name, None)
     #     if value is None:
     #         return False
     #     return LDAPPropertySheet.hasProperty(self, name)
 
+    def _loadLazy(self, name):
+        """Convert property on first access, reading it first if it's a
+        heavy one
+        """
+        pending = self._pending.pop(name, None)
+        if pending is not None:
+            entry, value = pending
+        else:
+            entry = self._lazy.pop(name, None)
+            if entry is None or self._loader is None:
+                return
+            value = self._loader(entry[0])
+            if value is None:
+                return
+        ldapname, zopename, type, converter = entry
+        recorder = self._recorder
+        if recorder is None:
+            self._properties[name] = self._fromLDAPValue(converter, value,
+                (ldapname, zopename, type))
+        else:
+            start = time.time()
+            self._properties[name] = self._fromLDAPValue(converter, value,
+                (ldapname, zopename, type))
+            recorder.record('conversion', self._labels[name],
+                time.time() - start)
+
+    def _loadAllLazy(self):
+        for name in self._pending.keys() + self._lazy.keys():
+            self._loadLazy(name)
+
+    def propertyValues(self):
+        self._loadAllLazy()
+        return LDAPPropertySheet.propertyValues(self)
+
+    def propertyItems(self):
+        self._loadAllLazy()
+        return LDAPPropertySheet.propertyItems(self)
+
+    def loadedPropertyItems(self):
+        """Return (name, value) pairs of properties read and converted
+        already, the rest are the same as in LDAP
+        """
+        return [(name, value) for name, value in self._properties.items()
+            if name not in self._pending and name not in self._lazy]
+
     def getProperty(self, name, default=None):
+        if name in self._pending or name in self._lazy:
+            self._loadLazy(name)
         value = self._properties.get(name, None)
         if value is None:
             value = default
         return value
 
+    def getEncodedProperty(self, name, default, charset):
+        """Same as getProperty but unicode values are encoded to charset,
+        encoded values are cached until properties change
+        """
+        key = (name, charset)
+        if self._encoded is None:
+            self._encoded = {}
+        value = self._encoded.get(key, _missing)
+        if value is _missing:
+            if name in self._pending or name in self._lazy:
+                self._loadLazy(name)
+            value = self._properties.get(name, None)
+            if isinstance(value, unicode):
+                value = value.encode(charset)
+            self._encoded[key] = value
+        if value is None:
+            value = default
+            if isinstance(value, unicode):
+                value = value.encode(charset)
+        return value
+
     def setProperties(self, user, mapping):
+        self._encoded = {}
+        for key in mapping.keys():
+            self._lazy.pop(key, None)
+        # old values are compared with new ones
+        for key in mapping.keys():
+            if key in self._pending:
+                self._loadLazy(key)
         acl = self._getLDAPUserFolder(user)
-        ldap_user = acl.getUserById(user.getId())
+        plugin = self.getLDAPMultiPlugin(user)
+        plan = plugin.getConversionPlan(self._ldapschema)
+        recorder = getRecorder(plugin)
+        volatile = getattr(plugin, 'volatile_properties', ())
+        if volatile:
+            mapping = self._queueVolatileProperties(user, acl, plugin, plan,
+                mapping, volatile)
+        if getattr(plugin, 'dirty_tracking', True):
+            return self._setChangedProperties(user, acl, plan, mapping,
+                recorder)
 
-        # converters cache
-        converters = {}
+        ldap_user = acl.getUserById(user.getId())
         changes = {}
-        schema = dict([(x[1], (x[0], x[2])) for x in self._ldapschema])
-        attrs = self.getLDAPMultiPlugin(user).getLDAPAttrs()
-        
         for (key, value) in mapping.items():
             # if key in schema and self._properties[key]!=value:
-            if key in schema:
-                # get ldap attribute converter
-                ldapname, zopename, type = info = (schema[key][0], key,
-                    schema[key][1])
-                attr, name = attrs.get(info, (None, None))
-                converter = converters.get(name)
-                if converter is None:
-                    converters[name] = converter = self._getConverter(attr,
-                        name)
-                
+            if key in plan.index:
+                ldapname, zopename, type, converter = plan.index[key]
+                info = (ldapname, zopename, type)
+
                 # set value if it's different from the previous one
                 if self._properties[key] != value:
                     self._properties[key] = value
@@ -121,44 +887,143 @@ class EnhancedLDAPPropertySheet(LDAPPropertySheet):
                     else:
                         changes[ldapname] = [value]
         
-        acl._delegate.modify(ldap_user.dn, attrs=changes)
+        timed(recorder, 'ldap', 'modify', acl._delegate.modify, ldap_user.dn,
+            attrs=changes)
+        self._expireCaches(user, acl, recorder)
+
+    def _setChangedProperties(self, user, acl, plan, mapping, recorder=None):
+        """Dirty tracking version of setProperties.
+
+        Old and new values are compared in their ldap form, so only
+        attributes which really change are sent to LDAP. Nothing is written
+        and caches are kept if there are no changes. Changes are written
+        with LDAPDelegate.modify, which renames entries on naming attribute
+        changes and returns errors instead of raising them. Sheet values
+        change and caches expire only if it wrote them.
+        """
+        changes = {}
+        changed = {}
+        for (key, value) in mapping.items():
+            entry = plan.index.get(key)
+            if entry is None:
+                continue
+            ldapname, zopename, type, converter = entry
+            info = (ldapname, zopename, type)
+
+            new = self._toLDAPValues(converter, value, info)
+            if new == self._toLDAPValues(converter, self._properties[key],
+                                         info):
+                continue
+
+            changed[key] = value
+            changes[ldapname] = new
+
+        if not changes:
+            return
+
+        ldap_user = acl.getUserById(user.getId())
+        error = timed(recorder, 'ldap', 'modify', acl._delegate.modify,
+            ldap_user.dn, attrs=changes)
+        if error:
+            logger.error('Modifying %s failed: %s' % (ldap_user.dn, error))
+            return
+        self._properties.update(changed)
+        self._expireCaches(user, acl, recorder)
+
+    def _expireCaches(self, user, acl, recorder=None):
+        """Drop cached LDAP user and property sheets after a write"""
         acl._expireUser(user.getUserName())
         self._invalidateCache(user)
+        plugin = self.getLDAPMultiPlugin(user)
+        invalidateSharedProperties(plugin, user.getId())
+        forgetWarmProperties(plugin, user.getId())
+        forgetMemberSheets(plugin, user.getId())
+        if recorder is not None:
+            recorder.count('_expireUser')
+            recorder.count('_invalidateCache')
+
+    def _queueVolatileProperties(self, user, acl, plugin, plan, mapping,
+                                 volatile):
+        """Put changed volatile properties into plugin write-behind queue.
+
+        Returns mapping of properties which have to be written right away.
+        """
+        settings = getConnectionSettings(acl)
+        # queued changes are written with plugin credentials in background,
+        # LDAPDelegate writing as the logged in user can't do that
+        if settings['read_only'] or not settings['write']:
+            return mapping
+        rest = {}
+        queued = {}
+        changes = {}
+        rdn_attr = (getattr(acl, '_rdnattr', '') or '').lower()
+        for (key, value) in mapping.items():
+            entry = plan.index.get(key)
+            # naming attribute changes need modrdn, they're written right
+            # away
+            if entry is None or key not in volatile or \
+               entry[0].lower() == rdn_attr:
+                rest[key] = value
+                continue
+            ldapname, zopename, type, converter = entry
+            info = (ldapname, zopename, type)
+
+            new = self._toLDAPValues(converter, value, info)
+            if new == self._toLDAPValues(converter, self._properties[key],
+                                         info):
+                continue
+            changes[ldapname] = new
+            queued[key] = value
+
+        if not changes:
+            return rest
+
+        ldap_user = acl.getUserById(user.getId())
+        recorder = getRecorder(plugin)
+        queue = getWriteBehindQueue(getCacheKey(plugin),
+            getattr(plugin, 'write_behind_interval', 30),
+            getattr(plugin, 'write_behind_max', 10000), recorder,
+            getConnectionPool(plugin), _makeInvalidator(plugin))
+        if queue.enqueue(user.getId(), to_utf8(ldap_user.dn), changes, queued,
+                         settings):
+            self._properties.update(queued)
+            if recorder is not None:
+                recorder.count('write-behind queued')
+        else:
+            # queue is full
+            rest.update(queued)
+            if recorder is not None:
+                recorder.count('write-behind refused')
+        return rest
+
+    def _toLDAPValues(self, converter, value, info):
+        """Return list of utf-8 encoded ldap values for a given python
+        value, empty list means no value
+        """
+        # None is not converted, converters do conversation but not value
+        # validation
+        if value is None:
+            return []
+        value = self._toLDAPValue(converter, value, info)
+        if isinstance(value, (types.ListType, types.TupleType)):
+            return [to_utf8(elem) for elem in value if elem != '']
+        if value == '':
+            return []
+        return [to_utf8(value)]
 
     def _getConverter(self, attr, name):
-        converter = None
-        if attr is not None:
-            # check for named adapter
-            if name:
-                converter = queryAdapter(attr, ILDAPAttributeConverter,
-                    name=name)
-            # if not found, fallback to default converter
-            if converter is None:
-                converter = queryAdapter(attr, ILDAPAttributeConverter,
-                    name=u"")
-        
-        # if still no luck, get our own converter
-        if converter is None:
-            converter = DefaultLDAPAttributeConverter(attr)
-        
-        return converter
-    
+        return getConverter(attr, name)
+
     def _fromLDAPValue(self, converter, value, info):
         # handle separately multivalued attributes
         if isinstance(value, (types.ListType, types.TupleType)):
-            result = []
-            for elem in value:
-                result.append(converter.fromLDAPValue(elem, info))
-            return result
+            return fromLDAPValues(converter, value, info)
         else:
             return converter.fromLDAPValue(value, info)
 
     def _toLDAPValue(self, converter, value, info):
         # handle separately multivalued attributes
         if isinstance(value, (types.ListType, types.TupleType)):
-            result = []
-            for elem in value:
-                result.append(converter.toLDAPValue(elem, info))
-            return result
+            return toLDAPValues(converter, value, info)
         else:
             return converter.toLDAPValue(value, info)
@@ -0,0 +1,125 @@
+"""Process cache of user ids known not to be in LDAP.
+
+Property lookups of local, non-LDAP users (service accounts, Plone only
+editors) would otherwise go to LDAP on every request. Ids are remembered for
+a limited time, so users added to LDAP by other means show up after it.
+"""
+import time
+import threading
+from collections import deque
+
+from collective.ploneldapplugin import getCacheKey
+
+
+class NegativeCache(object):
+    """Bounded set of absent user ids with timeout.
+
+    As all ids live for the same ttl, they expire in the order they were
+    added, which is also the order they are evicted in when cache is full.
+    """
+
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        # user id: expires
+        self._expires = {}
+        # (expires, user id) in order of addition
+        self._order = deque()
+        self._lock = threading.Lock()
+
+    def __contains__(self, uid):
+        expires = self._expires.get(uid)
+        return expires is not None and expires > time.time()
+
+    def add(self, uid):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            expires = self._expires[uid] = now + self.ttl
+            self._order.append((expires, uid))
+            self._prune(now)
+        finally:
+            self._lock.release()
+
+    def discard(self, uid):
+        """Forget a user id, e.g. because user was just added"""
+        self._lock.acquire()
+        try:
+            # its entry in order is skipped when pruned
+            self._expires.pop(uid, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._expires.clear()
+            self._order.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def _prune(self, now):
+        """Drop expired ids and the oldest ones over size, lock must be
+        held
+        """
+        order = self._order
+        expires = self._expires
+        while order and (order[0][0] <= now or len(expires) > self.size or
+                         len(order) > 2 * self.size):
+            added, uid = order.popleft()
+            # skip entries of ids added again or discarded since
+            if expires.get(uid) == added:
+                del expires[uid]
+
+# plugin key: negative cache
+_caches = {}
+_caches_lock = threading.Lock()
+
+def getNegativeCache(plugin):
+    """Return negative cache of a given plugin or None if plugin
+    negative_cache_size is 0
+    """
+    size = int(getattr(plugin, 'negative_cache_size', 0) or 0)
+    if size <= 0:
+        return None
+    key = getCacheKey(plugin)
+    cache = _caches.get(key)
+    if cache is None:
+        _caches_lock.acquire()
+        try:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = _caches[key] = NegativeCache()
+        finally:
+            _caches_lock.release()
+    cache.size = size
+    cache.ttl = getattr(plugin, 'negative_cache_ttl', 300)
+    return cache
+
+def isAbsentUser(plugin, uid, recorder=None):
+    """Tell whether a user is known not to be in LDAP"""
+    cache = getNegativeCache(plugin)
+    if cache is None:
+        return False
+    absent = uid in cache
+    if recorder is not None:
+        if absent:
+            recorder.hit('negative cache')
+        else:
+            recorder.miss('negative cache')
+    return absent
+
+def addAbsentUser(plugin, uid):
+    """Remember that a user is not in LDAP"""
+    cache = getNegativeCache(plugin)
+    if cache is not None:
+        cache.add(uid)
+
+def forgetAbsentUser(plugin, uid):
+    """Forget that a user is not in LDAP, e.g. because it was just added"""
+    cache = _caches.get(getCacheKey(plugin))
+    if cache is not None:
+        cache.discard(uid)
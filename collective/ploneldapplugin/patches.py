@@ -1,17 +1,26 @@
 import logging
-from ldap import schema
-
-from Acquisition import aq_base
-from persistent.mapping import PersistentMapping
 
 from Products.CMFCore.MemberDataTool import MemberData as BaseMemberData
 from Products.PluggableAuthService.interfaces.authservice import \
     IPluggableAuthService
 from Products.CMFPlone.MemberDataTool import _marker
-from Products.PlonePAS.utils import getCharset
 
-from collective.ploneldapplugin.ldapproperty import EnhancedLDAPPropertySheet
-from collective.ploneldapplugin import logException
+from collective.ploneldapplugin.ldapproperty import getPropertySheet, \
+    forgetPropertySheet
+from collective.ploneldapplugin.ldapproperty import \
+    getConversionPlan as _getConversionPlan
+from collective.ploneldapplugin.schemacache import \
+    getLDAPAttrs as _getLDAPAttrs
+from collective.ploneldapplugin.schemacache import getLDAPMetaData
+from collective.ploneldapplugin.schemasnapshot import getSnapshotDirectory
+from collective.ploneldapplugin.instrumentation import getRecorder
+from collective.ploneldapplugin.connection import getConnectionPool
+from collective.ploneldapplugin.sharedcache import \
+    invalidateSharedProperties
+from collective.ploneldapplugin.warmcache import forgetWarmProperties
+from collective.ploneldapplugin.negativecache import forgetAbsentUser
+from collective.ploneldapplugin.requestcache import getRequestCache, \
+    getRequestCharset, getMemberSheetsKey, forgetMemberSheets
 
 # below functions are methods copied from EnchancedPloneMultiPlugin class
 
@@ -22,24 +31,13 @@ def getLDAPAttrs(self):
       (ldapname, zopename, type): (Attribute, Syntax OID),
     }
     """
-    # add attribute if needed
-    if not hasattr(aq_base(self), '_ldapattrs'):
-        self._ldapattrs = PersistentMapping()
-    
-    # fill it in if it's empty
-    if not self._ldapattrs:
-        acl = self._getLDAPUserFolder()
-        meta = self._getLDAPMetaData(acl)
-        if meta:
-            for info in acl.getSchemaConfig().values():
-                ldapname, zopename, type = (info['ldap_name'],
-                    info['public_name'], info['multivalued'] and 'lines' or
-                    'string')
-                if not zopename or not meta.has_key(ldapname):
-                    continue
-                self._ldapattrs[(ldapname, zopename, type)] = meta[ldapname]
-    
-    return self._ldapattrs
+    return _getLDAPAttrs(self, getRecorder(self))
+
+def getConversionPlan(self, ldapschema):
+    """Return compiled conversion plan for a given property sheet
+    schema: [(ldapname, zopename, type), ...]
+    """
+    return _getConversionPlan(self, ldapschema)
 
 def _getLDAPMetaData(self, acl):
     """Return ldap attributes metadata
@@ -48,48 +46,27 @@ def _getLDAPMetaData(self, acl):
       ldapname: (attribute, syntax oid),
     }
     """
-    try:
-        connection = acl._delegate.connect()
-        subentrydn = connection.search_subschemasubentry_s()
-        entry = connection.read_subschemasubentry_s(subentrydn)
-        subschema = schema.SubSchema(entry)
-        must, may = subschema.attribute_types(acl._user_objclasses)
-    except Exception, e:
-        logException(u"Error while trying to gather LDAP Attributes Schema"
-                     " Metadata", acl)
-        return {}
-    
-    # gets attribute type syntax oid recursively if needed
-    def _get_syntax_oid(attr, default=None):
-        oid = attr.syntax
-        if not oid:
-            for sup in attr.sup:
-                parent = subschema.get_inheritedobj(schema.AttributeType,
-                    sup)
-                oid = _get_syntax_oid(parent, default)
-        return oid or default
-    
-    data = {}
-    for attribute in must.values() + may.values():
-        oid = _get_syntax_oid(attribute)            
-        for name in attribute.names:
-            data[name] = (attribute, oid)
-    return data
+    return getLDAPMetaData(acl, getSnapshotDirectory(self),
+        getRecorder(self), getConnectionPool(self))
 
 def getPropertiesForUser(self, user, request=None):
     """Fullfill PropertiesPlugin requirements"""
-    try:
-        return EnhancedLDAPPropertySheet(self.id, user)
-    except KeyError:
-        return None
+    return getPropertySheet(self, user, request)
 
 def setPropertiesForUser(self, user, propertysheet):
-    """Use here propertysheet API thus avoiding code duplication"""
-    propertysheet.setProperties(user, propertysheet._properties)
+    """Use here propertysheet API thus avoiding code duplication.
+
+    Properties of LDAP sheets not read or converted yet are left out.
+    """
+    items = getattr(propertysheet, 'loadedPropertyItems',
+        propertysheet.propertyItems)
+    propertysheet.setProperties(user, dict(items()))
+    forgetPropertySheet(self, user)
 
 # patching
 from Products.PloneLDAP.plugins.ldap import PloneLDAPMultiPlugin
 PloneLDAPMultiPlugin.getLDAPAttrs = getLDAPAttrs
+PloneLDAPMultiPlugin.getConversionPlan = getConversionPlan
 PloneLDAPMultiPlugin._getLDAPMetaData = _getLDAPMetaData
 PloneLDAPMultiPlugin.getPropertiesForUser = getPropertiesForUser
 PloneLDAPMultiPlugin.setPropertiesForUser = setPropertiesForUser
@@ -134,6 +111,9 @@ def doAddUser(self , login , password):
 
     view_name = self.getId() + '_enumerateUsers'
     self.ZCacheable_invalidate(view_name = view_name,)
+    invalidateSharedProperties(self, login)
+    forgetWarmProperties(self, login)
+    forgetAbsentUser(self, login)
 
     return not res
 
@@ -145,36 +125,74 @@ def addGroup(self, id, **kw):
     return True
 
 def getProperty(self, id, default=_marker):
-    """Passes default value to property sheets"""
+    """Passes default value to property sheets.
+
+    Sheet holding each property is looked up once per user and request,
+    LDAP property sheets also keep values encoded to portal charset.
+    """
     sheets = None
     if not IPluggableAuthService.providedBy(self.acl_users):
         return BaseMemberData.getProperty(self, id)
     else:
         # It's a PAS! Whee!
         user = self.getUser()
-        sheets = getattr(user, 'getOrderedPropertySheets', lambda: None)()
-
-        # we won't always have PlonePAS users, due to acquisition,
-        # nor are guaranteed property sheets
-        if not sheets:
-            return BaseMemberData.getProperty(self, id, default)
-
-    charset = getCharset(self)
+        cache = getRequestCache(self)
+        # user objects are usually created anew for each member lookup,
+        # sheets are the same for all of them
+        key = getMemberSheetsKey(user.getId())
+        entry = cache is not None and cache.get(key) or None
+        if entry is not None:
+            sheets, index = entry
+        else:
+            sheets = getattr(user, 'getOrderedPropertySheets',
+                lambda: None)()
+
+            # we won't always have PlonePAS users, due to acquisition,
+            # nor are guaranteed property sheets
+            if not sheets:
+                return BaseMemberData.getProperty(self, id, default)
+
+            # property id: first sheet having it or None
+            index = {}
+            if cache is not None:
+                cache[key] = (sheets, index)
+
+    charset = getRequestCharset(self, cache)
 
     # If we made this far, we found a PAS and some property sheets.
-    for sheet in sheets:
-        if sheet.hasProperty(id):
-            # Return the first one that has the property.
-            value = sheet.getProperty(id, default)
-            if isinstance(value, unicode):
-                # XXX Temporarily work around the fact that
-                # property sheets blindly store and return
-                # unicode. This is sub-optimal and should be
-                # dealed with at the property sheets level by
-                # using Zope's converters.
-                return value.encode(charset)
-            return value
+    sheet = index.get(id, _marker)
+    if sheet is _marker:
+        sheet = None
+        for candidate in sheets:
+            if candidate.hasProperty(id):
+                sheet = candidate
+                break
+        index[id] = sheet
+
+    if sheet is not None:
+        # Return the first one that has the property.
+        getEncodedProperty = getattr(sheet, 'getEncodedProperty', None)
+        if getEncodedProperty is not None:
+            return getEncodedProperty(id, default, charset)
+        value = sheet.getProperty(id, default)
+        if isinstance(value, unicode):
+            # XXX Temporarily work around the fact that
+            # property sheets blindly store and return
+            # unicode. This is sub-optimal and should be
+            # dealed with at the property sheets level by
+            # using Zope's converters.
+            return value.encode(charset)
+        return value
 
     # Couldn't find the property in the property sheets. Try to
     # delegate back to the base implementation.
     return BaseMemberData.getProperty(self, id, default)
+
+def setMemberProperties(self, *args, **kw):
+    """Drop property sheets getProperty cached in the request, sheets of
+    other plugins than LDAP ones may be replaced on write.
+    """
+    try:
+        return self._old_setMemberProperties(*args, **kw)
+    finally:
+        forgetMemberSheets(self, self.getUser().getId())
@@ -0,0 +1,167 @@
+"""Bulk searches of raw LDAP properties of many users.
+
+Searches take plain query data instead of LDAP user folder, so they can run
+in background threads too.
+"""
+from ldap.filter import filter_format
+
+from collective.ploneldapplugin.schemacache import getLDAPAttrs
+from collective.ploneldapplugin.instrumentation import timed
+from collective.ploneldapplugin import logger
+
+BASE_SCOPE = 0
+
+# syntaxes of large values: audio, binary, certificate, certificate list,
+# certificate pair, fax, jpeg and octet string
+HEAVY_SYNTAXES = dict([('1.3.6.1.4.1.1466.115.121.1.%d' % number, 1)
+    for number in (4, 5, 8, 9, 10, 23, 28, 40)])
+
+
+def getHeavyAttributes(plugin):
+    """Return {lowercased ldapname: 1} of attributes property reads leave
+    out, they are fetched when first asked for.
+
+    Those are attributes listed in plugin heavy_attributes and, with plugin
+    lazy_binary_attributes on, those of binary syntaxes.
+    """
+    heavy = dict([(name.strip().lower(), 1) for name in
+        getattr(plugin, 'heavy_attributes', ()) if name.strip()])
+    if getattr(plugin, 'lazy_binary_attributes', False):
+        for (ldapname, zopename, type), (attribute, syntax) in \
+                getLDAPAttrs(plugin).items():
+            if syntax in HEAVY_SYNTAXES:
+                heavy[ldapname.lower()] = 1
+    return heavy
+
+def getPropertyQuery(acl, heavy=None):
+    """Return plain data describing bulk property searches of a given LDAP
+    user folder, only attributes of property sheets are read, except heavy
+    ones ({lowercased ldapname: 1}):
+
+    {
+      'base': users base,
+      'scope': users scope,
+      'uid_attr': user id attribute,
+      'objclasses': filter matching user object classes,
+      'attrs': attributes to read,
+      'multivalued': {lowercased ldapname: True or False},
+    }
+    """
+    uid_attr = acl._uid_attr
+    schema = acl.getSchemaConfig().values()
+    heavy = heavy or {}
+    attrs = [info['ldap_name'] for info in schema if info['public_name'] and
+        info['ldap_name'].lower() not in heavy]
+    if uid_attr != 'dn' and uid_attr not in attrs:
+        attrs.append(uid_attr)
+    return {
+        'base': acl.users_base,
+        'scope': acl.users_scope,
+        'uid_attr': uid_attr,
+        'objclasses': ''.join([filter_format('(objectClass=%s)', (oc,))
+            for oc in acl._user_objclasses]),
+        'attrs': attrs,
+        'multivalued': dict([(info['ldap_name'].lower(),
+            info['multivalued']) for info in schema]),
+    }
+
+def searchProperties(search, query, uids, size=100, recorder=None,
+                     failed=None):
+    """Return raw ldap properties of given users in the same form
+    LDAPUser._properties keeps them:
+
+    {
+      user id: {ldapname: value or list of values},
+    }
+
+    search - LDAPDelegate.search compatible callable
+    size - user ids per OR-filtered search
+    failed - list ids of failed searches are added to, users missing in the
+             result and not in it are not in LDAP
+    """
+    result = {}
+    if not uids:
+        return result
+    uid_attr = query['uid_attr']
+
+    # can't OR-filter on dn, read entries one by one
+    if uid_attr == 'dn':
+        for uid in uids:
+            res = timed(recorder, 'ldap', 'search', search, base=uid,
+                scope=BASE_SCOPE, filter='(&%s)' % query['objclasses'],
+                attrs=query['attrs'])
+            if res['exception']:
+                # missing entry is reported as exception too
+                if failed is not None:
+                    failed.append(uid)
+            elif res['results']:
+                result[uid] = _toProperties(query, res['results'][0])
+        return result
+
+    # ldap may match user ids case insensitively, lowercased id: [user ids]
+    wanted = {}
+    exact = {}
+    unique = []
+    for uid in uids:
+        if uid in exact:
+            continue
+        exact[uid] = 1
+        unique.append(uid)
+        wanted.setdefault(uid.lower(), []).append(uid)
+    uids = unique
+    size = max(int(size), 1)
+    for start in range(0, len(uids), size):
+        chunk = uids[start:start + size]
+        ids = ''.join([filter_format('(%s=%s)', (uid_attr, uid))
+            for uid in chunk])
+        res = timed(recorder, 'ldap', 'search', search, base=query['base'],
+            scope=query['scope'], filter='(&%s(|%s))' % (query['objclasses'],
+            ids), attrs=query['attrs'])
+        if res['exception']:
+            logger.error('Bulk LDAP search failed with %s' %
+                res['exception'])
+            if failed is not None:
+                failed.extend(chunk)
+            continue
+
+        for entry in res['results']:
+            properties = _toProperties(query, entry)
+            # find out to which of the requested users entry belongs, ids
+            # differing only in case are told apart by exact match
+            values = getAttribute(entry, uid_attr) or []
+            for value in values:
+                if value in exact:
+                    result[value] = properties
+                    break
+            else:
+                for value in values:
+                    same = wanted.get(value.lower(), ())
+                    if len(same) == 1:
+                        result[same[0]] = properties
+                        break
+    return result
+
+def getAttribute(properties, ldapname):
+    """Return value of attribute in raw properties, server may return
+    attribute names in other case
+    """
+    value = properties.get(ldapname)
+    if value is None:
+        ldapname = ldapname.lower()
+        for key, value in properties.items():
+            if key.lower() == ldapname:
+                return value
+        return None
+    return value
+
+def _toProperties(query, entry):
+    multivalued = query['multivalued']
+    properties = {}
+    for key, value in entry.items():
+        if key == 'dn':
+            properties[key] = value
+        elif multivalued.get(key.lower()):
+            properties[key] = value
+        else:
+            properties[key] = value and value[0] or ''
+    return properties
@@ -0,0 +1,438 @@
+"""Bulk user and group provisioning.
+
+Users and groups are added with asynchronous LDAP operations, keeping up to
+a window of them in flight on a single connection, instead of one
+synchronous manage_addUser, manage_addGroup or manage_addGroupMember call
+at a time. Enumeration caches are invalidated once at the end.
+"""
+import types
+
+import ldap
+from ldap.dn import escape_dn_chars
+from ldap.filter import filter_format
+
+from Products.LDAPUserFolder.utils import to_utf8, _createLDAPPassword, \
+    GROUP_MEMBER_MAP
+
+from collective.ploneldapplugin.connection import connect, \
+    getConnectionSettings, getConnectionPool
+from collective.ploneldapplugin.ldapproperty import getSheetSchema, \
+    toLDAPValues
+from collective.ploneldapplugin.sharedcache import \
+    invalidateSharedProperties
+from collective.ploneldapplugin.warmcache import forgetWarmProperties
+from collective.ploneldapplugin.negativecache import forgetAbsentUser
+from collective.ploneldapplugin.instrumentation import getRecorder, timed
+from collective.ploneldapplugin import logger
+
+# LDAP writes in flight if plugin has no bulk_add_window
+WINDOW = 20
+
+# object class of groups made by importGroups, like manage_addGroup default
+GROUP_OBJCLASS = 'groupOfUniqueNames'
+
+
+def describeError(error):
+    """Return readable description of python-ldap error"""
+    info = error.args and error.args[0] or None
+    if isinstance(info, types.DictType):
+        return ' '.join([info[key] for key in ('desc', 'info')
+            if info.get(key)])
+    return str(error)
+
+def openConnection(plugin, acl):
+    """Return (connection, close) of a connection to write with.
+
+    close(connection, down) gives connection back, down tells server dropped
+    it. Pooled connection is used if plugin has pool for writes, otherwise
+    one bound with plugin credentials or, if LDAPDelegate writes as the
+    logged in user, the delegate connection.
+    """
+    pool = getConnectionPool(plugin, True)
+    if pool is not None:
+        def close(connection, down):
+            pool.release(connection)
+            if down:
+                pool.discard()
+        return pool.connection(), close
+
+    settings = getConnectionSettings(acl)
+    if settings['write']:
+        def close(connection, down):
+            connection.unbind_s()
+        return connect(settings), close
+
+    def close(connection, down):
+        # kept by LDAPDelegate
+        pass
+    return acl._delegate.connect(), close
+
+def buildUserEntry(acl, plan, login, password, properties):
+    """Return (dn, attributes list) of a new user entry.
+
+    Like PloneLDAP doAddUser uid, login and rdn attributes get login, unless
+    properties ({zopename: python value}) set them. Properties are converted
+    with plugin converters.
+    """
+    attrs = {}
+    for key, value in properties.items():
+        entry = plan.index.get(key)
+        if entry is None or value is None:
+            continue
+        ldapname, zopename, type, converter = entry
+        info = (ldapname, zopename, type)
+        if isinstance(value, (types.ListType, types.TupleType)):
+            values = toLDAPValues(converter, list(value), info)
+        else:
+            values = [converter.toLDAPValue(value, info)]
+        values = [to_utf8(v) for v in values if v != '']
+        if values:
+            attrs[ldapname] = values
+
+    login = to_utf8(login)
+    # ldap attribute names are case insensitive
+    names = dict([(key.lower(), key) for key in attrs.keys()])
+    for key in (acl._uid_attr, acl._login_attr, acl._rdnattr):
+        if key != 'dn' and key.lower() not in names:
+            attrs[key] = [login]
+            names[key.lower()] = key
+    attrs['objectClass'] = [to_utf8(oc) for oc in acl._user_objclasses]
+    attrs['userPassword'] = [_createLDAPPassword(password,
+        acl._pwd_encryption)]
+
+    rdn = attrs[names[acl._rdnattr.lower()]][0]
+    dn = '%s=%s,%s' % (acl._rdnattr, escape_dn_chars(rdn),
+        to_utf8(acl.users_base))
+    return dn, attrs.items()
+
+def getUserId(acl, dn, attrs):
+    """Return user id of a new user entry built by buildUserEntry"""
+    if acl._uid_attr == 'dn':
+        return dn
+    for key, values in attrs:
+        if key.lower() == acl._uid_attr.lower():
+            return values[0]
+    return None
+
+def addUsers(plugin, entries, window=None, roles=()):
+    """Add users out of iterable of (login, password, {zopename: value}).
+
+    Like manage_addUser added users get given roles, kept in the user folder
+    with local groups or as LDAP group memberships otherwise.
+
+    Returns list of {'login', 'id', 'dn', 'ok', 'error'} in entries order.
+    If LDAP server can't be reached, all entries are reported as failed. If
+    it goes down, adds still in flight are reported as failed and the
+    remaining entries are not processed.
+    """
+    acl = plugin._getLDAPUserFolder()
+    results = []
+    if acl is None:
+        return results
+    if getattr(acl._delegate, 'read_only', False):
+        for login, password, properties in entries:
+            results.append({'login': login, 'id': None, 'dn': None,
+                'ok': False,
+                'error': 'Running in read-only mode'})
+        return results
+
+    window = max(int(window or getattr(plugin, 'bulk_add_window', WINDOW)),
+        1)
+    plan = plugin.getConversionPlan(getSheetSchema(acl))
+    recorder = getRecorder(plugin)
+    try:
+        connection, close = openConnection(plugin, acl)
+    except ldap.LDAPError, e:
+        logger.error('Can not connect to LDAP for bulk user add: %s' %
+            describeError(e))
+        for login, password, properties in entries:
+            results.append({'login': login, 'id': None, 'dn': None,
+                'ok': False,
+                'error': describeError(e)})
+        return results
+
+    # (result, msgid) of adds in flight
+    pending = []
+    down = False
+    try:
+        try:
+            for login, password, properties in entries:
+                result = {'login': login, 'id': None, 'dn': None,
+                    'ok': False, 'error': ''}
+                results.append(result)
+                try:
+                    dn, attrs = buildUserEntry(acl, plan, login, password,
+                        properties or {})
+                except (ValueError, TypeError, AttributeError), e:
+                    result['error'] = 'Can not convert properties: %s' % e
+                    continue
+                result['dn'] = dn
+                result['id'] = getUserId(acl, dn, attrs)
+                try:
+                    pending.append((result, connection.add(dn, attrs)))
+                except ldap.SERVER_DOWN, e:
+                    result['error'] = describeError(e)
+                    raise
+                except ldap.LDAPError, e:
+                    result['error'] = describeError(e)
+                    continue
+                if len(pending) >= window:
+                    timed(recorder, 'ldap', 'bulk add', _collect, connection,
+                        *pending.pop(0))
+            while pending:
+                timed(recorder, 'ldap', 'bulk add', _collect, connection,
+                    *pending.pop(0))
+        except ldap.SERVER_DOWN, e:
+            logger.error('LDAP server went down during bulk user add')
+            down = True
+            for result, msgid in pending:
+                result['error'] = describeError(e)
+    finally:
+        close(connection, down)
+
+    added = [result for result in results if result['ok']]
+    if roles:
+        _grantRoles(acl, [result['dn'] for result in added], roles)
+    if added:
+        # LDAPUserFolder caches, like manage_addUser does
+        acl._clearCaches()
+    view_name = plugin.getId() + '_enumerateUsers'
+    plugin.ZCacheable_invalidate(view_name=view_name)
+    for result in added:
+        invalidateSharedProperties(plugin, result['id'])
+        forgetWarmProperties(plugin, result['id'])
+        forgetAbsentUser(plugin, result['id'])
+    if recorder is not None:
+        recorder.count('bulk added users', len(added))
+    return results
+
+def _grantRoles(acl, dns, roles):
+    """Give roles to new users the way manage_addUser does"""
+    if acl._local_groups:
+        store = acl._groups_store
+        for dn in dns:
+            store[dn] = list(roles)
+        # let persistence know the mapping changed
+        acl._groups_store = store
+        return
+    for dn in dns:
+        acl.manage_editUserRoles(dn, list(roles))
+
+def importGroups(plugin, groups, window=None, dry_run=False):
+    """Create groups and add members to them out of iterable of
+    (group id, [member user ids]).
+
+    Missing groups are added with all their members at once, members
+    missing in existing groups are added with a single MOD_ADD per group.
+    Members are never removed. With dry_run nothing is written and the
+    result tells what would change.
+
+    Returns list of {'group', 'dn', 'action', 'members', 'unknown', 'ok',
+    'error'} in groups order, action is 'add', 'modify' or 'unchanged',
+    members are dns of added members and unknown are user ids not found in
+    LDAP.
+    """
+    acl = plugin._getLDAPUserFolder()
+    results = []
+    if acl is None:
+        return results
+    # merge repeated groups, ldap matches cn case insensitively, keep order
+    # of first appearance
+    wanted = {}
+    order = []
+    for group_id, members in groups:
+        key = to_utf8(group_id).lower()
+        if key not in wanted:
+            wanted[key] = []
+            order.append(group_id)
+        wanted[key].extend(members or ())
+    if not order:
+        return results
+    read_only = getattr(acl._delegate, 'read_only', False)
+
+    window = max(int(window or getattr(plugin, 'bulk_add_window', WINDOW)),
+        1)
+    chunk_size = max(int(getattr(plugin, 'bulk_chunk_size', 100)), 1)
+    recorder = getRecorder(plugin)
+    connection, close = openConnection(plugin, acl)
+
+    # (result, msgid) of writes in flight
+    pending = []
+    down = False
+    try:
+        try:
+            existing = timed(recorder, 'ldap', 'bulk group search',
+                _searchGroups, acl, connection, order, chunk_size)
+            uids = []
+            for members in wanted.values():
+                uids.extend(members)
+            dns = timed(recorder, 'ldap', 'bulk member search',
+                _searchMemberDNs, acl, connection, uids, chunk_size)
+
+            for group_id in order:
+                key = to_utf8(group_id).lower()
+                result = _planGroup(acl, group_id, wanted[key],
+                    existing.get(key), dns)
+                results.append(result)
+                if result['action'] == 'unchanged' or dry_run:
+                    result['ok'] = True
+                    continue
+                if read_only:
+                    result['error'] = 'Running in read-only mode'
+                    continue
+                try:
+                    if result['action'] == 'add':
+                        msgid = connection.add(result['dn'],
+                            result.pop('attrs'))
+                    else:
+                        msgid = connection.modify(result['dn'],
+                            result.pop('mod_list'))
+                    pending.append((result, msgid))
+                except ldap.SERVER_DOWN, e:
+                    result['error'] = describeError(e)
+                    raise
+                except ldap.LDAPError, e:
+                    result['error'] = describeError(e)
+                    continue
+                if len(pending) >= window:
+                    timed(recorder, 'ldap', 'bulk group write', _collect,
+                        connection, *pending.pop(0))
+            while pending:
+                timed(recorder, 'ldap', 'bulk group write', _collect,
+                    connection, *pending.pop(0))
+        except ldap.SERVER_DOWN, e:
+            logger.error('LDAP server went down during group import')
+            down = True
+            for result, msgid in pending:
+                result['error'] = describeError(e)
+    finally:
+        close(connection, down)
+
+    for result in results:
+        result.pop('attrs', None)
+        result.pop('mod_list', None)
+    changed = len([result for result in results if result['ok'] and
+        result['action'] != 'unchanged'])
+    if changed and not dry_run:
+        for name in ('_enumerateGroups', '_getGroupsForPrincipal'):
+            plugin.ZCacheable_invalidate(view_name=plugin.getId() + name)
+        if recorder is not None:
+            recorder.count('bulk imported groups', changed)
+    return results
+
+def _searchGroups(acl, connection, group_ids, chunk_size):
+    """Return {lowercased cn: (dn, member attribute, {lowercased member
+    dn})} of existing groups
+    """
+    found = {}
+    objclasses = ''.join([filter_format('(objectClass=%s)', (oc,))
+        for oc in GROUP_MEMBER_MAP.keys()])
+    attrs = ['cn', 'objectClass'] + list(set(GROUP_MEMBER_MAP.values()))
+    for start in range(0, len(group_ids), chunk_size):
+        chunk = group_ids[start:start + chunk_size]
+        filter = '(&(|%s)(|%s))' % (objclasses, ''.join([
+            filter_format('(cn=%s)', (to_utf8(group_id),))
+            for group_id in chunk]))
+        try:
+            res = connection.search_s(to_utf8(acl.groups_base),
+                acl.groups_scope, filter, attrs)
+        except ldap.NO_SUCH_OBJECT:
+            return found
+        for dn, entry in res:
+            # skip referrals
+            if dn is None:
+                continue
+            entry = dict([(key.lower(), value) for key, value in
+                entry.items()])
+            member_attr = None
+            for oc in entry.get('objectclass', ()):
+                for name, attr in GROUP_MEMBER_MAP.items():
+                    if name.lower() == oc.lower():
+                        member_attr = attr
+            if member_attr is None:
+                continue
+            members = set([member.lower() for member in
+                entry.get(member_attr.lower(), ())])
+            for cn in entry.get('cn', ()):
+                found[cn.lower()] = (dn, member_attr, members)
+    return found
+
+def _searchMemberDNs(acl, connection, uids, chunk_size):
+    """Return {lowercased user id: dn} of given users found in LDAP"""
+    uid_attr = acl._uid_attr
+    if uid_attr == 'dn':
+        return dict([(to_utf8(uid).lower(), to_utf8(uid)) for uid in uids])
+    objclasses = ''.join([filter_format('(objectClass=%s)', (oc,))
+        for oc in acl._user_objclasses])
+    # ldap matches user ids case insensitively
+    wanted = dict([(to_utf8(uid).lower(), to_utf8(uid)) for uid in uids])
+    uids = wanted.values()
+    dns = {}
+    for start in range(0, len(uids), chunk_size):
+        chunk = uids[start:start + chunk_size]
+        filter = '(&%s(|%s))' % (objclasses, ''.join([
+            filter_format('(%s=%s)', (uid_attr, uid))
+            for uid in chunk]))
+        try:
+            res = connection.search_s(to_utf8(acl.users_base),
+                acl.users_scope, filter, [uid_attr])
+        except ldap.NO_SUCH_OBJECT:
+            return dns
+        for dn, entry in res:
+            if dn is None:
+                continue
+            for key, values in entry.items():
+                if key.lower() != uid_attr.lower():
+                    continue
+                for value in values:
+                    if value.lower() in wanted:
+                        dns[value.lower()] = dn
+    return dns
+
+def _planGroup(acl, group_id, members, existing, dns):
+    """Return result of group import with attrs of group to add or mod_list
+    of group to modify
+    """
+    result = {'group': group_id, 'dn': None, 'action': 'unchanged',
+        'members': [], 'unknown': [], 'ok': False, 'error': ''}
+    member_dns = []
+    seen = set()
+    for uid in members:
+        dn = dns.get(to_utf8(uid).lower())
+        if dn is None:
+            if uid not in result['unknown']:
+                result['unknown'].append(uid)
+        elif dn.lower() not in seen:
+            seen.add(dn.lower())
+            member_dns.append(dn)
+
+    if existing is None:
+        member_attr = GROUP_MEMBER_MAP[GROUP_OBJCLASS]
+        result['dn'] = 'cn=%s,%s' % (escape_dn_chars(to_utf8(group_id)),
+            to_utf8(acl.groups_base))
+        result['action'] = 'add'
+        result['members'] = member_dns
+        # like manage_addGroup, groups can't be empty
+        initial = member_dns or [to_utf8(acl._binduid) or 'cn=dummy']
+        result['attrs'] = [('objectClass', ['top', GROUP_OBJCLASS]),
+            ('cn', [to_utf8(group_id)]), (member_attr, initial)]
+        return result
+
+    dn, member_attr, current = existing
+    result['dn'] = dn
+    added = [member for member in member_dns
+        if member.lower() not in current]
+    if added:
+        result['action'] = 'modify'
+        result['members'] = added
+        result['mod_list'] = [(ldap.MOD_ADD, member_attr, added)]
+    return result
+
+def _collect(connection, result, msgid):
+    try:
+        connection.result(msgid)
+        result['ok'] = True
+    except ldap.LDAPError, e:
+        result['error'] = describeError(e)
+        if isinstance(e, ldap.SERVER_DOWN):
+            raise
@@ -0,0 +1,51 @@
+"""Values memoized for the rest of the current request.
+
+Kept in request annotations the same way plone.memoize does, so they go away
+together with the request.
+"""
+from zope.annotation.interfaces import IAnnotations
+
+from Products.PlonePAS.utils import getCharset
+
+KEY = 'collective.ploneldapplugin.requestcache'
+
+
+def getRequestCache(context, request=None):
+    """Return dictionary living as long as a given request or the request of
+    a given context, None if there is no request
+    """
+    if request is None:
+        request = getattr(context, 'REQUEST', None)
+    if request is None:
+        return None
+    try:
+        annotations = IAnnotations(request)
+    except TypeError:
+        return None
+    cache = annotations.get(KEY)
+    if cache is None:
+        cache = annotations[KEY] = {}
+    return cache
+
+def getRequestCharset(context, cache=None):
+    """Portal charset looked up once per request"""
+    if cache is None:
+        cache = getRequestCache(context)
+        if cache is None:
+            return getCharset(context)
+    charset = cache.get('charset')
+    if charset is None:
+        charset = cache['charset'] = getCharset(context)
+    return charset
+
+def getMemberSheetsKey(uid):
+    """Request cache key of ordered property sheets of a given member"""
+    return ('property sheets', uid)
+
+def forgetMemberSheets(context, uid, request=None):
+    """Drop request cached property sheets of a given member, they may be
+    out of date after a write
+    """
+    cache = getRequestCache(context, request)
+    if cache is not None:
+        cache.pop(getMemberSheetsKey(uid), None)
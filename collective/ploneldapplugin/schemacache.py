@@ -0,0 +1,252 @@
+"""Process wide cache of LDAP schema attributes metadata.
+
+Metadata used to be kept in persistent _ldapattrs plugin attribute which was
+written during ordinary requests. Now it lives in memory only, is shared by
+all threads of the process and expires after plugin schema_cache_ttl.
+"""
+import time
+import threading
+
+from ldap import schema, SCOPE_BASE
+from ldap.schema import SCHEMA_ATTRS
+
+from collective.ploneldapplugin.schemasnapshot import getSnapshotKey, \
+    loadSnapshot, saveSnapshot
+from collective.ploneldapplugin.instrumentation import timed
+from collective.ploneldapplugin import logException, getCacheKey
+
+# default time in seconds to keep schema metadata
+DEFAULT_TTL = 3600
+
+# time in seconds to keep empty metadata, LDAP was likely unreachable, so
+# it's read again soon without every request waiting for it meanwhile
+EMPTY_TTL = 60
+
+
+class SchemaCache(object):
+    """Thread safe, non persistent cache of plugins schema metadata"""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        # key: lock held while value of the key is computed
+        self._fill_locks = {}
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        self._lock.acquire()
+        try:
+            self._data[key] = (time.time() + ttl, value)
+        finally:
+            self._lock.release()
+
+    def _getFillLock(self, key):
+        lock = self._fill_locks.get(key)
+        if lock is None:
+            self._lock.acquire()
+            try:
+                lock = self._fill_locks.setdefault(key, threading.Lock())
+            finally:
+                self._lock.release()
+        return lock
+
+    def lookup(self, key, compute, ttl, empty_ttl=EMPTY_TTL):
+        """Return cached value, compute it if missing or expired.
+
+        Only one thread computes value of a key at a time, others wait for
+        it and reuse the result. Values of other keys are computed
+        meanwhile. Empty results are kept for empty_ttl at most.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        lock = self._getFillLock(key)
+        lock.acquire()
+        try:
+            value = self.get(key)
+            if value is None:
+                value = compute()
+                if value:
+                    self.set(key, value, ttl)
+                else:
+                    self.set(key, value, min(ttl, empty_ttl))
+        finally:
+            lock.release()
+        return value
+
+    def invalidate(self, key=None):
+        """Drop cached value for a given key or the whole cache"""
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._data.clear()
+            elif key in self._data:
+                del self._data[key]
+        finally:
+            self._lock.release()
+
+schemaCache = SchemaCache()
+
+
+def getLDAPAttrs(plugin, recorder=None):
+    """Return LDAP Schema Attributes Mapping of a given plugin:
+
+    {
+      (ldapname, zopename, type): (Attribute, Syntax OID),
+    }
+
+    recorder - instrumentation recorder counting cache hits and misses
+    """
+    def compute():
+        if recorder is not None:
+            recorder.miss('schema')
+        attrs = {}
+        acl = plugin._getLDAPUserFolder()
+        meta = plugin._getLDAPMetaData(acl)
+        if meta:
+            for info in acl.getSchemaConfig().values():
+                ldapname, zopename, type = (info['ldap_name'],
+                    info['public_name'], info['multivalued'] and 'lines' or
+                    'string')
+                if not zopename or not meta.has_key(ldapname):
+                    continue
+                attrs[(ldapname, zopename, type)] = meta[ldapname]
+        return attrs
+
+    ttl = getattr(plugin, 'schema_cache_ttl', DEFAULT_TTL)
+    if recorder is not None:
+        attrs = schemaCache.get(getCacheKey(plugin))
+        if attrs is not None:
+            recorder.hit('schema')
+            return attrs
+    return schemaCache.lookup(getCacheKey(plugin), compute, ttl)
+
+# schema metadata loaded by this process: {snapshot key: (stamp, metadata)}
+_loaded = {}
+
+def getLDAPMetaData(acl, directory=None, recorder=None, pool=None):
+    """Return ldap attributes metadata
+
+    {
+      ldapname: (attribute, syntax oid),
+    }
+
+    First call in a process uses on disk snapshot from a given directory
+    without contacting LDAP if there is one. Later calls only re-read and
+    parse subschema if its modifyTimestamp changed.
+
+    recorder - instrumentation recorder timing subschema reads
+    pool - connection pool to read subschema with instead of LDAP delegate
+    """
+    key = getSnapshotKey(acl)
+    loaded = _loaded.get(key)
+    if loaded is None and directory:
+        snapshot = loadSnapshot(directory, key)
+        if snapshot is not None:
+            stamp, table = snapshot
+            meta = getMetaDataFromTable(table)
+            _loaded[key] = (stamp, meta)
+            return meta
+
+    def read(connection):
+        """Return subschema subentry, None if it did not change"""
+        subentrydn = timed(recorder, 'ldap', 'subschema dn',
+            connection.search_subschemasubentry_s)
+        if loaded is not None and loaded[0]:
+            stamp = timed(recorder, 'ldap', 'subschema timestamp',
+                readModifyTimestamp, connection, subentrydn)
+            if stamp == loaded[0]:
+                return None
+        return timed(recorder, 'ldap', 'subschema',
+            connection.read_subschemasubentry_s, subentrydn,
+            SCHEMA_ATTRS + ['modifyTimestamp'])
+
+    try:
+        if pool is not None:
+            entry = pool.run(read)
+        else:
+            entry = read(acl._delegate.connect())
+        if entry is None:
+            return loaded[1]
+        table = getAttributesTable(entry, acl._user_objclasses)
+    except Exception, e:
+        logException(u"Error while trying to gather LDAP Attributes Schema"
+                     " Metadata", acl)
+        return {}
+
+    stamp = _getModifyTimestamp(entry)
+    meta = getMetaDataFromTable(table)
+    _loaded[key] = (stamp, meta)
+    if directory:
+        saveSnapshot(directory, key, stamp, table)
+    return meta
+
+def readModifyTimestamp(connection, subentrydn):
+    """Read only modifyTimestamp of subschema subentry"""
+    res = connection.search_s(subentrydn, SCOPE_BASE, '(objectClass=*)',
+        ['modifyTimestamp'])
+    if not res:
+        return ''
+    return _getModifyTimestamp(res[0][1])
+
+def _getModifyTimestamp(entry):
+    for name, values in entry.items():
+        if name.lower() == 'modifytimestamp':
+            return values and values[0] or ''
+    return ''
+
+def getAttributesTable(entry, objclasses):
+    """Parse subschema subentry into compact attributes table
+
+    {
+      attribute oid: (syntax oid, single value, names, definition),
+    }
+    """
+    subschema = schema.SubSchema(entry)
+    must, may = subschema.attribute_types(objclasses)
+
+    # gets attribute type syntax oid following sup chain if needed,
+    # each attribute type is resolved only once
+    oids = {}
+    def _get_syntax_oid(attr):
+        if attr.oid in oids:
+            return oids[attr.oid]
+        oid = attr.syntax
+        if not oid:
+            for sup in attr.sup:
+                parent = subschema.get_inheritedobj(schema.AttributeType,
+                    sup)
+                if parent is not None:
+                    oid = _get_syntax_oid(parent)
+        oids[attr.oid] = oid
+        return oid
+
+    table = {}
+    for attribute in must.values() + may.values():
+        table[attribute.oid] = (_get_syntax_oid(attribute),
+            bool(attribute.single_value), tuple(attribute.names),
+            str(attribute))
+    return table
+
+def getMetaDataFromTable(table):
+    """Build attributes metadata out of compact attributes table"""
+    data = {}
+    for syntax, single_value, names, definition in table.values():
+        attribute = schema.AttributeType(definition)
+        for name in names:
+            data[name] = (attribute, syntax)
+    return data
+
+def refreshLDAPAttrs(plugin):
+    """Forget cached schema metadata of a given plugin"""
+    schemaCache.invalidate(getCacheKey(plugin))
+
+def invalidateSchemaCache(obj, event):
+    """Subscriber for LDAP schema and server configuration changes"""
+    schemaCache.invalidate()
@@ -0,0 +1,84 @@
+"""On disk snapshots of parsed LDAP subschema attributes.
+
+Snapshot keeps compact attributes table:
+
+{
+  attribute oid: (syntax oid, single value, names, definition),
+}
+
+together with the subschema modifyTimestamp it was read at, so a freshly
+started process can get schema metadata without contacting LDAP.
+"""
+import os
+import marshal
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from collective.ploneldapplugin import logger
+
+# bump when table format changes, older snapshots are ignored then
+VERSION = 1
+
+
+def getSnapshotKey(acl):
+    """Identify LDAP servers and user object classes schema was read for"""
+    servers = ['%s://%s:%s' % (server.get('protocol', 'ldap'),
+        server['host'], server['port']) for server in acl.getServers()]
+    return '%s|%s' % (','.join(servers), ','.join(acl._user_objclasses))
+
+def getSnapshotDirectory(plugin):
+    """Return directory to keep plugin schema snapshots in, None if
+    snapshots are disabled
+    """
+    if not getattr(plugin, 'use_schema_snapshot', True):
+        return None
+    directory = getattr(plugin, 'schema_snapshot_dir', '')
+    if not directory:
+        try:
+            from App.config import getConfiguration
+            directory = getConfiguration().clienthome
+        except (ImportError, AttributeError):
+            return None
+    return directory
+
+def _getPath(directory, key):
+    return os.path.join(directory,
+        'ploneldap-schema-%s.snapshot' % md5(key).hexdigest())
+
+def loadSnapshot(directory, key):
+    """Return (modifyTimestamp, table) or None if there is no usable
+    snapshot
+    """
+    path = _getPath(directory, key)
+    if not os.path.exists(path):
+        return None
+    try:
+        f = open(path, 'rb')
+        try:
+            version, snapshot_key, stamp, table = marshal.load(f)
+        finally:
+            f.close()
+    except Exception:
+        logger.warning('Can not read LDAP schema snapshot %s' % path)
+        return None
+    if version != VERSION or snapshot_key != key:
+        return None
+    return stamp, table
+
+def saveSnapshot(directory, key, stamp, table):
+    """Atomically write snapshot file"""
+    path = _getPath(directory, key)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump((VERSION, key, stamp, table), f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        logger.warning('Can not write LDAP schema snapshot %s' % path)
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,275 @@
+"""Property cache shared by all ZEO clients.
+
+Raw LDAP attribute values of users, in the form LDAPUser._properties keeps
+them, are stored marshalled in a memcached compatible server (or any other
+ISharedCacheBackend). Writes bump per user version kept next to the values:
+
+  ploneldap:v<digest> - current version of the user entry
+  ploneldap:p<digest><version> - values read at that version
+  ploneldap:p<digest><version>:<ldapname> - value of a heavy attribute
+                                            read separately
+
+where digest is md5 of plugin path and user id.
+
+Readers store values under the version they saw before reading LDAP, so
+values read concurrently with a write go to an outdated key and are never
+returned.
+"""
+import time
+import socket
+import marshal
+import threading
+from zlib import crc32
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from zope.interface import implements
+from zope.component import queryUtility
+
+from collective.ploneldapplugin.interfaces import ISharedCacheBackend, \
+    ISharedCacheBackendFactory
+from collective.ploneldapplugin import logger, getCacheKey
+
+# bump when stored values format changes
+VERSION = 1
+
+# seconds to keep values in shared cache
+DEFAULT_TTL = 600
+
+# seconds to wait for cache server
+SOCKET_TIMEOUT = 1.0
+
+# seconds before reconnecting to a failed server
+RETRY_DELAY = 30
+
+
+class MemcachedError(Exception):
+    pass
+
+class MemcachedBackend(object):
+    """Client of memcached text protocol.
+
+    servers - sequence of 'host:port' or 'unix:/path/to/socket', keys are
+              spread over servers by their crc32. Each thread keeps its own
+              connections.
+    """
+
+    implements(ISharedCacheBackend)
+
+    def __init__(self, servers, timeout=SOCKET_TIMEOUT):
+        self.servers = tuple(servers)
+        self.timeout = timeout
+        self._local = threading.local()
+        # server: time it failed
+        self._dead = {}
+
+    def get(self, key):
+        return self._command(key, 'get %s\r\n' % key, self._readValue)
+
+    def set(self, key, value, ttl=0):
+        return self._store('set', key, value, ttl)
+
+    def add(self, key, value, ttl=0):
+        return self._store('add', key, value, ttl)
+
+    def incr(self, key, delta=1):
+        reply = self._command(key, 'incr %s %d\r\n' % (key, delta),
+            self._readLine)
+        if reply is None or not reply.isdigit():
+            return None
+        return int(reply)
+
+    def delete(self, key):
+        reply = self._command(key, 'delete %s\r\n' % key, self._readLine)
+        return reply == 'DELETED'
+
+    def _store(self, command, key, value, ttl):
+        reply = self._command(key, '%s %s 0 %d %d\r\n%s\r\n' % (command, key,
+            int(ttl), len(value), value), self._readLine)
+        return reply == 'STORED'
+
+    def _command(self, key, data, read):
+        """Send command to server of a given key, None if it failed"""
+        server = self.servers[(crc32(key) & 0x7fffffff) % len(self.servers)]
+        failed = self._dead.get(server)
+        if failed is not None:
+            if failed + RETRY_DELAY > time.time():
+                return None
+            del self._dead[server]
+
+        try:
+            connection = self._connect(server)
+            connection[0].sendall(data)
+            return read(connection)
+        except (socket.error, MemcachedError), e:
+            logger.warning('Shared cache server %s failed: %s' % (server, e))
+            self._disconnect(server)
+            self._dead[server] = time.time()
+            return None
+
+    def _connect(self, server):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        connection = connections.get(server)
+        if connection is None:
+            if server.startswith('unix:'):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                address = server[5:]
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                host, port = server.rsplit(':', 1)
+                address = (host, int(port))
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+            # socket and its read buffer
+            connection = connections[server] = [sock, '']
+        return connection
+
+    def _disconnect(self, server):
+        connections = getattr(self._local, 'connections', {})
+        connection = connections.pop(server, None)
+        if connection is not None:
+            try:
+                connection[0].close()
+            except socket.error:
+                pass
+
+    def _readLine(self, connection):
+        while '\r\n' not in connection[1]:
+            self._receive(connection)
+        line, connection[1] = connection[1].split('\r\n', 1)
+        if line.startswith('SERVER_ERROR') or line == 'ERROR':
+            raise MemcachedError(line)
+        return line
+
+    def _readValue(self, connection):
+        line = self._readLine(connection)
+        if line == 'END':
+            return None
+        parts = line.split()
+        if len(parts) < 4 or parts[0] != 'VALUE':
+            raise MemcachedError('Unexpected reply %r' % line)
+        size = int(parts[3])
+        while len(connection[1]) < size + 2:
+            self._receive(connection)
+        value = connection[1][:size]
+        connection[1] = connection[1][size + 2:]
+        if self._readLine(connection) != 'END':
+            raise MemcachedError('Unexpected end of reply')
+        return value
+
+    def _receive(self, connection):
+        data = connection[0].recv(65536)
+        if not data:
+            raise MemcachedError('Connection closed')
+        connection[1] += data
+
+
+class SharedPropertyCache(object):
+    """Versioned raw LDAP properties of one plugin users"""
+
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix
+
+    def _digest(self, uid):
+        if isinstance(uid, unicode):
+            uid = uid.encode('utf-8')
+        return md5('%s\0%s' % (self.prefix, uid.lower())).hexdigest()
+
+    def getVersion(self, uid):
+        """Return current version of user entry, new one if it's unknown"""
+        key = 'ploneldap:v%s' % self._digest(uid)
+        version = self.backend.get(key)
+        if version is None:
+            # start from time based version, so values stored before
+            # version got evicted are never found again
+            version = str(int(time.time() * 1000))
+            if not self.backend.add(key, version):
+                version = self.backend.get(key)
+        return version
+
+    def _key(self, uid, version, attr):
+        key = 'ploneldap:p%s%s' % (self._digest(uid), version)
+        if attr is not None:
+            key = '%s:%s' % (key, attr.lower())
+        return key
+
+    def get(self, uid, version, attr=None):
+        """Return raw LDAP properties stored at a given version or None,
+        raw value of a given attribute only if attr is given
+        """
+        if version is None:
+            return None
+        value = self.backend.get(self._key(uid, version, attr))
+        if value is None:
+            return None
+        try:
+            format, properties = marshal.loads(value)
+        except (ValueError, EOFError, TypeError):
+            return None
+        if format != VERSION:
+            return None
+        return properties
+
+    def set(self, uid, version, properties, ttl=DEFAULT_TTL, attr=None):
+        """Store raw LDAP properties read at a given version, or raw value
+        of a given attribute
+        """
+        if version is None:
+            return
+        try:
+            value = marshal.dumps((VERSION, properties))
+        except ValueError:
+            return
+        self.backend.set(self._key(uid, version, attr), value, ttl)
+
+    def invalidate(self, uid):
+        """Make stored properties of a given user outdated in all clients"""
+        key = 'ploneldap:v%s' % self._digest(uid)
+        if self.backend.incr(key) is None:
+            self.backend.add(key, str(int(time.time() * 1000)))
+
+
+# servers: backend
+_backends = {}
+_backends_lock = threading.Lock()
+
+def getSharedBackend(servers):
+    """Return backend for given servers, shared by all plugins and threads.
+
+    Backend is made by ISharedCacheBackendFactory utility if there is one,
+    MemcachedBackend otherwise.
+    """
+    servers = tuple(servers)
+    backend = _backends.get(servers)
+    if backend is None:
+        _backends_lock.acquire()
+        try:
+            backend = _backends.get(servers)
+            if backend is None:
+                factory = queryUtility(ISharedCacheBackendFactory,
+                    default=MemcachedBackend)
+                backend = _backends[servers] = factory(servers)
+        finally:
+            _backends_lock.release()
+    return backend
+
+def getSharedCache(plugin):
+    """Return shared property cache of a given plugin or None if plugin has
+    no shared_cache_servers
+    """
+    servers = [server.strip() for server in
+        getattr(plugin, 'shared_cache_servers', ()) if server.strip()]
+    if not servers:
+        return None
+    return SharedPropertyCache(getSharedBackend(servers), getCacheKey(plugin))
+
+def invalidateSharedProperties(plugin, uid):
+    """Publish change of a given user to all clients"""
+    cache = getSharedCache(plugin)
+    if cache is not None:
+        cache.invalidate(uid)
@@ -0,0 +1,327 @@
+"""Stale-while-revalidate cache of exact LDAP user lookups.
+
+Results of enumerateUsers looking up a single user by id or login are kept
+per plugin. For soft ttl seconds they are served as they are. After it and
+until hard ttl they are still served right away, but a background thread
+checks them against LDAP, so no request waits for the round trip. Each
+entry is checked once however many requests find it stale. Entries older
+than hard ttl are looked up synchronously again.
+
+Background checks use plain query data and pooled connections, they don't
+touch persistent objects.
+"""
+import time
+import threading
+
+from ldap.filter import filter_format
+
+from Products.LDAPUserFolder.utils import to_utf8
+
+from collective.ploneldapplugin.connection import ConnectionPool, \
+    getConnectionSettings, getConnectionPool
+from collective.ploneldapplugin.instrumentation import getRecorder
+from collective.ploneldapplugin import logger, getCacheKey
+
+# maximum number of kept lookups
+SIZE = 10000
+
+# returned by refresh functions to leave entry as it is, it expires after
+# hard ttl then
+KEEP = object()
+
+BASE_SCOPE = 0
+
+
+class StaleCache(object):
+    """Values served fresh for soft_ttl seconds and stale, while being
+    refreshed in background, until hard_ttl seconds
+    """
+
+    def __init__(self, soft_ttl=60, hard_ttl=3600, size=SIZE):
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.size = size
+        # instrumentation recorder of the plugin, if recording is on
+        self.recorder = None
+        # key: [fetched, value]
+        self._entries = {}
+        # key: (function, args) of refreshes waiting for the worker
+        self._queued = {}
+        self._queue = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def get(self, key):
+        """Return (value, stale) or (None, False) if there is no usable
+        value
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._record(False)
+            return None, False
+        age = time.time() - entry[0]
+        if age <= self.soft_ttl:
+            self._record(True)
+            return entry[1], False
+        if age <= max(self.hard_ttl, self.soft_ttl):
+            self._record(True)
+            self._count('stale')
+            return entry[1], True
+        self._record(False)
+        return None, False
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._entries[key] = [time.time(), value]
+            if len(self._entries) > self.size:
+                self._trim()
+        finally:
+            self._lock.release()
+
+    def forget(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._queued.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def forgetMatching(self, match):
+        """Drop entries for whose values match returns true"""
+        self._lock.acquire()
+        try:
+            for key, (fetched, value) in self._entries.items():
+                if match(value):
+                    del self._entries[key]
+                    self._queued.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._queued.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _trim(self):
+        """Drop oldest entries, lock must be held.
+
+        Tenth of size more is dropped, so sorting doesn't happen on every
+        new entry.
+        """
+        fetched = [(entry[0], key) for key, entry in self._entries.items()]
+        fetched.sort()
+        for last, key in fetched[:len(fetched) - self.size * 9 // 10]:
+            del self._entries[key]
+
+    def refresh(self, key, func, *args):
+        """Call func(value, *args) in background to get new value of a
+        stale entry, None drops the entry and KEEP leaves it as it is.
+        Refreshes of an entry already waiting for one are left out.
+        """
+        self._lock.acquire()
+        try:
+            if key in self._queued:
+                return
+            self._queued[key] = (func, args)
+            self._queue.append(key)
+        finally:
+            self._lock.release()
+        self._startThread()
+        self._wakeup.set()
+
+    def _refreshQueued(self):
+        self._lock.acquire()
+        try:
+            if not self._queue:
+                return False
+            key = self._queue.pop(0)
+            # forgotten meanwhile
+            if key not in self._queued:
+                return True
+            func, args = self._queued[key]
+            entry = self._entries.get(key)
+        finally:
+            self._lock.release()
+
+        value = KEEP
+        if entry is not None:
+            try:
+                value = func(entry[1], *args)
+            except Exception:
+                logger.exception('Error while refreshing LDAP user lookup')
+        self._lock.acquire()
+        try:
+            # forgotten or set again meanwhile
+            if self._queued.pop(key, None) is None or \
+               self._entries.get(key) is not entry:
+                return True
+            if value is None:
+                del self._entries[key]
+            elif value is not KEEP:
+                self._entries[key] = [time.time(), value]
+        finally:
+            self._lock.release()
+        self._count('refreshed')
+        return True
+
+    def _startThread(self):
+        if self._thread is not None:
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='ploneldap-stale-cache')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._refreshQueued():
+                pass
+
+    def _record(self, hit):
+        recorder = self.recorder
+        if recorder is not None:
+            if hit:
+                recorder.hit('user lookup cache')
+            else:
+                recorder.miss('user lookup cache')
+
+    def _count(self, name, value=1):
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.count('user lookup cache %s' % name, value)
+
+# plugin key: stale cache
+_caches = {}
+_caches_lock = threading.Lock()
+
+def getStaleCache(plugin):
+    """Return user lookup cache of a given plugin or None if plugin
+    stale_while_revalidate is off
+    """
+    if not getattr(plugin, 'stale_while_revalidate', False):
+        return None
+    key = getCacheKey(plugin)
+    cache = _caches.get(key)
+    if cache is None:
+        _caches_lock.acquire()
+        try:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = _caches[key] = StaleCache()
+        finally:
+            _caches_lock.release()
+    cache.soft_ttl = getattr(plugin, 'stale_soft_ttl', 60)
+    cache.hard_ttl = getattr(plugin, 'stale_hard_ttl', 3600)
+    cache.recorder = getRecorder(plugin)
+    return cache
+
+def getLookupQuery(acl):
+    """Return plain data user lookup checks need"""
+    return {
+        'base': acl.users_base,
+        'scope': acl.users_scope,
+        'uid_attr': acl._uid_attr,
+        'login_attr': acl._login_attr,
+        'objclasses': ''.join([filter_format('(objectClass=%s)', (oc,))
+            for oc in acl._user_objclasses]),
+    }
+
+def _entryValue(entry, attr):
+    if attr == 'dn':
+        return entry.get('dn')
+    # server may return attribute names in other case
+    for key, values in entry.items():
+        if key.lower() == attr.lower():
+            return values and values[0] or None
+    return None
+
+# user info keys enumerateUsers adds itself, not read from LDAP
+INFO_KEYS = ('id', 'login', 'dn', 'pluginid', 'editurl')
+
+def checkUserLookup(result, query, search, attr, value):
+    """Return lookup result if its user is still in LDAP with the same id
+    and login, None otherwise.
+
+    Other enumeration fields of cached user info (LDAP attributes like cn or
+    mail) are read too, result with current values is returned if some of
+    them changed.
+    """
+    info = result[0]
+    fields = [key for key in info.keys() if key.lower() not in INFO_KEYS]
+    attrs = [query['uid_attr'], query['login_attr']] + fields
+    ldapattr = query[attr == 'id' and 'uid_attr' or 'login_attr']
+    if ldapattr == 'dn':
+        res = search(base=value, scope=BASE_SCOPE, filter='(&%s)' %
+            query['objclasses'], attrs=attrs)
+    else:
+        res = search(base=query['base'], scope=query['scope'],
+            filter='(&%s%s)' % (query['objclasses'], filter_format('(%s=%s)',
+            (ldapattr, value))), attrs=attrs)
+    if res['exception']:
+        # served until hard ttl
+        return KEEP
+    if len(res['results']) != 1:
+        return None
+    entry = res['results'][0]
+    for key, ldapattr in (('id', query['uid_attr']),
+                          ('login', query['login_attr'])):
+        found = _entryValue(entry, ldapattr)
+        if found is None or \
+           to_utf8(found).lower() != to_utf8(info.get(key) or '').lower():
+            return None
+    changed = {}
+    for key in fields:
+        found = _entryValue(entry, key) or ''
+        if to_utf8(found) != to_utf8(info[key] or ''):
+            changed[key] = found
+    if changed:
+        info = dict(info)
+        info.update(changed)
+        return (info,) + tuple(result[1:])
+    return result
+
+def lookupUser(plugin, func, attr, value):
+    """Return enumerateUsers result of a single user looked up by id or
+    login with func, serving cached results until hard ttl
+    """
+    cache = getStaleCache(plugin)
+    key = (attr, value)
+    result, stale = cache.get(key)
+    if result is None:
+        result = func()
+        # users not in LDAP are left to negative cache
+        if len(result) == 1:
+            cache.set(key, tuple([dict(info) for info in result]))
+        return result
+    if stale:
+        acl = plugin._getLDAPUserFolder()
+        pool = getConnectionPool(plugin)
+        if pool is None:
+            # connections of size 0 pool are closed after each search
+            pool = ConnectionPool(getConnectionSettings(acl), 0)
+        cache.refresh(key, checkUserLookup, getLookupQuery(acl), pool.search,
+            attr, value)
+    # callers add keys to user info
+    return tuple([dict(info) for info in result])
+
+def forgetUserLookups(plugin, uid):
+    """Drop cached lookups of a removed or changed user"""
+    cache = _caches.get(getCacheKey(plugin))
+    if cache is not None:
+        cache.forgetMatching(lambda result: [info for info in result
+            if info.get('id') == uid])
@@ -0,0 +1,150 @@
+import pickle
+import unittest
+
+from collective.ploneldapplugin.ldapproperty import SheetLayout, \
+    CompactProperties, getConversionPlan, INTERN_SIZE, INTERN_LENGTH
+
+ENTRIES = [
+    ('cn', 'fullname', 'string', None),
+    ('ou', 'department', 'string', None),
+    ('memberOf', 'groups', 'lines', None),
+]
+
+
+class FakePlugin(object):
+
+    def __init__(self):
+        self.attrs = {}
+
+    def getLDAPAttrs(self):
+        return self.attrs
+
+
+class SheetLayoutTests(unittest.TestCase):
+
+    def test_positions(self):
+        layout = SheetLayout(ENTRIES)
+        self.assertEqual(layout.names, ('fullname', 'department', 'groups'))
+        self.assertEqual(layout.positions['groups'], 2)
+        self.assertEqual(layout.schema, (('fullname', 'string'),
+            ('department', 'string'), ('groups', 'lines')))
+
+    def test_intern(self):
+        layout = SheetLayout(ENTRIES)
+        first = ''.join(['Sa', 'les'])
+        second = ''.join(['Sal', 'es'])
+        self.failIf(first is second)
+        self.failUnless(layout.intern(1, first) is first)
+        self.failUnless(layout.intern(1, second) is first)
+        groups = layout.intern(2, [''.join(['st', 'aff'])])
+        self.failUnless(layout.intern(2, [''.join(['sta', 'ff'])])[0] is
+            groups[0])
+
+    def test_long_values_not_interned(self):
+        layout = SheetLayout(ENTRIES)
+        value = 'x' * (INTERN_LENGTH + 1)
+        layout.intern(0, value)
+        self.failIf(layout.intern(0, 'x' * (INTERN_LENGTH + 1)) is value)
+
+    def test_distinct_values_stop_interning(self):
+        layout = SheetLayout(ENTRIES)
+        for index in range(INTERN_SIZE + 1):
+            layout.intern(0, 'name %d' % index)
+        self.assertEqual(layout._interned[0], None)
+        value = ''.join(['na', 'me 1'])
+        self.failUnless(layout.intern(0, value) is value)
+        # other properties keep interning
+        self.failIf(layout._interned[1] is None)
+
+    def test_unicode_and_str_kept_apart(self):
+        layout = SheetLayout(ENTRIES)
+        layout.intern(1, 'Sales')
+        self.assertEqual(type(layout.intern(1, u'Sales')), unicode)
+
+
+class CompactPropertiesTests(unittest.TestCase):
+
+    def makeProperties(self, **properties):
+        return CompactProperties(SheetLayout(ENTRIES), properties)
+
+    def test_mapping(self):
+        properties = self.makeProperties(fullname='Joe', groups=['staff'])
+        self.assertEqual(properties['fullname'], 'Joe')
+        self.assertRaises(KeyError, properties.__getitem__, 'department')
+        self.assertEqual(properties.get('department', 'none'), 'none')
+        self.failUnless('groups' in properties)
+        self.failIf(properties.has_key('department'))
+        self.assertEqual(sorted(properties.keys()), ['fullname', 'groups'])
+        self.assertEqual(len(properties), 2)
+        self.assertEqual(properties, {'fullname': 'Joe',
+            'groups': ['staff']})
+
+    def test_none_is_a_value(self):
+        properties = self.makeProperties(department=None)
+        self.failUnless('department' in properties)
+        self.assertEqual(properties['department'], None)
+
+    def test_extra_keys(self):
+        properties = self.makeProperties(fullname='Joe')
+        properties['mobile'] = '123'
+        self.assertEqual(properties['mobile'], '123')
+        self.assertEqual(sorted(properties.keys()), ['fullname', 'mobile'])
+        del properties['mobile']
+        self.failIf('mobile' in properties)
+        self.assertRaises(KeyError, properties.__delitem__, 'mobile')
+
+    def test_update_pop(self):
+        properties = self.makeProperties(fullname='Joe')
+        properties.update({'fullname': 'Ann', 'department': 'Sales'})
+        self.assertEqual(properties.pop('fullname'), 'Ann')
+        self.failIf('fullname' in properties)
+        self.assertEqual(properties.pop('fullname', None), None)
+        self.assertRaises(KeyError, properties.pop, 'fullname')
+        self.assertEqual(properties.copy(), {'department': 'Sales'})
+
+    def test_no_instance_dict(self):
+        properties = self.makeProperties(fullname='Joe')
+        self.failIf(hasattr(properties, '__dict__'))
+
+    def test_shared_values(self):
+        layout = SheetLayout(ENTRIES)
+        joe = CompactProperties(layout, {'department': ''.join(['Sa',
+            'les'])})
+        ann = CompactProperties(layout, {'department': ''.join(['Sal',
+            'es'])})
+        self.failUnless(joe['department'] is ann['department'])
+
+    def test_pickle(self):
+        properties = self.makeProperties(fullname='Joe', department=None)
+        properties['mobile'] = '123'
+        copy = pickle.loads(pickle.dumps(properties, 2))
+        self.assertEqual(copy, {'fullname': 'Joe', 'department': None,
+            'mobile': '123'})
+
+
+class LayoutReuseTests(unittest.TestCase):
+
+    def test_layout_kept_across_plan_rebuilds(self):
+        plugin = FakePlugin()
+        schema = [entry[:3] for entry in ENTRIES]
+        plan = getConversionPlan(plugin, schema)
+        plugin.attrs = {}
+        new = getConversionPlan(plugin, schema)
+        self.failIf(new is plan)
+        self.failUnless(new.layout is plan.layout)
+
+    def test_new_layout_for_new_schema(self):
+        plugin = FakePlugin()
+        schema = [entry[:3] for entry in ENTRIES]
+        plan = getConversionPlan(plugin, schema)
+        new = getConversionPlan(plugin, schema[:2])
+        self.failIf(new.layout is plan.layout)
+        self.assertEqual(new.layout.names, ('fullname', 'department'))
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(SheetLayoutTests),
+        unittest.makeSuite(CompactPropertiesTests),
+        unittest.makeSuite(LayoutReuseTests),
+        ])
@@ -0,0 +1,231 @@
+import unittest
+import threading
+
+import ldap
+
+from collective.ploneldapplugin import connection
+
+DOWN = 'ldap://down.example.com:389'
+
+
+class FakeLDAPObject(object):
+    """python ldap connection stand-in, servers in DOWN can't be reached"""
+
+    opened = []
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.bound = None
+        self.unbound = False
+        self.opened.append(self)
+
+    def set_option(self, option, value):
+        pass
+
+    def simple_bind_s(self, dn, password):
+        if self.uri == DOWN:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+        self.bound = dn
+
+    def unbind_s(self):
+        self.unbound = True
+
+    def search_s(self, base, scope, filter, attrs=None):
+        return [('uid=joe,dc=example,dc=com', {'uid': ['joe']}),
+                (None, ['ldap://referral'])]
+
+
+class EncodedLDAPObject(FakeLDAPObject):
+    """Connection returning utf-8 encoded and binary values"""
+
+    def search_s(self, base, scope, filter, attrs=None):
+        return [('cn=Jo\xc3\xa9,dc=example,dc=com', {'cn': ['Jo\xc3\xa9'],
+            'jpegPhoto': ['\xff\xd8']})]
+
+
+class FakeDelegate(object):
+
+    binduid_usage = 1
+    read_only = False
+
+    def __init__(self, servers):
+        self.servers = servers
+
+    def getServers(self):
+        return self.servers
+
+
+class FakeLDAPUserFolder(object):
+
+    _binduid = 'cn=Manager,dc=example,dc=com'
+    _bindpwd = 'secret'
+
+    def __init__(self, servers):
+        self._delegate = FakeDelegate(servers)
+
+
+def server(host, protocol='ldap'):
+    return {'host': host, 'port': 389, 'protocol': protocol,
+        'conn_timeout': -1, 'op_timeout': -1}
+
+
+class ConnectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.initialize = connection.ldap.initialize
+        connection.ldap.initialize = FakeLDAPObject
+        FakeLDAPObject.opened = []
+
+    def tearDown(self):
+        connection.ldap.initialize = self.initialize
+
+
+class SettingsTests(ConnectionTestCase):
+
+    def test_servers(self):
+        acl = FakeLDAPUserFolder([server('one.example.com'),
+            server('two.example.com', 'ldaps'),
+            server('/var/run/ldapi', 'ldapi')])
+        settings = connection.getConnectionSettings(acl)
+        self.assertEqual([entry[0] for entry in settings['servers']], [
+            'ldap://one.example.com:389', 'ldaps://two.example.com:389',
+            'ldapi://%2Fvar%2Frun%2Fldapi'])
+
+    def test_manager_bind(self):
+        acl = FakeLDAPUserFolder([server('one.example.com')])
+        settings = connection.getConnectionSettings(acl)
+        self.assertEqual(settings['bind_dn'], acl._binduid)
+        self.failUnless(settings['write'])
+
+    def test_manager_bind_for_lookups_only(self):
+        acl = FakeLDAPUserFolder([server('one.example.com')])
+        acl._delegate.binduid_usage = 2
+        settings = connection.getConnectionSettings(acl)
+        self.assertEqual(settings['bind_dn'], acl._binduid)
+        self.failIf(settings['write'])
+
+    def test_never_manager_bind(self):
+        acl = FakeLDAPUserFolder([server('one.example.com')])
+        acl._delegate.binduid_usage = 0
+        settings = connection.getConnectionSettings(acl)
+        self.assertEqual((settings['bind_dn'], settings['bind_pwd']),
+            ('', ''))
+        self.failIf(settings['write'])
+
+    def test_read_only(self):
+        acl = FakeLDAPUserFolder([server('one.example.com')])
+        acl._delegate.read_only = True
+        self.failUnless(connection.getConnectionSettings(acl)['read_only'])
+
+    def test_next_server(self):
+        acl = FakeLDAPUserFolder([server('down.example.com'),
+            server('two.example.com')])
+        ldap_connection = connection.connect(
+            connection.getConnectionSettings(acl))
+        self.assertEqual(ldap_connection.uri, 'ldap://two.example.com:389')
+        self.assertEqual(ldap_connection.bound, acl._binduid)
+
+    def test_all_servers_down(self):
+        acl = FakeLDAPUserFolder([server('down.example.com')])
+        self.assertRaises(ldap.SERVER_DOWN, connection.connect,
+            connection.getConnectionSettings(acl))
+
+
+class ConnectionPoolTests(ConnectionTestCase):
+
+    def makePool(self, size=10, *hosts):
+        acl = FakeLDAPUserFolder([server(host) for host in hosts or
+            ('one.example.com',)])
+        return connection.ConnectionPool(
+            connection.getConnectionSettings(acl), size)
+
+    def test_reused(self):
+        pool = self.makePool()
+        first = pool.connection()
+        pool.release(first)
+        self.failUnless(pool.connection() is first)
+        self.failIf(first.unbound)
+
+    def test_per_thread(self):
+        pool = self.makePool()
+        main = pool.connection()
+        other = []
+        thread = threading.Thread(target=lambda:
+            other.append(pool.connection()))
+        thread.start()
+        thread.join()
+        self.failIf(other[0] is main)
+        self.assertEqual(pool._kept, {'ldap://one.example.com:389': 2})
+
+    def test_size_per_server(self):
+        pool = self.makePool(1)
+        pool._kept['ldap://one.example.com:389'] = 1
+        # other threads use up the pool, this one gets a connection closed
+        # after use
+        extra = pool.connection()
+        pool.release(extra)
+        self.failUnless(extra.unbound)
+        # limit is per server
+        pool.settings = dict(pool.settings,
+            servers=(('ldap://two.example.com:389', -1, -1),))
+        kept = pool.connection()
+        pool.release(kept)
+        self.failIf(kept.unbound)
+        self.assertEqual(pool._kept['ldap://two.example.com:389'], 1)
+
+    def test_discard(self):
+        pool = self.makePool()
+        first = pool.connection()
+        pool.discard()
+        self.failUnless(first.unbound)
+        self.assertEqual(pool._kept['ldap://one.example.com:389'], 0)
+        self.failIf(pool.connection() is first)
+
+    def test_idle_reopened(self):
+        pool = self.makePool()
+        pool.idle_timeout = -1
+        first = pool.connection()
+        self.failIf(pool.connection() is first)
+        self.failUnless(first.unbound)
+
+    def test_reconnect(self):
+        pool = self.makePool()
+        calls = []
+        def operation(ldap_connection):
+            calls.append(ldap_connection)
+            if len(calls) == 1:
+                raise ldap.SERVER_DOWN({})
+            return 'done'
+        self.assertEqual(pool.run(operation), 'done')
+        self.failIf(calls[0] is calls[1])
+        self.failUnless(calls[0].unbound)
+
+    def test_search(self):
+        pool = self.makePool()
+        res = pool.search('dc=example,dc=com', 2, '(uid=joe)', ['uid'])
+        # referrals are skipped
+        self.assertEqual(res, {'exception': '', 'size': 1, 'results': [
+            {'dn': 'uid=joe,dc=example,dc=com', 'uid': ['joe']}]})
+
+    def test_search_decoded(self):
+        connection.ldap.initialize = EncodedLDAPObject
+        pool = self.makePool()
+        entry = pool.search('dc=example,dc=com', 2, '(cn=*)')['results'][0]
+        self.assertEqual(entry['cn'], [u'Jo\xe9'])
+        self.assertEqual(type(entry['cn'][0]), unicode)
+        self.assertEqual(entry['dn'], u'cn=Jo\xe9,dc=example,dc=com')
+        # binary values are kept as they are
+        self.assertEqual(entry['jpegPhoto'], ['\xff\xd8'])
+
+    def test_search_down(self):
+        pool = self.makePool(10, 'down.example.com')
+        res = pool.search('dc=example,dc=com', 2, '(uid=joe)', ['uid'])
+        self.failUnless(res['exception'])
+        self.assertEqual(res['results'], [])
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(SettingsTests),
+        unittest.makeSuite(ConnectionPoolTests),
+        ])
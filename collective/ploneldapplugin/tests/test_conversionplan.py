@@ -0,0 +1,83 @@
+import unittest
+
+from collective.ploneldapplugin.ldapproperty import compileConversionPlan, \
+    getConversionPlan, convertersChanged, DefaultLDAPAttributeConverter
+
+SCHEMA = [
+    ('cn', 'fullname', 'string'),
+    ('mail', 'email', 'string'),
+    ('memberOf', 'groups', 'lines'),
+]
+
+
+class FakePlugin(object):
+    """Plugin stand-in with LDAP schema metadata of its own"""
+
+    def __init__(self):
+        self.attrs = {}
+
+    def getLDAPAttrs(self):
+        return self.attrs
+
+
+class FakeRegistration(object):
+
+    class provided(object):
+
+        @staticmethod
+        def isOrExtends(interface):
+            return True
+
+
+class CompileTests(unittest.TestCase):
+
+    def test_entries(self):
+        plan = compileConversionPlan(SCHEMA, {})
+        self.assertEqual([entry[:3] for entry in plan.entries], SCHEMA)
+        self.assertEqual(plan.index['email'][0], 'mail')
+        self.assertEqual(plan.layout.names, ('fullname', 'email', 'groups'))
+
+    def test_default_converter_shared(self):
+        # attributes without metadata get one default converter
+        plan = compileConversionPlan(SCHEMA, {})
+        converters = [entry[3] for entry in plan.entries]
+        self.failUnless(isinstance(converters[0],
+            DefaultLDAPAttributeConverter))
+        self.failUnless(converters[0] is converters[1] is converters[2])
+        self.assertEqual(plan.labels['fullname'],
+            'DefaultLDAPAttributeConverter -')
+
+
+class GetConversionPlanTests(unittest.TestCase):
+
+    def test_kept(self):
+        plugin = FakePlugin()
+        plan = getConversionPlan(plugin, SCHEMA)
+        self.failUnless(getConversionPlan(plugin, SCHEMA) is plan)
+
+    def test_schema_changed(self):
+        plugin = FakePlugin()
+        plan = getConversionPlan(plugin, SCHEMA)
+        other = getConversionPlan(plugin, SCHEMA[:2])
+        self.failIf(other is plan)
+        self.failIf('groups' in other.index)
+
+    def test_metadata_changed(self):
+        plugin = FakePlugin()
+        plan = getConversionPlan(plugin, SCHEMA)
+        plugin.attrs = {}
+        new = getConversionPlan(plugin, SCHEMA)
+        self.failIf(new is plan)
+
+    def test_converters_changed(self):
+        plugin = FakePlugin()
+        plan = getConversionPlan(plugin, SCHEMA)
+        convertersChanged(FakeRegistration(), None)
+        self.failIf(getConversionPlan(plugin, SCHEMA) is plan)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(CompileTests),
+        unittest.makeSuite(GetConversionPlanTests),
+        ])
@@ -0,0 +1,65 @@
+import unittest
+from datetime import datetime
+
+from collective.ploneldapplugin import converters
+
+INFO = ('attr', 'attr', 'lines')
+
+# converter: (ldap values, python values)
+SAMPLES = (
+    (converters.DefaultConverter, ['Jo\xc3\xa9', 'Ann'], [u'Jo\xe9', u'Ann']),
+    (converters.NullConverter, ['a', 'b'], ['a', 'b']),
+    (converters.StringConverter, ['Jo\xc3\xa9', 'Ann'], [u'Jo\xe9', u'Ann']),
+    (converters.IntegerConverter, ['1', '-20'], [1, -20]),
+    (converters.NumericConverter, ['1.5', '-2.25'], [1.5, -2.25]),
+    (converters.BooleanConverter, ['TRUE', 'FALSE'], [True, False]),
+    (converters.DateTimeConverter, ['20100102030405Z'],
+        [datetime(2010, 1, 2, 3, 4, 5)]),
+)
+
+
+class BatchConversionTests(unittest.TestCase):
+
+    def test_from_ldap(self):
+        for factory, ldap_values, python_values in SAMPLES:
+            converter = factory(None)
+            self.assertEqual(converter.fromLDAPValues(ldap_values, INFO),
+                python_values)
+            self.assertEqual(converter.fromLDAPValues(ldap_values, INFO),
+                [converter.fromLDAPValue(value, INFO)
+                 for value in ldap_values])
+
+    def test_to_ldap(self):
+        for factory, ldap_values, python_values in SAMPLES:
+            converter = factory(None)
+            self.assertEqual(converter.toLDAPValues(python_values, INFO),
+                ldap_values)
+            self.assertEqual(converter.toLDAPValues(python_values, INFO),
+                [converter.toLDAPValue(value, INFO)
+                 for value in python_values])
+
+    def test_empty(self):
+        for factory, ldap_values, python_values in SAMPLES:
+            converter = factory(None)
+            self.assertEqual(converter.fromLDAPValues([], INFO), [])
+            self.assertEqual(converter.toLDAPValues([], INFO), [])
+
+    def test_string_mixed_values(self):
+        converter = converters.StringConverter(None)
+        # already decoded values fall back to one by one conversion
+        self.assertEqual(converter.fromLDAPValues([u'Jo\xe9', 'Ann'], INFO),
+            [u'Jo\xe9', u'Ann'])
+        # encoded values are kept as they are
+        self.assertEqual(converter.toLDAPValues([u'Jo\xe9', 'Jo\xc3\xa9'],
+            INFO), ['Jo\xc3\xa9', 'Jo\xc3\xa9'])
+
+    def test_boolean_values(self):
+        converter = converters.BooleanConverter(None)
+        self.assertEqual(converter.toLDAPValues([1, 0, 'yes', ''], INFO),
+            ['TRUE', 'FALSE', 'TRUE', 'FALSE'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(BatchConversionTests),
+        ])
@@ -0,0 +1,62 @@
+import unittest
+
+from Products.PloneLDAP.plugins.ldap import PloneLDAPMultiPlugin
+
+from collective.ploneldapplugin import ldapplugin
+from collective.ploneldapplugin.ldapplugin import EnhancedPloneLDAPMultiPlugin
+
+USERS = [{'id': 'user%d' % index, 'login': 'user%d' % index}
+         for index in range(5)]
+
+
+def enumerateUsers(self, id=None, login=None, exact_match=0, sort_by=None,
+                   max_results=None, **kw):
+    """PloneLDAP enumerateUsers stand-in finding all USERS"""
+    return [dict(info) for info in USERS]
+
+
+class PrefetchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.enumerateUsers = PloneLDAPMultiPlugin.__dict__.get(
+            'enumerateUsers')
+        PloneLDAPMultiPlugin.enumerateUsers = enumerateUsers
+        self.prefetchProperties = ldapplugin.prefetchProperties
+        self.prefetched = []
+        ldapplugin.prefetchProperties = lambda plugin, uids: \
+            self.prefetched.append(uids)
+        self.plugin = EnhancedPloneLDAPMultiPlugin('ldap')
+
+    def tearDown(self):
+        if self.enumerateUsers is None:
+            del PloneLDAPMultiPlugin.enumerateUsers
+        else:
+            PloneLDAPMultiPlugin.enumerateUsers = self.enumerateUsers
+        ldapplugin.prefetchProperties = self.prefetchProperties
+
+    def test_off_by_default(self):
+        self.assertEqual(len(self.plugin.enumerateUsers(login='user')), 5)
+        self.assertEqual(self.prefetched, [])
+
+    def test_prefetched(self):
+        self.plugin.prefetch_enumerated_users = True
+        self.plugin.enumerateUsers(login='user')
+        self.assertEqual(self.prefetched,
+            [[info['id'] for info in USERS]])
+
+    def test_limited_to_chunk(self):
+        self.plugin.prefetch_enumerated_users = True
+        self.plugin.bulk_chunk_size = 2
+        self.plugin.enumerateUsers(login='user')
+        self.assertEqual(self.prefetched, [['user0', 'user1']])
+
+    def test_exact_match(self):
+        self.plugin.prefetch_enumerated_users = True
+        self.plugin.enumerateUsers(login='user0', exact_match=1)
+        self.assertEqual(self.prefetched, [])
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(PrefetchTests),
+        ])
@@ -0,0 +1,132 @@
+import unittest
+from StringIO import StringIO
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from collective.ploneldapplugin import connection, export
+from collective.ploneldapplugin.ldapproperty import compileConversionPlan
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+
+class PageControl(object):
+    """SimplePagedResultsControl stand-in"""
+
+    controlType = export.PAGED_RESULTS_OID
+
+    def __init__(self, criticality=True, size=0, cookie=''):
+        self.size = size
+        self.cookie = cookie
+
+
+class PagedConnection(fakeldap.FakeConnection):
+    """Connection returning directory entries page by page, the cookie is
+    the offset of the next page
+    """
+
+    def __init__(self, directory, stats):
+        fakeldap.FakeConnection.__init__(self, directory, stats)
+        self.searches = []
+
+    def search_ext(self, base, scope, filterstr, attrlist, serverctrls):
+        self.stats.count('search')
+        control = serverctrls[0]
+        self.searches.append((attrlist, control.size))
+        return (control.size, int(control.cookie or 0))
+
+    def result3(self, msgid):
+        size, offset = msgid
+        uids = sorted(self.directory.uids())
+        page = []
+        for uid in uids[offset:offset + size]:
+            dn, attrs = self.directory.get(uid)
+            page.append((dn, dict([(key, list(values))
+                for key, values in attrs.items()])))
+        # referral
+        page.append((None, ['ldap://other.example.com']))
+        cookie = offset + size < len(uids) and str(offset + size) or ''
+        return 101, page, msgid, [PageControl(cookie=cookie)]
+
+
+class ExportPlugin(fakeldap.FakePlugin):
+
+    export_page_size = 2
+
+    def getConversionPlan(self, ldapschema):
+        # default converters only
+        return compileConversionPlan(ldapschema, {})
+
+
+class ExportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = fakeldap.Stats()
+        self.directory = fakeldap.FakeDirectory(5)
+        acl = fakeldap.FakeLDAPUserFolder(self.directory, self.stats)
+        self.plugin = ExportPlugin(acl, self.id())
+        self.connections = []
+        self.initialize = connection.ldap.initialize
+        def initialize(uri):
+            self.connections.append(PagedConnection(self.directory,
+                self.stats))
+            return self.connections[-1]
+        connection.ldap.initialize = initialize
+        self.control = export.SimplePagedResultsControl
+        export.SimplePagedResultsControl = PageControl
+
+    def tearDown(self):
+        connection.ldap.initialize = self.initialize
+        export.SimplePagedResultsControl = self.control
+
+    def test_all_users(self):
+        rows = list(export.exportUsers(self.plugin))
+        self.assertEqual([row['id'] for row in rows],
+            sorted(self.directory.uids()))
+        dn, attrs = self.directory.get(rows[0]['id'])
+        self.assertEqual(rows[0]['dn'], dn)
+        self.assertEqual(rows[0]['fullname'], attrs['cn'][0])
+        self.assertEqual(rows[0]['extensions'],
+            attrs.get('phoneExtension', []))
+
+    def test_paged(self):
+        rows = export.exportUsers(self.plugin)
+        # nothing read before rows are asked for
+        self.assertEqual(self.stats.counts.get('search'), None)
+        rows.next()
+        self.assertEqual(self.stats.counts.get('search'), 1)
+        list(rows)
+        self.assertEqual(self.stats.counts.get('search'), 3)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_page_size(self):
+        list(export.exportUsers(self.plugin, 10))
+        self.assertEqual(self.stats.counts.get('search'), 1)
+        self.assertEqual(self.connections[0].searches[0][1], 10)
+
+    def test_schema_attributes_only(self):
+        list(export.exportUsers(self.plugin))
+        attrs = self.connections[0].searches[0][0]
+        self.failIf('objectClass' in attrs)
+        self.failUnless('uid' in attrs and 'cn' in attrs)
+
+    def test_jsonl(self):
+        out = StringIO()
+        self.assertEqual(export.export(self.plugin, out), 5)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[0]['id'], 'user000000')
+
+    def test_csv(self):
+        out = StringIO()
+        self.assertEqual(export.export(self.plugin, out, 'csv'), 5)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(',')[:2], ['id', 'dn'])
+        self.failUnless(lines[1].startswith('user000000,'))
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(ExportTests),
+        ])
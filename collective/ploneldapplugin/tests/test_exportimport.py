@@ -0,0 +1,135 @@
+import logging
+import unittest
+from xml.dom.minidom import parseString
+
+from collective.ploneldapplugin import exportimport
+
+SERVERS = '''<servers purge="True">
+  <server server="one.example.com" connection_type="0" enabled="True"
+      connection_timeout="5" operation_timeout="-1"/>
+  <server server="two.example.com" connection_type="0" enabled="True"
+      connection_timeout="10" operation_timeout="-1"/>
+</servers>'''
+
+SCHEMA = '''<schema purge="True">
+  <schema-item ldap_name="cn" plone_name="fullname" description="Name"
+      multi_valued="False"/>
+  <schema-item ldap_name="mail" plone_name="email" description="Mail"
+      multi_valued="False"/>
+</schema>'''
+
+
+class Storage(dict):
+    """plone.app.ldap servers and schema storage stand-in"""
+
+    def __init__(self):
+        self.added = 0
+
+    def addItem(self, item):
+        self.added += 1
+        self['item%d' % self.added] = item
+
+
+class Configuration(object):
+
+    def __init__(self):
+        self.servers = Storage()
+        self.schema = Storage()
+
+
+class Environ(object):
+
+    def shouldPurge(self):
+        return False
+
+    def getLogger(self, name):
+        return logging.getLogger(name)
+
+
+class ImportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.configuration = Configuration()
+        self.adapter = exportimport.PloneLDAPSettingsXMLAdapter(
+            self.configuration, Environ())
+        self.adapter.changes = []
+        self.events = []
+        self.notify = exportimport.notify
+        exportimport.notify = lambda event: self.events.append(
+            event.__class__.__name__)
+
+    def tearDown(self):
+        exportimport.notify = self.notify
+
+    def node(self, xml):
+        return parseString('<object>%s</object>' % xml).documentElement
+
+    def server(self, host, timeout=5):
+        server = exportimport.LDAPServer(server=host, connection_type=0,
+            connection_timeout=timeout, operation_timeout=-1, enabled=True)
+        self.configuration.servers.addItem(server)
+        return server
+
+    def schemaItem(self, ldap_name, plone_name, description):
+        item = exportimport.LDAPProperty(ldap_name=ldap_name,
+            plone_name=plone_name, description=description,
+            multi_valued=False)
+        self.configuration.schema.addItem(item)
+        return item
+
+    def test_servers_diff(self):
+        one = self.server('one.example.com')
+        self.server('two.example.com', 5)
+        self.server('old.example.com')
+        self.adapter._initLDAPServers(self.node(SERVERS))
+        servers = self.configuration.servers
+        # unchanged server is kept as it is
+        self.failUnless(servers['item1'] is one)
+        self.assertEqual(servers['item2'].connection_timeout, 10)
+        self.assertEqual(sorted([server.server for server in
+            servers.values()]), ['one.example.com', 'two.example.com'])
+        self.assertEqual(self.adapter.changes, [
+            'server two.example.com:389 modified',
+            'server old.example.com:389 removed'])
+        self.assertEqual(sorted(self.events), ['ObjectModifiedEvent',
+            'ObjectRemovedEvent'])
+
+    def test_servers_unchanged(self):
+        self.server('one.example.com')
+        self.server('two.example.com', 10)
+        self.adapter._initLDAPServers(self.node(SERVERS))
+        self.assertEqual(self.adapter.changes, [])
+        self.assertEqual(self.events, [])
+
+    def test_server_added(self):
+        self.server('one.example.com')
+        self.adapter._initLDAPServers(self.node(SERVERS))
+        self.assertEqual(self.adapter.changes,
+            ['server two.example.com:389 added'])
+        self.assertEqual(self.events, ['ObjectCreatedEvent'])
+
+    def test_schema_diff(self):
+        cn = self.schemaItem('cn', 'fullname', u'Name')
+        self.schemaItem('mail', 'email', u'E-mail')
+        self.schemaItem('ou', 'department', u'Department')
+        self.adapter._initLDAPSchema(self.node(SCHEMA))
+        schema = self.configuration.schema
+        self.failUnless(schema['item1'] is cn)
+        self.assertEqual(schema['item2'].description, u'Mail')
+        self.failIf('item3' in schema)
+        self.assertEqual(self.adapter.changes, [
+            'schema item mail modified', 'schema item ou removed'])
+
+    def test_schema_without_purge(self):
+        self.schemaItem('ou', 'department', u'Department')
+        self.adapter._initLDAPSchema(self.node(SCHEMA.replace('True',
+            'False', 1)))
+        self.assertEqual(len(self.configuration.schema), 3)
+        self.assertEqual(self.adapter.changes, ['schema item cn added',
+            'schema item mail added'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(ImportTests),
+        ])
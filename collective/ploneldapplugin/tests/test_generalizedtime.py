@@ -0,0 +1,94 @@
+import unittest
+from datetime import datetime, date, timedelta, tzinfo
+
+from collective.ploneldapplugin.generalizedtime import parseGeneralizedTime, \
+    formatGeneralizedTime
+
+
+class FixedOffset(tzinfo):
+
+    def __init__(self, minutes):
+        self.offset = timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self.offset
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+class ParseTests(unittest.TestCase):
+
+    def test_common_form(self):
+        self.assertEqual(parseGeneralizedTime('19941216103245Z'),
+            datetime(1994, 12, 16, 10, 32, 45))
+
+    def test_minutes_only(self):
+        self.assertEqual(parseGeneralizedTime('199412161032Z'),
+            datetime(1994, 12, 16, 10, 32))
+
+    def test_hours_only(self):
+        self.assertEqual(parseGeneralizedTime('1994121610Z'),
+            datetime(1994, 12, 16, 10))
+
+    def test_fraction_of_second(self):
+        self.assertEqual(parseGeneralizedTime('19941216103245.5Z'),
+            datetime(1994, 12, 16, 10, 32, 45, 500000))
+        self.assertEqual(parseGeneralizedTime('19941216103245,25Z'),
+            datetime(1994, 12, 16, 10, 32, 45, 250000))
+
+    def test_fraction_of_minute_and_hour(self):
+        self.assertEqual(parseGeneralizedTime('199412161032.5Z'),
+            datetime(1994, 12, 16, 10, 32, 30))
+        self.assertEqual(parseGeneralizedTime('1994121610.25Z'),
+            datetime(1994, 12, 16, 10, 15))
+
+    def test_time_zones(self):
+        # results are in UTC
+        self.assertEqual(parseGeneralizedTime('20100102030405.123-0500'),
+            datetime(2010, 1, 2, 8, 4, 5, 123000))
+        self.assertEqual(parseGeneralizedTime('2010010203+02'),
+            datetime(2010, 1, 2, 1))
+
+    def test_local_time(self):
+        self.assertEqual(parseGeneralizedTime('20100102030405'),
+            datetime(2010, 1, 2, 3, 4, 5))
+
+    def test_leap_second(self):
+        self.assertEqual(parseGeneralizedTime('20081231235960Z'),
+            datetime(2008, 12, 31, 23, 59, 59, 999999))
+
+    def test_invalid(self):
+        for value in ('', 'yesterday', '2010', '20101302030405Z',
+                      '20100102030405X', '20100132030405Z'):
+            self.assertEqual(parseGeneralizedTime(value), None, value)
+
+
+class FormatTests(unittest.TestCase):
+
+    def test_datetime(self):
+        self.assertEqual(formatGeneralizedTime(
+            datetime(1994, 12, 16, 10, 32, 45, 500000)), '19941216103245Z')
+
+    def test_aware_datetime(self):
+        value = datetime(2010, 1, 2, 3, 4, 5, tzinfo=FixedOffset(-300))
+        self.assertEqual(formatGeneralizedTime(value), '20100102080405Z')
+
+    def test_date(self):
+        self.assertEqual(formatGeneralizedTime(date(2010, 1, 2)),
+            '20100102000000Z')
+
+    def test_round_trip(self):
+        value = datetime(2001, 2, 3, 4, 5, 6)
+        self.assertEqual(
+            parseGeneralizedTime(formatGeneralizedTime(value)), value)
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, formatGeneralizedTime, '20100102Z')
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(ParseTests),
+        unittest.makeSuite(FormatTests),
+        ])
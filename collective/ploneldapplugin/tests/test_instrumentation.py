@@ -0,0 +1,167 @@
+import unittest
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from collective.ploneldapplugin import instrumentation
+from collective.ploneldapplugin.ldapplugin import EnhancedPloneLDAPMultiPlugin
+
+
+class Plugin(EnhancedPloneLDAPMultiPlugin):
+    """Plugin not placed in acl_users"""
+
+    id = 'ldap-metrics'
+
+    def getPhysicalPath(self):
+        return ('', 'acl_users', self.id)
+
+    def absolute_url(self):
+        return 'http://nohost/acl_users/%s' % self.id
+
+
+class FakeResponse(object):
+
+    def __init__(self):
+        self.headers = {}
+
+    def setHeader(self, name, value):
+        self.headers[name] = value
+
+    def redirect(self, url):
+        return url
+
+
+class FakeRequest(dict):
+
+    def __init__(self):
+        self.RESPONSE = self['RESPONSE'] = FakeResponse()
+
+
+class TimerTests(unittest.TestCase):
+
+    def test_statistics(self):
+        timer = instrumentation.Timer()
+        for elapsed in (0.002, 0.004, 0.0003):
+            timer.add(elapsed)
+        info = timer.info()
+        self.assertEqual(info['count'], 3)
+        self.assertAlmostEqual(info['total_ms'], 6.3)
+        self.assertAlmostEqual(info['mean_ms'], 2.1)
+        self.assertAlmostEqual(info['min_ms'], 0.3)
+        self.assertAlmostEqual(info['max_ms'], 4.0)
+
+    def test_histogram(self):
+        timer = instrumentation.Timer()
+        for elapsed in (0.00005, 0.002, 0.004, 10):
+            timer.add(elapsed)
+        histogram = dict([(bound, count) for bound, count in
+            timer.info()['histogram']])
+        self.assertEqual(histogram[0.1], 1)
+        self.assertEqual(histogram[5], 2)
+        # slower than the last bucket
+        self.assertEqual(histogram[None], 1)
+        self.assertEqual(sum(histogram.values()), 4)
+
+    def test_empty(self):
+        info = instrumentation.Timer().info()
+        self.assertEqual((info['count'], info['mean_ms'], info['min_ms']),
+            (0, 0.0, 0.0))
+
+
+class RecorderTests(unittest.TestCase):
+
+    def test_info(self):
+        recorder = instrumentation.Recorder()
+        recorder.count('expire')
+        recorder.count('expire', 2)
+        recorder.hit('schema')
+        recorder.hit('schema')
+        recorder.miss('schema')
+        recorder.record('ldap', 'search', 0.001)
+        info = recorder.info()
+        self.assertEqual(info['counters'], {'expire': 3})
+        self.assertEqual(info['caches']['schema']['hits'], 2)
+        self.assertEqual(info['caches']['schema']['misses'], 1)
+        self.assertAlmostEqual(info['caches']['schema']['ratio'], 2 / 3.0)
+        self.assertEqual(info['timers']['ldap']['search']['count'], 1)
+        # plain python types only
+        json.dumps(info)
+
+    def test_reset(self):
+        recorder = instrumentation.Recorder()
+        recorder.count('expire')
+        recorder.reset()
+        info = recorder.info()
+        self.assertEqual((info['counters'], info['timers'], info['caches']),
+            ({}, {}, {}))
+
+    def test_timed(self):
+        recorder = instrumentation.Recorder()
+        self.assertEqual(instrumentation.timed(recorder, 'ldap', 'search',
+            lambda value: value, 'found'), 'found')
+        self.assertEqual(instrumentation.timed(None, 'ldap', 'search',
+            lambda: 'found'), 'found')
+        def fail():
+            raise ValueError
+        self.assertRaises(ValueError, instrumentation.timed, recorder,
+            'ldap', 'search', fail)
+        # failed calls are timed too
+        self.assertEqual(recorder.info()['timers']['ldap']['search']['count'],
+            2)
+
+
+class MetricsViewTests(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = Plugin('ldap-metrics')
+        instrumentation._recorders.pop(
+            instrumentation.getCacheKey(self.plugin), None)
+
+    def tearDown(self):
+        instrumentation._recorders.pop(
+            instrumentation.getCacheKey(self.plugin), None)
+
+    def test_off(self):
+        self.assertEqual(instrumentation.getRecorder(self.plugin), None)
+        self.assertEqual(self.plugin.getMetrics()['counters'], {})
+
+    def test_recording(self):
+        request = FakeRequest()
+        self.assertEqual(self.plugin.manage_setRecording(True, request),
+            'http://nohost/acl_users/ldap-metrics/manage_metrics?'
+            'manage_tabs_message=Recording+started')
+        recorder = instrumentation.getRecorder(self.plugin)
+        self.failUnless(instrumentation.getRecorder(self.plugin) is recorder)
+        recorder.count('expire')
+        self.assertEqual(self.plugin.getMetrics()['counters'],
+            {'expire': 1})
+        self.plugin.manage_setRecording(False)
+        self.assertEqual(instrumentation.getRecorder(self.plugin), None)
+        # metrics recorded so far are still shown
+        self.assertEqual(self.plugin.getMetrics()['counters'],
+            {'expire': 1})
+
+    def test_json(self):
+        self.plugin.manage_setRecording(True)
+        instrumentation.getRecorder(self.plugin).miss('schema')
+        request = FakeRequest()
+        data = json.loads(self.plugin.manage_metricsJSON(request))
+        self.assertEqual(data['caches']['schema']['misses'], 1)
+        self.assertEqual(request.RESPONSE.headers['Content-Type'],
+            'application/json')
+
+    def test_reset(self):
+        self.plugin.manage_setRecording(True)
+        instrumentation.getRecorder(self.plugin).count('expire')
+        self.plugin.manage_resetMetrics()
+        self.assertEqual(self.plugin.getMetrics()['counters'], {})
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(TimerTests),
+        unittest.makeSuite(RecorderTests),
+        unittest.makeSuite(MetricsViewTests),
+        ])
@@ -0,0 +1,135 @@
+import unittest
+
+from collective.ploneldapplugin import connection
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+
+class SheetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = fakeldap.Stats()
+        self.directory = fakeldap.FakeDirectory(3)
+        acl = fakeldap.FakeLDAPUserFolder(self.directory, self.stats)
+        self.plugin = fakeldap.CachingPlugin(acl, self.id())
+        self.uid = sorted(self.directory.uids())[0]
+        self.user = fakeldap.FakeUser(self.uid)
+
+    def entry(self):
+        return self.directory.get(self.uid)[1]
+
+    def makeSheet(self):
+        return fakeldap.BenchPropertySheet(self.plugin, self.user)
+
+
+class LazyConversionTests(SheetTestCase):
+
+    def setUp(self):
+        SheetTestCase.setUp(self)
+        self.plugin.lazy_conversion = True
+
+    def test_converted_on_access(self):
+        sheet = self.makeSheet()
+        self.failUnless('department' in sheet._pending)
+        self.assertEqual(sheet.getProperty('department'),
+            self.entry()['ou'][0])
+        self.failIf('department' in sheet._pending)
+
+    def test_property_items_convert_all(self):
+        sheet = self.makeSheet()
+        items = dict(sheet.propertyItems())
+        self.assertEqual(items['email'], self.entry()['mail'][0])
+        self.assertEqual(sheet._pending, {})
+
+    def test_cache_keeps_raw_values(self):
+        self.makeSheet()
+        cached = self.plugin.cache.values()
+        self.assertEqual(len(cached), 1)
+        self.assertEqual(cached[0][1]['ou'], self.entry()['ou'][0])
+
+    def test_sheet_from_cache(self):
+        first = self.makeSheet()
+        self.stats.reset()
+        second = self.makeSheet()
+        self.assertEqual(self.stats.counts.get('search'), None)
+        # pending values of the first sheet are not shared
+        self.assertEqual(second.getProperty('department'),
+            self.entry()['ou'][0])
+        self.assertEqual(second.getProperty('email'),
+            self.entry()['mail'][0])
+        self.assertEqual(first.getProperty('department'),
+            self.entry()['ou'][0])
+
+    def test_cache_dropped_after_write(self):
+        sheet = self.makeSheet()
+        sheet.setProperties(self.user, {'department': 'Legal'})
+        self.assertEqual(self.plugin.cache, {})
+        self.assertEqual(self.makeSheet().getProperty('department'),
+            'Legal')
+
+
+class HeavyAttributeTests(SheetTestCase):
+
+    def setUp(self):
+        SheetTestCase.setUp(self)
+        self.plugin.projected_reads = True
+        self.plugin.heavy_attributes = ('mailAlias',)
+        # user with mail aliases
+        self.uid = [uid for uid in sorted(self.directory.uids())
+            if 'mailAlias' in self.directory.get(uid)[1]][0]
+        self.user = fakeldap.FakeUser(self.uid)
+        # lazy reads open connections of their own
+        self.initialize = connection.ldap.initialize
+        directory, stats = self.directory, self.stats
+        connection.ldap.initialize = lambda uri: \
+            fakeldap.FakeConnection(directory, stats)
+
+    def tearDown(self):
+        connection.ldap.initialize = self.initialize
+
+    def test_read_on_access(self):
+        sheet = self.makeSheet()
+        self.failUnless('mail_aliases' in sheet._lazy)
+        self.stats.reset()
+        self.assertEqual(sheet.getProperty('fullname'),
+            self.entry()['cn'][0])
+        self.assertEqual(self.stats.counts.get('search'), None)
+        self.assertEqual(sheet.getProperty('mail_aliases'),
+            self.entry()['mailAlias'])
+        self.assertEqual(self.stats.counts.get('search'), 1)
+        self.failIf('mail_aliases' in sheet._lazy)
+
+    def test_sheet_from_cache(self):
+        self.makeSheet().getProperty('mail_aliases')
+        created, cached = self.plugin.cache.values()[0]
+        self.failIf('mailAlias' in cached)
+        sheet = self.makeSheet()
+        self.assertEqual(sheet.getProperty('mail_aliases'),
+            self.entry()['mailAlias'])
+
+    def test_missing_value(self):
+        self.directory.get(self.uid)[1].pop('mailAlias')
+        sheet = self.makeSheet()
+        self.assertEqual(sheet.getProperty('mail_aliases'), [])
+        self.failIf('mail_aliases' in sheet._lazy)
+
+    def test_loaded_items(self):
+        sheet = self.makeSheet()
+        self.failIf('mail_aliases' in dict(sheet.loadedPropertyItems()))
+        sheet.getProperty('mail_aliases')
+        self.failUnless('mail_aliases' in dict(sheet.loadedPropertyItems()))
+
+    def test_set_properties_for_user(self):
+        sheet = self.makeSheet()
+        self.stats.reset()
+        self.plugin.setPropertiesForUser(self.user, sheet)
+        # nothing read or written
+        self.assertEqual(self.stats.counts.get('search'), None)
+        self.assertEqual(self.stats.counts.get('modify'), None)
+        self.failUnless('mail_aliases' in sheet._lazy)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(LazyConversionTests),
+        unittest.makeSuite(HeavyAttributeTests),
+        ])
@@ -0,0 +1,111 @@
+import time
+import unittest
+
+from collective.ploneldapplugin.negativecache import NegativeCache, \
+    getNegativeCache, isAbsentUser, addAbsentUser, forgetAbsentUser
+
+
+class FakePlugin(object):
+
+    negative_cache_size = 10
+    negative_cache_ttl = 300
+
+    def __init__(self, path):
+        self.path = path
+
+    def getPhysicalPath(self):
+        return self.path
+
+
+class NegativeCacheTests(unittest.TestCase):
+
+    def test_add(self):
+        cache = NegativeCache()
+        self.failIf('joe' in cache)
+        cache.add('joe')
+        self.failUnless('joe' in cache)
+        self.failIf('ann' in cache)
+
+    def test_discard(self):
+        cache = NegativeCache()
+        cache.add('joe')
+        cache.discard('joe')
+        self.failIf('joe' in cache)
+        cache.discard('ann')
+
+    def test_expired(self):
+        cache = NegativeCache(ttl=-1)
+        cache.add('joe')
+        self.failIf('joe' in cache)
+
+    def test_expired_pruned(self):
+        cache = NegativeCache(ttl=0.01)
+        cache.add('joe')
+        time.sleep(0.02)
+        cache.add('ann')
+        self.assertEqual(len(cache), 1)
+
+    def test_oldest_evicted(self):
+        cache = NegativeCache(size=3)
+        for uid in ('u1', 'u2', 'u3', 'u4'):
+            cache.add(uid)
+        self.assertEqual(len(cache), 3)
+        self.failIf('u1' in cache)
+        self.failUnless('u4' in cache)
+
+    def test_added_again(self):
+        cache = NegativeCache(size=2)
+        cache.add('u1')
+        cache.add('u2')
+        # newer entry of u1 outlives its first one
+        cache.add('u1')
+        cache.add('u3')
+        self.failUnless('u1' in cache)
+        self.failIf('u2' in cache)
+
+    def test_order_bounded(self):
+        cache = NegativeCache(size=2)
+        for i in range(100):
+            cache.add('joe')
+        self.failUnless(len(cache._order) <= 4)
+        self.failUnless('joe' in cache)
+
+    def test_clear(self):
+        cache = NegativeCache()
+        cache.add('joe')
+        cache.clear()
+        self.failIf('joe' in cache)
+        self.assertEqual(len(cache), 0)
+
+
+class PluginCacheTests(unittest.TestCase):
+
+    def test_off(self):
+        plugin = FakePlugin(('', 'off'))
+        plugin.negative_cache_size = 0
+        self.assertEqual(getNegativeCache(plugin), None)
+        addAbsentUser(plugin, 'joe')
+        self.failIf(isAbsentUser(plugin, 'joe'))
+
+    def test_absent(self):
+        plugin = FakePlugin(('', 'absent'))
+        addAbsentUser(plugin, 'joe')
+        self.failUnless(isAbsentUser(plugin, 'joe'))
+        self.failIf(isAbsentUser(FakePlugin(('', 'other')), 'joe'))
+        forgetAbsentUser(plugin, 'joe')
+        self.failIf(isAbsentUser(plugin, 'joe'))
+
+    def test_settings_followed(self):
+        plugin = FakePlugin(('', 'settings'))
+        plugin.negative_cache_size = 5
+        plugin.negative_cache_ttl = 60
+        cache = getNegativeCache(plugin)
+        self.assertEqual((cache.size, cache.ttl), (5, 60))
+        self.failUnless(getNegativeCache(plugin) is cache)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(NegativeCacheTests),
+        unittest.makeSuite(PluginCacheTests),
+        ])
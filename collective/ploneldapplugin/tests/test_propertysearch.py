@@ -0,0 +1,130 @@
+import unittest
+
+from collective.ploneldapplugin.propertysearch import searchProperties, \
+    getAttribute
+
+QUERY = {
+    'base': 'ou=people,dc=example,dc=com',
+    'scope': 2,
+    'uid_attr': 'uid',
+    'objclasses': '(objectClass=person)',
+    'attrs': ['uid', 'cn', 'mail'],
+    'multivalued': {'mail': True},
+}
+
+
+class FakeSearch(object):
+    """LDAPDelegate.search stand-in matching user ids case insensitively"""
+
+    def __init__(self, entries, exception=''):
+        self.entries = entries
+        self.exception = exception
+        self.calls = []
+
+    def __call__(self, base, scope, filter, attrs):
+        self.calls.append((base, scope, filter))
+        if self.exception:
+            return {'exception': self.exception, 'size': 0, 'results': []}
+        results = []
+        for entry in self.entries:
+            if scope == 0:
+                found = entry['dn'] == base
+            else:
+                found = ('(uid=%s)' % entry['uid'][0]).lower() in \
+                    filter.lower()
+            if found:
+                results.append(dict(entry))
+        return {'exception': '', 'size': len(results), 'results': results}
+
+def entry(uid, cn=None, mail=()):
+    return {'dn': 'uid=%s,ou=people,dc=example,dc=com' % uid, 'uid': [uid],
+            'cn': [cn or uid.title()], 'mail': list(mail)}
+
+
+class SearchPropertiesTests(unittest.TestCase):
+
+    def test_chunks(self):
+        search = FakeSearch([entry('u%d' % i) for i in range(5)])
+        result = searchProperties(search, QUERY,
+            ['u%d' % i for i in range(5)], size=2)
+        self.assertEqual(len(search.calls), 3)
+        self.assertEqual(sorted(result.keys()),
+            ['u0', 'u1', 'u2', 'u3', 'u4'])
+
+    def test_values(self):
+        search = FakeSearch([entry('joe', 'Joe Doe', ['a@x', 'b@x'])])
+        properties = searchProperties(search, QUERY, ['joe'])['joe']
+        # single valued attributes are unwrapped, multivalued kept
+        self.assertEqual(properties['cn'], 'Joe Doe')
+        self.assertEqual(properties['mail'], ['a@x', 'b@x'])
+        self.assertEqual(properties['dn'],
+            'uid=joe,ou=people,dc=example,dc=com')
+
+    def test_duplicate_ids_searched_once(self):
+        search = FakeSearch([entry('joe')])
+        searchProperties(search, QUERY, ['joe', 'joe'])
+        self.assertEqual(search.calls[0][2].count('(uid=joe)'), 1)
+
+    def test_ids_differing_in_case(self):
+        search = FakeSearch([entry('Joe', 'Upper'), entry('joe', 'Lower')])
+        result = searchProperties(search, QUERY, ['Joe', 'joe'])
+        self.assertEqual(result['Joe']['cn'], 'Upper')
+        self.assertEqual(result['joe']['cn'], 'Lower')
+
+    def test_case_insensitive_fallback(self):
+        search = FakeSearch([entry('joe')])
+        result = searchProperties(search, QUERY, ['JOE'])
+        self.assertEqual(result.keys(), ['JOE'])
+
+    def test_ambiguous_fallback(self):
+        search = FakeSearch([entry('joe')])
+        result = searchProperties(search, QUERY, ['JOE', 'Joe'])
+        self.assertEqual(result, {})
+
+    def test_failed_search(self):
+        search = FakeSearch([entry('joe')], exception='Server down')
+        self.assertEqual(searchProperties(search, QUERY, ['joe']), {})
+
+    def test_failed_ids(self):
+        search = FakeSearch([entry('joe')], exception='Server down')
+        failed = []
+        searchProperties(search, QUERY, ['joe', 'ann', 'bob'], size=2,
+            failed=failed)
+        self.assertEqual(failed, ['joe', 'ann', 'bob'])
+
+    def test_missing_ids_not_failed(self):
+        search = FakeSearch([entry('joe')])
+        failed = []
+        result = searchProperties(search, QUERY, ['joe', 'ann'],
+            failed=failed)
+        self.assertEqual(result.keys(), ['joe'])
+        self.assertEqual(failed, [])
+
+    def test_dn_ids(self):
+        query = dict(QUERY, uid_attr='dn')
+        joe = entry('joe')
+        search = FakeSearch([joe, entry('ann')])
+        result = searchProperties(search, query, [joe['dn'], 'uid=x'])
+        self.assertEqual(result.keys(), [joe['dn']])
+        self.assertEqual([call[1] for call in search.calls], [0, 0])
+
+    def test_no_ids(self):
+        search = FakeSearch([])
+        self.assertEqual(searchProperties(search, QUERY, []), {})
+        self.assertEqual(search.calls, [])
+
+
+class GetAttributeTests(unittest.TestCase):
+
+    def test_case(self):
+        properties = {'jpegPhoto': 'data'}
+        self.assertEqual(getAttribute(properties, 'jpegPhoto'), 'data')
+        self.assertEqual(getAttribute(properties, 'JPEGPHOTO'), 'data')
+        self.assertEqual(getAttribute(properties, 'cn'), None)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(SearchPropertiesTests),
+        unittest.makeSuite(GetAttributeTests),
+        ])
@@ -0,0 +1,221 @@
+import re
+import unittest
+
+import ldap
+
+from collective.ploneldapplugin import connection
+from collective.ploneldapplugin.benchmarks import fakeldap
+from collective.ploneldapplugin.ldapproperty import compileConversionPlan
+from collective.ploneldapplugin.provisioning import buildUserEntry, \
+    getUserId, addUsers, importGroups
+
+GROUPS_BASE = 'ou=groups,dc=example,dc=com'
+CN_FILTER = re.compile(r'\(cn=([^)]*)\)')
+
+SCHEMA = [
+    ('cn', 'fullname', 'string'),
+    ('mail', 'email', 'string'),
+    ('uid', 'userid', 'string'),
+]
+
+
+class FakeLDAPUserFolder(object):
+
+    _uid_attr = 'uid'
+    _login_attr = 'mail'
+    _rdnattr = 'uid'
+    _user_objclasses = ['top', 'person']
+    _pwd_encryption = 'clear'
+    users_base = 'ou=people,dc=example,dc=com'
+
+
+class GroupConnection(fakeldap.FakeConnection):
+    """Connection to fake directory with groups {dn: {ldapname: values}}"""
+
+    def __init__(self, directory, stats, groups):
+        fakeldap.FakeConnection.__init__(self, directory, stats)
+        self.groups = groups
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)',
+                 attrlist=None):
+        if base != GROUPS_BASE:
+            return fakeldap.FakeConnection.search_s(self, base, scope,
+                filterstr, attrlist)
+        self.stats.count('search')
+        cns = [cn.lower() for cn in CN_FILTER.findall(filterstr)]
+        return [(dn, dict(attrs)) for dn, attrs in self.groups.items()
+            if attrs['cn'][0].lower() in cns]
+
+    def add(self, dn, modlist):
+        self.stats.count('add')
+        self.groups[dn] = dict(modlist)
+        return 0
+
+    def modify(self, dn, mod_list):
+        self.stats.count('modify')
+        for op, name, values in mod_list:
+            self.groups[dn].setdefault(name, []).extend(values)
+        return 0
+
+
+class BuildUserEntryTests(unittest.TestCase):
+
+    def build(self, acl, login, properties):
+        dn, attrs = buildUserEntry(acl, compileConversionPlan(SCHEMA, {}),
+            login, 'secret', properties)
+        return dn, dict(attrs)
+
+    def test_login_fills_naming_attributes(self):
+        dn, attrs = self.build(FakeLDAPUserFolder(), 'joe',
+            {'fullname': u'Jo\xe9'})
+        self.assertEqual(dn, 'uid=joe,ou=people,dc=example,dc=com')
+        self.assertEqual(attrs['uid'], ['joe'])
+        self.assertEqual(attrs['mail'], ['joe'])
+        self.assertEqual(attrs['cn'], ['Jo\xc3\xa9'])
+        self.assertEqual(attrs['objectClass'], ['top', 'person'])
+
+    def test_record_values_kept(self):
+        dn, attrs = self.build(FakeLDAPUserFolder(), 'joe',
+            {'email': 'joe@example.com', 'userid': 'j.doe'})
+        self.assertEqual(attrs['mail'], ['joe@example.com'])
+        self.assertEqual(attrs['uid'], ['j.doe'])
+        self.assertEqual(dn, 'uid=j.doe,ou=people,dc=example,dc=com')
+
+    def test_dn_from_record_rdn(self):
+        acl = FakeLDAPUserFolder()
+        acl._rdnattr = 'cn'
+        dn, attrs = self.build(acl, 'joe', {'fullname': 'Doe, Joe'})
+        self.assertEqual(dn, 'cn=Doe\\, Joe,ou=people,dc=example,dc=com')
+        self.assertEqual(attrs['cn'], ['Doe, Joe'])
+
+    def test_user_id(self):
+        acl = FakeLDAPUserFolder()
+        dn, attrs = buildUserEntry(acl, compileConversionPlan(SCHEMA, {}),
+            'joe', 'secret', {'userid': 'j.doe'})
+        self.assertEqual(getUserId(acl, dn, attrs), 'j.doe')
+        acl._uid_attr = 'dn'
+        self.assertEqual(getUserId(acl, dn, attrs), dn)
+
+
+class AddUsersTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = fakeldap.Stats()
+        self.directory = fakeldap.FakeDirectory(3)
+        self.acl = fakeldap.FakeLDAPUserFolder(self.directory, self.stats)
+        self.plugin = fakeldap.FakePlugin(self.acl, self.id())
+        self.initialize = connection.ldap.initialize
+        directory, stats = self.directory, self.stats
+        connection.ldap.initialize = lambda uri: \
+            fakeldap.FakeConnection(directory, stats)
+
+    def tearDown(self):
+        connection.ldap.initialize = self.initialize
+
+    def add(self, logins, roles=()):
+        return addUsers(self.plugin, [(login, 'secret', {'surname': login})
+            for login in logins], roles=roles)
+
+    def test_added(self):
+        results = self.add(['joe', 'user000000'])
+        self.assertEqual([result['ok'] for result in results],
+            [True, False])
+        self.failUnless(self.directory.get('joe'))
+        self.assertEqual(self.stats.counts.get('clear'), 1)
+
+    def test_nothing_added(self):
+        self.add(['user000000'])
+        self.assertEqual(self.stats.counts.get('clear'), None)
+
+    def test_local_roles(self):
+        self.acl._local_groups = True
+        results = self.add(['joe', 'user000000'], ['Member'])
+        self.assertEqual(self.acl._groups_store,
+            {results[0]['dn']: ['Member']})
+        self.assertEqual(self.acl.edited_roles, {})
+
+    def test_ldap_group_roles(self):
+        results = self.add(['joe'], ['Member'])
+        self.assertEqual(self.acl.edited_roles,
+            {results[0]['dn']: ['Member']})
+        self.assertEqual(self.acl._groups_store, {})
+
+    def test_no_roles(self):
+        self.acl._local_groups = True
+        self.add(['joe'])
+        self.assertEqual(self.acl._groups_store, {})
+
+
+class ImportGroupsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = fakeldap.Stats()
+        self.directory = fakeldap.FakeDirectory(3)
+        self.acl = fakeldap.FakeLDAPUserFolder(self.directory, self.stats)
+        self.acl.groups_base = GROUPS_BASE
+        self.acl.groups_scope = ldap.SCOPE_SUBTREE
+        self.plugin = fakeldap.FakePlugin(self.acl, self.id())
+        self.staff = 'cn=staff,%s' % GROUPS_BASE
+        self.groups = {self.staff: {'cn': ['staff'],
+            'objectClass': ['top', 'groupOfUniqueNames'],
+            'uniqueMember': [self.dn('user000000')]}}
+        self.initialize = connection.ldap.initialize
+        directory, stats, groups = self.directory, self.stats, self.groups
+        connection.ldap.initialize = lambda uri: \
+            GroupConnection(directory, stats, groups)
+
+    def tearDown(self):
+        connection.ldap.initialize = self.initialize
+
+    def dn(self, uid):
+        return self.directory.get(uid)[0]
+
+    def test_dry_run(self):
+        results = importGroups(self.plugin, [
+            ('staff', ['user000000', 'user000001']),
+            ('admins', ['user000002', 'nobody'])], dry_run=True)
+        self.assertEqual([(result['group'], result['action'], result['ok'])
+            for result in results], [('staff', 'modify', True),
+            ('admins', 'add', True)])
+        self.assertEqual(results[0]['members'], [self.dn('user000001')])
+        self.assertEqual(results[1]['dn'], 'cn=admins,%s' % GROUPS_BASE)
+        self.assertEqual(results[1]['members'], [self.dn('user000002')])
+        self.assertEqual(results[1]['unknown'], ['nobody'])
+        # nothing written, no caches dropped
+        self.assertEqual(self.stats.counts.get('add'), None)
+        self.assertEqual(self.stats.counts.get('modify'), None)
+        self.assertEqual(self.stats.counts.get('invalidate'), None)
+        self.assertEqual(self.groups.keys(), [self.staff])
+
+    def test_import(self):
+        results = importGroups(self.plugin, [
+            ('staff', ['user000000', 'user000001']),
+            ('admins', ['user000002'])])
+        self.failUnless(results[0]['ok'] and results[1]['ok'])
+        self.assertEqual(self.groups[self.staff]['uniqueMember'],
+            [self.dn('user000000'), self.dn('user000001')])
+        self.assertEqual(self.groups['cn=admins,%s' % GROUPS_BASE][
+            'uniqueMember'], [self.dn('user000002')])
+        self.assertEqual(self.stats.counts.get('invalidate'), 2)
+
+    def test_unchanged(self):
+        results = importGroups(self.plugin, [('Staff', ['USER000000'])])
+        self.assertEqual((results[0]['action'], results[0]['ok']),
+            ('unchanged', True))
+        self.assertEqual(self.stats.counts.get('modify'), None)
+        self.assertEqual(self.stats.counts.get('invalidate'), None)
+
+    def test_repeated_groups_merged(self):
+        results = importGroups(self.plugin, [('staff', ['user000001']),
+            ('STAFF', ['user000002'])], dry_run=True)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['members'], [self.dn('user000001'),
+            self.dn('user000002')])
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(BuildUserEntryTests),
+        unittest.makeSuite(AddUsersTests),
+        unittest.makeSuite(ImportGroupsTests),
+        ])
@@ -0,0 +1,133 @@
+import unittest
+
+from collective.ploneldapplugin import requestcache
+from collective.ploneldapplugin.ldapproperty import forgetPropertySheet, \
+    getPropertySheet, cachePropertySheets, getCachedPropertySheets
+from collective.ploneldapplugin.patches import setMemberProperties
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.annotations = {}
+
+
+class UserFolder(object):
+    """acl_users holding a plugin, sheets look their plugin up in it"""
+
+    def __init__(self, plugin):
+        setattr(self, plugin.getId(), plugin)
+
+
+class FakeMember(object):
+
+    def __init__(self, user, request):
+        self.user = user
+        self.REQUEST = request
+        self.written = []
+
+    def getUser(self):
+        return self.user
+
+    def _old_setMemberProperties(self, mapping, force_local=0):
+        self.written.append(mapping)
+
+
+class RequestCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # requests are annotatable in Zope, plain objects here
+        self.IAnnotations = requestcache.IAnnotations
+        requestcache.IAnnotations = lambda request: request.annotations
+        self.request = FakeRequest()
+        self.stats = fakeldap.Stats()
+        self.directory = fakeldap.FakeDirectory(3)
+        acl = fakeldap.FakeLDAPUserFolder(self.directory, self.stats)
+        self.plugin = fakeldap.CachingPlugin(acl, self.id())
+        self.plugin.REQUEST = self.request
+        self.uid = sorted(self.directory.uids())[0]
+        self.user = fakeldap.FakeUser(self.uid)
+
+    def tearDown(self):
+        requestcache.IAnnotations = self.IAnnotations
+
+    def cache(self):
+        return requestcache.getRequestCache(self.plugin)
+
+
+class MemberSheetsTests(RequestCacheTestCase):
+
+    def setUp(self):
+        RequestCacheTestCase.setUp(self)
+        self.key = requestcache.getMemberSheetsKey(self.uid)
+        self.cache()[self.key] = ([], {})
+
+    def test_forget_property_sheet(self):
+        forgetPropertySheet(self.plugin, self.user)
+        self.failIf(self.key in self.cache())
+
+    def test_sheet_write(self):
+        sheet = fakeldap.BenchPropertySheet(self.plugin, self.user)
+        sheet.setProperties(self.user, {'department': 'Legal'})
+        self.failIf(self.key in self.cache())
+
+    def test_set_member_properties(self):
+        member = FakeMember(self.user, self.request)
+        setMemberProperties(member, {'email': 'joe@example.com'})
+        self.assertEqual(member.written, [{'email': 'joe@example.com'}])
+        self.failIf(self.key in self.cache())
+
+    def test_other_members_kept(self):
+        other = requestcache.getMemberSheetsKey('other')
+        self.cache()[other] = ([], {})
+        forgetPropertySheet(self.plugin, self.user)
+        self.failUnless(other in self.cache())
+
+
+class SheetMemoTests(RequestCacheTestCase):
+
+    def setUp(self):
+        RequestCacheTestCase.setUp(self)
+        self.plugin.cache_sheets_per_request = True
+        self.user.acl_users = UserFolder(self.plugin)
+
+    def test_memoized(self):
+        sheet = getPropertySheet(self.plugin, self.user)
+        self.stats.reset()
+        self.failUnless(getPropertySheet(self.plugin, self.user) is sheet)
+        self.assertEqual(self.stats.total(), 0)
+
+    def test_off(self):
+        self.plugin.cache_sheets_per_request = False
+        sheet = getPropertySheet(self.plugin, self.user)
+        self.failIf(getPropertySheet(self.plugin, self.user) is sheet)
+
+    def test_no_request(self):
+        del self.plugin.REQUEST
+        sheet = getPropertySheet(self.plugin, self.user)
+        self.failIf(getPropertySheet(self.plugin, self.user) is sheet)
+
+    def test_other_request(self):
+        sheet = getPropertySheet(self.plugin, self.user)
+        self.failIf(getPropertySheet(self.plugin, self.user,
+            FakeRequest()) is sheet)
+
+    def test_forgotten(self):
+        sheet = getPropertySheet(self.plugin, self.user)
+        forgetPropertySheet(self.plugin, self.user)
+        self.failIf(getPropertySheet(self.plugin, self.user) is sheet)
+
+    def test_bulk_sheets(self):
+        sheet = getPropertySheet(self.plugin, self.user)
+        cachePropertySheets(self.plugin, {'other': None})
+        self.assertEqual(getCachedPropertySheets(self.plugin,
+            [self.uid, 'other', 'unknown']), {self.uid: sheet,
+            'other': None})
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(MemberSheetsTests),
+        unittest.makeSuite(SheetMemoTests),
+        ])
@@ -0,0 +1,66 @@
+import unittest
+import threading
+
+from collective.ploneldapplugin.schemacache import SchemaCache
+
+
+class SchemaCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SchemaCache()
+        self.calls = []
+
+    def compute(self, value):
+        def compute():
+            self.calls.append(value)
+            return value
+        return compute
+
+    def test_cached(self):
+        self.assertEqual(self.cache.lookup('a', self.compute({'x': 1}), 60),
+            {'x': 1})
+        self.assertEqual(self.cache.lookup('a', self.compute({'x': 2}), 60),
+            {'x': 1})
+        self.assertEqual(self.calls, [{'x': 1}])
+
+    def test_empty_cached(self):
+        self.assertEqual(self.cache.lookup('a', self.compute({}), 3600), {})
+        self.assertEqual(self.cache.lookup('a', self.compute({'x': 1}),
+            3600), {})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_empty_expires_sooner(self):
+        self.cache.lookup('a', self.compute({}), 3600, empty_ttl=-1)
+        self.assertEqual(self.cache.lookup('a', self.compute({'x': 1}),
+            3600), {'x': 1})
+
+    def test_keys_filled_independently(self):
+        # computing one key doesn't hold up the others
+        started = threading.Event()
+        release = threading.Event()
+        def slow():
+            started.set()
+            release.wait(5)
+            return {'slow': 1}
+        thread = threading.Thread(target=lambda:
+            self.cache.lookup('slow', slow, 60))
+        thread.start()
+        try:
+            started.wait(5)
+            self.assertEqual(self.cache.lookup('fast',
+                self.compute({'fast': 1}), 60), {'fast': 1})
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(self.cache.get('slow'), {'slow': 1})
+
+    def test_invalidate(self):
+        self.cache.lookup('a', self.compute({'x': 1}), 60)
+        self.cache.invalidate('a')
+        self.assertEqual(self.cache.get('a'), None)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(SchemaCacheTests),
+        ])
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from collective.ploneldapplugin import schemacache, schemasnapshot
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+TABLE = {
+    '2.5.4.3': ('1.3.6.1.4.1.1466.115.121.1.15', False, ('cn', 'commonName'),
+        "( 2.5.4.3 NAME ( 'cn' 'commonName' ) "
+        "SYNTAX 1.3.6.1.4.1.1466.115.121.1.15 )"),
+}
+
+
+class SnapshotTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class SnapshotTests(SnapshotTestCase):
+
+    def test_round_trip(self):
+        schemasnapshot.saveSnapshot(self.directory, 'key', '20100101000000Z',
+            TABLE)
+        self.assertEqual(schemasnapshot.loadSnapshot(self.directory, 'key'),
+            ('20100101000000Z', TABLE))
+        # no temporary files left
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_missing(self):
+        self.assertEqual(schemasnapshot.loadSnapshot(self.directory, 'key'),
+            None)
+
+    def test_other_version(self):
+        schemasnapshot.saveSnapshot(self.directory, 'key', '', TABLE)
+        version = schemasnapshot.VERSION
+        schemasnapshot.VERSION = version + 1
+        try:
+            self.assertEqual(schemasnapshot.loadSnapshot(self.directory,
+                'key'), None)
+        finally:
+            schemasnapshot.VERSION = version
+
+    def test_broken(self):
+        path = schemasnapshot._getPath(self.directory, 'key')
+        f = open(path, 'wb')
+        f.write('broken')
+        f.close()
+        self.assertEqual(schemasnapshot.loadSnapshot(self.directory, 'key'),
+            None)
+
+    def test_snapshot_directory(self):
+        plugin = fakeldap.FakePlugin(None, 'ldap')
+        self.assertEqual(schemasnapshot.getSnapshotDirectory(plugin), None)
+        plugin.use_schema_snapshot = True
+        plugin.schema_snapshot_dir = self.directory
+        self.assertEqual(schemasnapshot.getSnapshotDirectory(plugin),
+            self.directory)
+
+
+class MetaDataTests(SnapshotTestCase):
+
+    def setUp(self):
+        SnapshotTestCase.setUp(self)
+        self.stats = fakeldap.Stats()
+        self.acl = fakeldap.FakeLDAPUserFolder(fakeldap.FakeDirectory(1),
+            self.stats)
+        self.key = schemasnapshot.getSnapshotKey(self.acl)
+        schemacache._loaded.pop(self.key, None)
+        self.stamp = fakeldap.SUBSCHEMA['modifyTimestamp'][0]
+        schemasnapshot.saveSnapshot(self.directory, self.key, self.stamp,
+            TABLE)
+
+    def tearDown(self):
+        schemacache._loaded.pop(self.key, None)
+        SnapshotTestCase.tearDown(self)
+
+    def test_loaded_without_ldap(self):
+        meta = schemacache.getLDAPMetaData(self.acl, self.directory)
+        self.assertEqual(sorted(meta.keys()), ['cn', 'commonName'])
+        self.assertEqual(self.stats.total(), 0)
+
+    def test_timestamp_unchanged(self):
+        meta = schemacache.getLDAPMetaData(self.acl, self.directory)
+        self.failUnless(schemacache.getLDAPMetaData(self.acl,
+            self.directory) is meta)
+        # subschema dn and its modifyTimestamp only
+        self.assertEqual(self.stats.counts, {'subschema': 1, 'search': 1})
+
+    def test_timestamp_changed(self):
+        schemacache._loaded[self.key] = ('20000101000000Z', {})
+        schemacache.getLDAPMetaData(self.acl, self.directory)
+        # subschema read again
+        self.assertEqual(self.stats.counts, {'subschema': 2, 'search': 1})
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(SnapshotTests),
+        unittest.makeSuite(MetaDataTests),
+        ])
@@ -0,0 +1,90 @@
+import unittest
+
+import ldap
+
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+BASE = fakeldap.USERS_BASE
+
+
+class FailingConnection(fakeldap.FakeConnection):
+
+    def modify_s(self, dn, mod_list):
+        raise ldap.UNWILLING_TO_PERFORM({'desc': 'Server is unwilling to '
+            'perform'})
+
+
+class SetPropertiesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin, self.directory, self.stats = fakeldap.setUp(3)
+        self.uid = sorted(self.directory.uids())[0]
+        self.user = fakeldap.FakeUser(self.uid)
+        self.sheet = fakeldap.BenchPropertySheet(self.plugin, self.user)
+
+    def entry(self):
+        return self.directory.get(self.uid)
+
+    def test_changed_values_written(self):
+        self.stats.reset()
+        self.sheet.setProperties(self.user, {'department': 'Legal',
+            'email': self.entry()[1]['mail'][0]})
+        self.assertEqual(self.entry()[1]['ou'], ['Legal'])
+        # unchanged email isn't sent
+        self.assertEqual(self.stats.counts.get('modify'), 1)
+        self.assertEqual(self.sheet.getProperty('department'), 'Legal')
+
+    def test_nothing_changed(self):
+        self.stats.reset()
+        self.sheet.setProperties(self.user,
+            {'department': self.entry()[1]['ou'][0]})
+        self.assertEqual(self.stats.counts.get('modify'), None)
+
+    def test_values_encoded(self):
+        self.sheet.setProperties(self.user, {'department': u'R\xe9search'})
+        self.assertEqual(self.entry()[1]['ou'], ['R\xc3\xa9search'])
+
+    def test_empty_value_deletes(self):
+        self.sheet.setProperties(self.user, {'department': ''})
+        self.failIf('ou' in self.entry()[1])
+
+    def test_naming_attribute_renames(self):
+        self.plugin.acl._rdnattr = 'cn'
+        self.directory.rename(self.entry()[0], 'cn=Old')
+        self.stats.reset()
+        self.sheet.setProperties(self.user, {'fullname': u'N\xe9w, Name',
+            'department': 'Legal'})
+        dn, attrs = self.entry()
+        self.assertEqual(dn, 'cn=N\xc3\xa9w\\, Name,%s' % BASE)
+        self.assertEqual(attrs['ou'], ['Legal'])
+        self.assertEqual(self.stats.counts.get('modrdn'), 1)
+
+    def test_naming_attribute_not_removed(self):
+        fullname = self.sheet.getProperty('fullname')
+        self.directory.rename(self.entry()[0], 'cn=%s' % fullname)
+        # LDAP refuses the change, delegate returns the error
+        self.sheet.setProperties(self.user, {'fullname': ''})
+        self.assertEqual(self.entry()[1]['cn'], [fullname])
+        self.assertEqual(self.sheet.getProperty('fullname'), fullname)
+
+    def test_failed_write(self):
+        department = self.sheet.getProperty('department')
+        directory, stats = self.directory, self.stats
+        self.plugin.acl._delegate.connect = lambda *args: \
+            FailingConnection(directory, stats)
+        self.sheet.setProperties(self.user, {'department': 'Legal'})
+        # sheet keeps values LDAP has
+        self.assertEqual(self.sheet.getProperty('department'), department)
+        self.assertEqual(stats.counts.get('expire'), None)
+
+    def test_read_only(self):
+        department = self.entry()[1]['ou']
+        self.plugin.acl._delegate.read_only = True
+        self.sheet.setProperties(self.user, {'department': 'Legal'})
+        self.assertEqual(self.entry()[1]['ou'], department)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(SetPropertiesTests),
+        ])
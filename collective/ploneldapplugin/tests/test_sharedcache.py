@@ -0,0 +1,131 @@
+import socket
+import unittest
+import threading
+
+from collective.ploneldapplugin.sharedcache import MemcachedBackend, \
+    SharedPropertyCache
+from collective.ploneldapplugin.benchmarks import fakememcached
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs stand-in memcached server on a free local port"""
+
+    def setUp(self):
+        fakememcached.storage.data.clear()
+        self.server = fakememcached.makeServer('0')
+        self.thread = threading.Thread(target=self.server.serve_forever,
+            args=(0.05,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.address = '127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class MemcachedBackendTests(ServerTestCase):
+
+    def test_set_get_delete(self):
+        backend = MemcachedBackend([self.address])
+        self.assertEqual(backend.get('key'), None)
+        self.failUnless(backend.set('key', 'value\r\nwith lines'))
+        self.assertEqual(backend.get('key'), 'value\r\nwith lines')
+        self.failUnless(backend.delete('key'))
+        self.assertEqual(backend.get('key'), None)
+        self.failIf(backend.delete('key'))
+
+    def test_add(self):
+        backend = MemcachedBackend([self.address])
+        self.failUnless(backend.add('key', 'first'))
+        self.failIf(backend.add('key', 'second'))
+        self.assertEqual(backend.get('key'), 'first')
+
+    def test_incr(self):
+        backend = MemcachedBackend([self.address])
+        self.assertEqual(backend.incr('counter'), None)
+        backend.set('counter', '41')
+        self.assertEqual(backend.incr('counter'), 42)
+
+    def test_unreachable_server(self):
+        # port of a closed listening socket is not reachable
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        backend = MemcachedBackend(['127.0.0.1:%d' % port], timeout=0.5)
+        self.assertEqual(backend.get('key'), None)
+        self.failIf(backend.set('key', 'value'))
+        self.failUnless(backend._dead)
+
+
+class SharedPropertyCacheTests(ServerTestCase):
+
+    def makeCache(self, prefix='/plone/acl_users/ldap'):
+        return SharedPropertyCache(MemcachedBackend([self.address]), prefix)
+
+    def test_round_trip(self):
+        cache = self.makeCache()
+        version = cache.getVersion('joe')
+        properties = {'cn': 'Joe', 'mail': ['a@x', 'b@x'], 'dn': 'uid=joe'}
+        cache.set('joe', version, properties)
+        self.assertEqual(cache.get('joe', version), properties)
+        # other clients see the same version and values
+        other = self.makeCache()
+        self.assertEqual(other.getVersion('joe'), version)
+        self.assertEqual(other.get('joe', version), properties)
+
+    def test_user_ids_case_insensitive(self):
+        cache = self.makeCache()
+        version = cache.getVersion('joe')
+        cache.set('joe', version, {'cn': 'Joe'})
+        self.assertEqual(cache.getVersion(u'JOE'), version)
+        self.assertEqual(cache.get(u'JOE', version), {'cn': 'Joe'})
+
+    def test_attribute_values(self):
+        cache = self.makeCache()
+        version = cache.getVersion('joe')
+        cache.set('joe', version, 'photo data', attr='jpegPhoto')
+        self.assertEqual(cache.get('joe', version, 'JPEGPHOTO'),
+            'photo data')
+        self.assertEqual(cache.get('joe', version), None)
+
+    def test_invalidate(self):
+        cache = self.makeCache()
+        version = cache.getVersion('joe')
+        cache.set('joe', version, {'cn': 'Joe'})
+        cache.invalidate('joe')
+        new = cache.getVersion('joe')
+        self.assertNotEqual(new, version)
+        self.assertEqual(cache.get('joe', new), None)
+
+    def test_read_during_write_not_served(self):
+        cache = self.makeCache()
+        # reader gets version, then a write happens before it stores
+        # what it read
+        version = cache.getVersion('joe')
+        cache.invalidate('joe')
+        cache.set('joe', version, {'cn': 'Old'})
+        self.assertEqual(cache.get('joe', cache.getVersion('joe')), None)
+
+    def test_plugins_separated(self):
+        cache = self.makeCache()
+        other = self.makeCache('/other/acl_users/ldap')
+        version = cache.getVersion('joe')
+        cache.set('joe', version, {'cn': 'Joe'})
+        self.assertEqual(other.get('joe', other.getVersion('joe')), None)
+
+    def test_invalid_values(self):
+        cache = self.makeCache()
+        version = cache.getVersion('joe')
+        cache.backend.set(cache._key('joe', version, None), 'garbage')
+        self.assertEqual(cache.get('joe', version), None)
+        self.assertEqual(cache.get('joe', None), None)
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(MemcachedBackendTests),
+        unittest.makeSuite(SharedPropertyCacheTests),
+        ])
@@ -0,0 +1,188 @@
+import time
+import unittest
+
+from collective.ploneldapplugin.stalecache import StaleCache, KEEP, \
+    checkUserLookup
+
+QUERY = {
+    'base': 'ou=people,dc=example,dc=com',
+    'scope': 2,
+    'uid_attr': 'uid',
+    'login_attr': 'mail',
+    'objclasses': '(objectClass=person)',
+}
+
+
+class Cache(StaleCache):
+    """Cache refreshed by tests only"""
+
+    def _startThread(self):
+        pass
+
+    def refreshAll(self):
+        while self._refreshQueued():
+            pass
+
+
+class FakeSearch(object):
+
+    def __init__(self, results, exception=''):
+        self.results = results
+        self.exception = exception
+        self.filters = []
+        self.attrs = []
+
+    def __call__(self, base, scope, filter, attrs):
+        self.filters.append(filter)
+        self.attrs.append(attrs)
+        return {'exception': self.exception, 'size': len(self.results),
+            'results': self.results}
+
+def age(cache, key, seconds):
+    cache._entries[key][0] = time.time() - seconds
+
+
+class StaleCacheTests(unittest.TestCase):
+
+    def test_fresh(self):
+        cache = Cache(soft_ttl=60, hard_ttl=3600)
+        self.assertEqual(cache.get('joe'), (None, False))
+        cache.set('joe', 'value')
+        self.assertEqual(cache.get('joe'), ('value', False))
+
+    def test_stale(self):
+        cache = Cache(soft_ttl=60, hard_ttl=3600)
+        cache.set('joe', 'value')
+        age(cache, 'joe', 120)
+        self.assertEqual(cache.get('joe'), ('value', True))
+
+    def test_expired(self):
+        cache = Cache(soft_ttl=60, hard_ttl=3600)
+        cache.set('joe', 'value')
+        age(cache, 'joe', 4000)
+        self.assertEqual(cache.get('joe'), (None, False))
+
+    def test_refreshed_once(self):
+        cache = Cache()
+        cache.set('joe', 'old')
+        calls = []
+        def refresh(value, new):
+            calls.append(value)
+            return new
+        for index in range(5):
+            cache.refresh('joe', refresh, 'new')
+        cache.refreshAll()
+        self.assertEqual(calls, ['old'])
+        self.assertEqual(cache.get('joe'), ('new', False))
+
+    def test_refresh_keep_and_drop(self):
+        cache = Cache(soft_ttl=60, hard_ttl=3600)
+        cache.set('joe', 'value')
+        cache.set('ann', 'value')
+        age(cache, 'joe', 120)
+        cache.refresh('joe', lambda value: KEEP)
+        cache.refresh('ann', lambda value: None)
+        cache.refreshAll()
+        # kept entries stay stale until hard ttl
+        self.assertEqual(cache.get('joe'), ('value', True))
+        self.assertEqual(cache.get('ann'), (None, False))
+
+    def test_refresh_errors_keep_entry(self):
+        cache = Cache()
+        cache.set('joe', 'value')
+        def refresh(value):
+            raise ValueError
+        cache.refresh('joe', refresh)
+        cache.refreshAll()
+        self.assertEqual(cache.get('joe'), ('value', False))
+
+    def test_forgotten_not_refreshed(self):
+        cache = Cache()
+        cache.set('joe', 'value')
+        cache.refresh('joe', lambda value: 'new')
+        cache.forget('joe')
+        cache.refreshAll()
+        self.assertEqual(cache.get('joe'), (None, False))
+
+    def test_set_meanwhile_wins(self):
+        cache = Cache()
+        cache.set('joe', 'old')
+        def refresh(value):
+            cache.set('joe', 'newer')
+            return 'refreshed'
+        cache.refresh('joe', refresh)
+        cache.refreshAll()
+        self.assertEqual(cache.get('joe'), ('newer', False))
+
+    def test_forget_matching(self):
+        cache = Cache()
+        cache.set(('id', 'joe'), ({'id': 'joe'},))
+        cache.set(('login', 'joe@x'), ({'id': 'joe'},))
+        cache.set(('id', 'ann'), ({'id': 'ann'},))
+        cache.forgetMatching(lambda result: result[0]['id'] == 'joe')
+        self.assertEqual(cache._entries.keys(), [('id', 'ann')])
+
+    def test_trimmed(self):
+        cache = Cache(size=10)
+        for index in range(11):
+            cache.set(index, index)
+            age(cache, index, 20 - index)
+        self.assertEqual(len(cache), 9)
+        self.assertEqual(cache.get(0), (None, False))
+        self.assertEqual(cache.get(10), (10, False))
+
+
+class CheckUserLookupTests(unittest.TestCase):
+
+    result = ({'id': 'joe', 'login': 'joe@example.com'},)
+
+    def test_unchanged(self):
+        search = FakeSearch([{'dn': 'uid=joe', 'uid': ['joe'],
+            'MAIL': ['Joe@Example.com']}])
+        self.failUnless(checkUserLookup(self.result, QUERY, search, 'id',
+            'joe') is self.result)
+        self.failUnless('(uid=joe)' in search.filters[0])
+
+    def test_login_changed(self):
+        search = FakeSearch([{'dn': 'uid=joe', 'uid': ['joe'],
+            'mail': ['joe@example.org']}])
+        self.assertEqual(checkUserLookup(self.result, QUERY, search,
+            'login', 'joe@example.com'), None)
+        self.failUnless('(mail=joe@example.com)' in search.filters[0])
+
+    def test_removed(self):
+        search = FakeSearch([])
+        self.assertEqual(checkUserLookup(self.result, QUERY, search, 'id',
+            'joe'), None)
+
+    def test_failed_search(self):
+        search = FakeSearch([], exception='Server down')
+        self.failUnless(checkUserLookup(self.result, QUERY, search, 'id',
+            'joe') is KEEP)
+
+    def test_fields_unchanged(self):
+        result = ({'id': 'joe', 'login': 'joe@example.com', 'cn': u'Jo\xe9',
+            'pluginid': 'ldap'},)
+        search = FakeSearch([{'dn': 'uid=joe', 'uid': ['joe'],
+            'mail': ['joe@example.com'], 'cn': [u'Jo\xe9']}])
+        self.failUnless(checkUserLookup(result, QUERY, search, 'id',
+            'joe') is result)
+        self.assertEqual(search.attrs[0], ['uid', 'mail', 'cn'])
+
+    def test_fields_changed(self):
+        result = ({'id': 'joe', 'login': 'joe@example.com', 'cn': 'Joe',
+            'ou': 'Sales', 'pluginid': 'ldap'},)
+        search = FakeSearch([{'dn': 'uid=joe', 'uid': ['joe'],
+            'mail': ['joe@example.com'], 'cn': ['Joe Doe']}])
+        fresh = checkUserLookup(result, QUERY, search, 'id', 'joe')
+        self.assertEqual(fresh, ({'id': 'joe', 'login': 'joe@example.com',
+            'cn': 'Joe Doe', 'ou': '', 'pluginid': 'ldap'},))
+        # cached result is not changed in place
+        self.assertEqual(result[0]['cn'], 'Joe')
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(StaleCacheTests),
+        unittest.makeSuite(CheckUserLookupTests),
+        ])
@@ -0,0 +1,175 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from collective.ploneldapplugin.warmcache import WarmCache
+from collective.ploneldapplugin.propertysearch import getPropertyQuery
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+ATTRS = ['cn', 'mail', 'uid']
+
+JOE = {'cn': 'Jo\xc3\xa9', 'mail': 'joe@example.com', 'uid': 'joe'}
+ANN = {'cn': 'Ann', 'mail': 'ann@example.com', 'uid': 'ann'}
+
+
+class Cache(WarmCache):
+    """Cache revalidated by tests only"""
+
+    def _startThread(self):
+        pass
+
+
+class WarmCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'warm.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def makeCache(self, key='key', attrs=ATTRS, **kw):
+        cache = Cache(self.path, key, **kw)
+        cache.open(attrs)
+        return cache
+
+
+class MemoryTests(WarmCacheTestCase):
+
+    def test_fresh(self):
+        cache = self.makeCache()
+        self.assertEqual(cache.get('joe'), (None, False))
+        cache.remember('joe', JOE)
+        self.assertEqual(cache.get('joe'), (JOE, False))
+
+    def test_expired(self):
+        cache = self.makeCache(ttl=60, hard_ttl=600)
+        cache.remember('joe', JOE)
+        cache._entries['joe'][1] = time.time() - 120
+        self.assertEqual(cache.get('joe'), (JOE, True))
+        cache._entries['joe'][1] = time.time() - 1200
+        self.assertEqual(cache.get('joe'), (None, False))
+
+    def test_trimmed(self):
+        cache = self.makeCache(size=10)
+        for index in range(11):
+            cache.remember('user%d' % index, JOE)
+        self.assertEqual(len(cache._entries), 9)
+
+    def test_forget(self):
+        cache = self.makeCache()
+        cache.remember('joe', JOE)
+        cache.forget('joe')
+        self.assertEqual(cache.get('joe'), (None, False))
+
+
+class SnapshotTests(WarmCacheTestCase):
+
+    def setUp(self):
+        WarmCacheTestCase.setUp(self)
+        cache = self.makeCache()
+        cache.remember('joe', JOE)
+        cache.remember('ann', ANN)
+        cache.save()
+
+    def test_mapped(self):
+        cache = self.makeCache()
+        # only index is read
+        self.assertEqual(cache._entries, {})
+        self.assertEqual(sorted(cache._index.keys()), ['ann', 'joe'])
+        # entries from snapshot are stale
+        self.assertEqual(cache.get('joe'), (JOE, True))
+        self.assertEqual(cache._index.keys(), ['ann'])
+        self.assertEqual(cache.get('ann'), (ANN, True))
+
+    def test_other_key(self):
+        cache = self.makeCache('other')
+        self.assertEqual(cache.get('joe'), (None, False))
+
+    def test_attributes_not_covered(self):
+        cache = self.makeCache(attrs=ATTRS + ['ou'])
+        self.assertEqual(cache.get('joe'), (None, False))
+        # fewer attributes are fine
+        cache = self.makeCache(attrs=['CN'])
+        self.assertEqual(cache.get('joe'), (JOE, True))
+
+    def test_broken(self):
+        f = open(self.path, 'wb')
+        f.write('broken')
+        f.close()
+        cache = self.makeCache()
+        self.assertEqual(cache.get('joe'), (None, False))
+
+    def test_saved_again(self):
+        cache = self.makeCache()
+        cache.get('joe')
+        cache.remember('bob', ANN)
+        cache.save()
+        # entry not decoded yet is copied as it is
+        self.assertEqual(cache._index.keys(), ['ann'])
+        cache = self.makeCache()
+        self.assertEqual(sorted(cache._index.keys()), ['ann', 'bob', 'joe'])
+        self.assertEqual(cache.get('ann'), (ANN, True))
+        self.assertEqual(cache.get('bob'), (ANN, True))
+
+    def test_no_temporary_files(self):
+        self.assertEqual(os.listdir(self.directory), ['warm.snapshot'])
+
+
+class RevalidateTests(WarmCacheTestCase):
+
+    def setUp(self):
+        WarmCacheTestCase.setUp(self)
+        self.stats = fakeldap.Stats()
+        directory = fakeldap.FakeDirectory(3)
+        self.acl = fakeldap.FakeLDAPUserFolder(directory, self.stats)
+        self.uid = sorted(directory.uids())[0]
+        self.entry = directory.get(self.uid)[1]
+        cache = self.makeCache()
+        cache.remember(self.uid, {'cn': 'Old name'})
+        cache.remember('gone', JOE)
+        cache.save()
+        self.cache = self.makeCache()
+
+    def revalidate(self, *uids):
+        query = getPropertyQuery(self.acl)
+        for uid in uids:
+            self.cache.get(uid)
+            self.cache.revalidate(uid, query, self.acl._delegate.search)
+        while self.cache._revalidateQueued():
+            pass
+
+    def test_revalidated(self):
+        self.revalidate(self.uid, 'gone')
+        properties, stale = self.cache.get(self.uid)
+        self.failIf(stale)
+        self.assertEqual(properties['cn'], self.entry['cn'][0])
+        # users no longer in LDAP are dropped
+        self.assertEqual(self.cache.get('gone'), (None, False))
+        # read with one search
+        self.assertEqual(self.stats.counts, {'search': 1})
+
+    def test_queued_once(self):
+        query = getPropertyQuery(self.acl)
+        self.cache.revalidate(self.uid, query, self.acl._delegate.search)
+        self.cache.revalidate(self.uid, query, self.acl._delegate.search)
+        self.assertEqual(self.cache._queue, [self.uid])
+
+    def test_forgotten_meanwhile(self):
+        query = getPropertyQuery(self.acl)
+        self.cache.get(self.uid)
+        self.cache.revalidate(self.uid, query, self.acl._delegate.search)
+        self.cache.forget(self.uid)
+        while self.cache._revalidateQueued():
+            pass
+        self.assertEqual(self.cache.get(self.uid), (None, False))
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(MemoryTests),
+        unittest.makeSuite(SnapshotTests),
+        unittest.makeSuite(RevalidateTests),
+        ])
@@ -0,0 +1,270 @@
+import unittest
+
+import ldap
+
+from collective.ploneldapplugin import connection, writebehind, \
+    getCacheKey
+from collective.ploneldapplugin.writebehind import WriteBehindQueue, \
+    MAX_ATTEMPTS
+from collective.ploneldapplugin.benchmarks import fakeldap
+
+DN = 'uid=%s,ou=people,dc=example,dc=com'
+
+
+class Queue(WriteBehindQueue):
+    """Queue flushed by tests only"""
+
+    def _start(self):
+        pass
+
+
+class FakeConnection(object):
+    """Asynchronous python ldap connection stand-in.
+
+    send_errors and result_errors map dns to exceptions raised when
+    modification of the entry is sent or its result read.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.written = []
+        self.send_errors = {}
+        self.result_errors = {}
+
+    def modify(self, dn, mod_list):
+        error = self.send_errors.get(dn)
+        if error is not None:
+            raise error
+        self.sent.append((dn, sorted(mod_list)))
+        return len(self.sent) - 1
+
+    def result(self, msgid):
+        dn, mod_list = self.sent[msgid]
+        error = self.result_errors.get(dn)
+        if error is not None:
+            raise error
+        self.written.append((dn, mod_list))
+        return ldap.RES_MODIFY, []
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.current = FakeConnection()
+        self.discarded = 0
+
+    def connection(self):
+        return self.current
+
+    def release(self, connection):
+        pass
+
+    def discard(self):
+        self.discarded += 1
+
+
+def makeQueue():
+    queue = Queue(interval=3600)
+    queue.pool = FakePool()
+    return queue
+
+def enqueue(queue, uid, changes, values=None):
+    return queue.enqueue(uid, DN % uid, changes, values or {}, None)
+
+
+class CoalescingTests(unittest.TestCase):
+
+    def test_latest_values_written_once(self):
+        queue = makeQueue()
+        enqueue(queue, 'joe', {'lastLogin': ['1']})
+        enqueue(queue, 'joe', {'lastLogin': ['2'], 'loginCount': ['5']})
+        queue.flush()
+        self.assertEqual(queue.pool.current.written, [(DN % 'joe', [
+            (ldap.MOD_REPLACE, 'lastLogin', ['2']),
+            (ldap.MOD_REPLACE, 'loginCount', ['5'])])])
+
+    def test_empty_values_delete(self):
+        queue = makeQueue()
+        enqueue(queue, 'joe', {'lastLogin': []})
+        queue.flush()
+        self.assertEqual(queue.pool.current.written, [(DN % 'joe', [
+            (ldap.MOD_DELETE, 'lastLogin', None)])])
+
+    def test_pending_values_visible(self):
+        queue = makeQueue()
+        self.assertEqual(queue.getPending('joe'), None)
+        enqueue(queue, 'joe', {'lastLogin': ['1']}, {'last_login': 1})
+        enqueue(queue, 'joe', {'loginCount': ['5']}, {'login_count': 5})
+        self.assertEqual(queue.getPending('joe'),
+            {'last_login': 1, 'login_count': 5})
+        # kept for reads after flush too
+        queue.flush()
+        self.assertEqual(queue.getPending('joe')['login_count'], 5)
+
+    def test_full_queue_refuses(self):
+        queue = makeQueue()
+        queue.max_users = 1
+        self.failUnless(enqueue(queue, 'joe', {'lastLogin': ['1']}))
+        self.failIf(enqueue(queue, 'ann', {'lastLogin': ['1']}))
+        # users already queued can still be changed
+        self.failUnless(enqueue(queue, 'joe', {'lastLogin': ['2']}))
+
+    def test_batches(self):
+        queue = makeQueue()
+        queue.batch_size = 2
+        for index in range(5):
+            enqueue(queue, 'u%d' % index, {'lastLogin': ['1']})
+        queue.flush()
+        self.assertEqual(len(queue.pool.current.written), 5)
+        self.assertEqual(queue._pending, {})
+
+
+class RequeueTests(unittest.TestCase):
+
+    def test_server_down_on_result(self):
+        queue = makeQueue()
+        connection = queue.pool.current
+        connection.result_errors[DN % 'joe'] = ldap.SERVER_DOWN({})
+        enqueue(queue, 'joe', {'lastLogin': ['1'], 'loginCount': ['5']})
+        queue.flush()
+        self.assertEqual(connection.written, [])
+        self.assertEqual(queue.pool.discarded, 1)
+
+        # newer changes win over requeued ones
+        enqueue(queue, 'joe', {'lastLogin': ['2']})
+        queue.pool.current = FakeConnection()
+        queue.flush()
+        self.assertEqual(queue.pool.current.written, [(DN % 'joe', [
+            (ldap.MOD_REPLACE, 'lastLogin', ['2']),
+            (ldap.MOD_REPLACE, 'loginCount', ['5'])])])
+
+    def test_server_down_on_send(self):
+        queue = makeQueue()
+        queue.pool.current.send_errors[DN % 'ann'] = ldap.SERVER_DOWN({})
+        for uid in ('joe', 'ann', 'bob'):
+            enqueue(queue, uid, {'lastLogin': ['1']})
+        queue.flush()
+        # nothing sent can be confirmed any more
+        self.assertEqual(queue.pool.current.written, [])
+        self.assertEqual(sorted(queue._pending.keys()),
+            ['ann', 'bob', 'joe'])
+
+        queue.pool.current = FakeConnection()
+        queue.flush()
+        self.assertEqual(len(queue.pool.current.written), 3)
+        self.assertEqual(queue._pending, {})
+
+    def test_refused_retried(self):
+        queue = makeQueue()
+        connection = queue.pool.current
+        connection.result_errors[DN % 'joe'] = ldap.LDAPError({})
+        enqueue(queue, 'joe', {'lastLogin': ['1']})
+        enqueue(queue, 'ann', {'lastLogin': ['1']})
+        queue.flush()
+        self.assertEqual(connection.written, [(DN % 'ann', [
+            (ldap.MOD_REPLACE, 'lastLogin', ['1'])])])
+        self.assertEqual(queue._pending.keys(), ['joe'])
+
+        del connection.result_errors[DN % 'joe']
+        queue.flush()
+        self.assertEqual(connection.written[-1][0], DN % 'joe')
+        self.assertEqual(queue._attempts, {})
+
+    def test_refused_dropped(self):
+        queue = makeQueue()
+        queue.pool.current.send_errors[DN % 'joe'] = ldap.LDAPError({})
+        enqueue(queue, 'joe', {'lastLogin': ['1']})
+        for attempt in range(MAX_ATTEMPTS - 1):
+            queue.flush()
+            self.assertEqual(queue._pending.keys(), ['joe'])
+        queue.flush()
+        self.assertEqual(queue._pending, {})
+        self.assertEqual(queue._attempts, {})
+
+
+class InvalidationTests(unittest.TestCase):
+
+    def test_written_users_invalidated(self):
+        queue = makeQueue()
+        invalidated = []
+        queue.invalidate = invalidated.extend
+        queue.pool.current.result_errors[DN % 'ann'] = ldap.LDAPError({})
+        enqueue(queue, 'joe', {'lastLogin': ['1']})
+        enqueue(queue, 'ann', {'lastLogin': ['1']})
+        queue.flush()
+        self.assertEqual(invalidated, ['joe'])
+        self.failUnless(queue.getWriteTime('joe'))
+        self.assertEqual(queue.getWriteTime('ann'), 0)
+
+    def test_invalidation_errors(self):
+        queue = makeQueue()
+        def invalidate(uids):
+            raise ValueError
+        queue.invalidate = invalidate
+        enqueue(queue, 'joe', {'lastLogin': ['1']})
+        queue.flush()
+        self.assertEqual(queue._pending, {})
+        self.failUnless(queue.getWriteTime('joe'))
+
+    def test_unknown_plugin(self):
+        self.assertEqual(writebehind.getWriteTime('/nowhere', 'joe'), 0)
+
+
+class CachedSheetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = fakeldap.Stats()
+        self.directory = fakeldap.FakeDirectory(3)
+        acl = fakeldap.FakeLDAPUserFolder(self.directory, self.stats)
+        self.plugin = fakeldap.CachingPlugin(acl, self.id())
+        self.plugin.volatile_properties = ('login_time',)
+        self.user = fakeldap.FakeUser(sorted(self.directory.uids())[0])
+        self.queue = writebehind._queues[getCacheKey(self.plugin)] = \
+            Queue(interval=3600)
+        # fake plugin has no connection pool, queue opens connections
+        self.initialize = connection.ldap.initialize
+        directory, stats = self.directory, self.stats
+        connection.ldap.initialize = lambda uri: \
+            fakeldap.FakeConnection(directory, stats)
+
+    def tearDown(self):
+        connection.ldap.initialize = self.initialize
+        del writebehind._queues[getCacheKey(self.plugin)]
+
+    def makeSheet(self):
+        return fakeldap.BenchPropertySheet(self.plugin, self.user)
+
+    def test_queued_values_on_cached_sheet(self):
+        self.makeSheet().setProperties(self.user,
+            {'login_time': '20200101000000Z'})
+        self.stats.reset()
+        sheet = self.makeSheet()
+        self.assertEqual(self.stats.counts.get('search'), None)
+        self.assertEqual(sheet.getProperty('login_time'), '20200101000000Z')
+
+    def test_not_cached_while_queued(self):
+        self.makeSheet().setProperties(self.user,
+            {'login_time': '20200101000000Z'})
+        self.plugin.cache.clear()
+        self.makeSheet()
+        self.assertEqual(self.plugin.cache, {})
+
+    def test_cached_sheet_outdated_by_write(self):
+        self.makeSheet().setProperties(self.user,
+            {'login_time': '20200101000000Z'})
+        self.queue.flush()
+        # written values are no longer held by the queue
+        self.queue._overlay.clear()
+        self.stats.reset()
+        sheet = self.makeSheet()
+        self.failUnless(self.stats.counts.get('search'))
+        self.assertEqual(sheet.getProperty('login_time'), '20200101000000Z')
+
+
+def test_suite():
+    return unittest.TestSuite([
+        unittest.makeSuite(CoalescingTests),
+        unittest.makeSuite(RequeueTests),
+        unittest.makeSuite(InvalidationTests),
+        unittest.makeSuite(CachedSheetTests),
+        ])
@@ -0,0 +1,459 @@
+"""Process cache of hot users raw LDAP properties with warm restart
+snapshots.
+
+Raw LDAP attribute values of recently used users, in the form
+LDAPUser._properties keeps them, are kept per plugin and written to a local
+snapshot file at intervals and on shutdown. A restarted process maps the
+snapshot into memory, reads only its index and decodes entries when they
+are first asked for. Entries coming from snapshot are stale: they are
+served right away, but a background thread reads them again from LDAP.
+
+Snapshot file layout:
+
+  header  - struct '>8sII': MAGIC, VERSION, index length
+  index   - marshalled (key, attrs, saved, {user id: (offset, length)})
+  entries - marshalled raw properties, offsets are relative to the end of
+            index
+"""
+import os
+import mmap
+import time
+import struct
+import atexit
+import marshal
+import threading
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from collective.ploneldapplugin.connection import ConnectionPool, \
+    getConnectionSettings, getConnectionPool
+from collective.ploneldapplugin.propertysearch import getPropertyQuery, \
+    getHeavyAttributes, searchProperties
+from collective.ploneldapplugin.schemasnapshot import getSnapshotKey
+from collective.ploneldapplugin.instrumentation import getRecorder
+from collective.ploneldapplugin import logger, getCacheKey
+
+MAGIC = 'PLDAPWC\0'
+HEADER = '>8sII'
+
+# bump when snapshot layout or entries format changes
+VERSION = 1
+
+# checked time of entries loaded from snapshot
+STALE = 0
+
+# users read from LDAP at once during revalidation
+BATCH_SIZE = 100
+
+# users kept in memory in stale-while-revalidate mode if warm cache is off
+STALE_SIZE = 10000
+
+
+class WarmCache(object):
+    """Raw LDAP properties of most recently used users of one plugin
+
+    size - maximum number of kept users
+    ttl - seconds to serve entries read from LDAP
+    interval - seconds between snapshot saves, 0 to save on shutdown only
+    hard_ttl - seconds to serve entries older than ttl as stale, 0 not to
+               serve them
+    """
+
+    def __init__(self, path, key, size=1000, ttl=300, interval=0,
+                 hard_ttl=0):
+        self.path = path
+        self.key = key
+        self.size = size
+        self.ttl = ttl
+        self.hard_ttl = hard_ttl
+        self.interval = interval
+        # instrumentation recorder of the plugin, if recording is on
+        self.recorder = None
+        # attributes read by property searches, snapshots made for other
+        # attributes are not used
+        self.attrs = None
+        # user id: [used, checked, raw properties]
+        self._entries = {}
+        # user id: (offset, length) of snapshot entries not decoded yet
+        self._index = {}
+        self._mapped = None
+        self._start = 0
+        # (query, search) for revalidation and user ids waiting for it
+        self._source = None
+        self._queue = []
+        self._queued = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def open(self, attrs):
+        """Map snapshot file and read its index"""
+        self.attrs = attrs
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            f = open(self.path, 'rb')
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            magic, version, length = struct.unpack(HEADER,
+                mapped[:struct.calcsize(HEADER)])
+            if magic != MAGIC or version != VERSION:
+                mapped.close()
+                return
+            start = struct.calcsize(HEADER)
+            key, attrs, saved, index = marshal.loads(
+                mapped[start:start + length])
+        except Exception:
+            logger.warning('Can not read LDAP property snapshot %s' %
+                self.path)
+            return
+        if key != self.key or not self._covers(attrs):
+            mapped.close()
+            return
+        self._lock.acquire()
+        try:
+            self._mapped = mapped
+            self._start = start + length
+            self._index = index
+        finally:
+            self._lock.release()
+        logger.info('Mapped %d users of LDAP property snapshot %s' %
+            (len(index), self.path))
+
+    def _covers(self, attrs):
+        """Tell whether snapshot made for given attributes has all needed
+        ones
+        """
+        wanted = [attr.lower() for attr in self.attrs or ()]
+        have = dict([(attr.lower(), 1) for attr in attrs])
+        for attr in wanted:
+            if attr not in have:
+                return False
+        return True
+
+    def get(self, uid):
+        """Return (raw properties, stale) of a user or (None, False)"""
+        entry = self._entries.get(uid)
+        if entry is None:
+            entry = self._decode(uid)
+            if entry is None:
+                self._record(False)
+                return None, False
+        now = time.time()
+        entry[0] = now
+        if entry[1] == STALE:
+            self._record(True)
+            self._count('stale')
+            return entry[2], True
+        if entry[1] + self.ttl < now:
+            if entry[1] + self.hard_ttl >= now:
+                self._record(True)
+                self._count('stale')
+                return entry[2], True
+            self._record(False)
+            return None, False
+        self._record(True)
+        return entry[2], False
+
+    def _decode(self, uid):
+        self._lock.acquire()
+        try:
+            position = self._index.pop(uid, None)
+            if position is None:
+                return None
+            offset, length = position
+            start = self._start + offset
+            try:
+                properties = marshal.loads(self._mapped[start:start +
+                    length])
+            except (ValueError, EOFError, TypeError):
+                return None
+            entry = self._entries[uid] = [time.time(), STALE, properties]
+            return entry
+        finally:
+            self._lock.release()
+
+    def remember(self, uid, properties):
+        """Keep raw properties of a user just read from LDAP"""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._index.pop(uid, None)
+            self._entries[uid] = [now, now, properties]
+            if len(self._entries) > self.size:
+                self._trim()
+        finally:
+            self._lock.release()
+
+    def forget(self, uid):
+        """Drop a user changed in LDAP"""
+        self._lock.acquire()
+        try:
+            self._entries.pop(uid, None)
+            self._index.pop(uid, None)
+            self._queued.pop(uid, None)
+        finally:
+            self._lock.release()
+
+    def _trim(self):
+        """Drop least recently used users, lock must be held.
+
+        Tenth of size more is dropped, so sorting doesn't happen on every
+        new user.
+        """
+        used = [(entry[0], uid) for uid, entry in self._entries.items()]
+        used.sort()
+        for last, uid in used[:len(used) - self.size * 9 // 10]:
+            del self._entries[uid]
+
+    def revalidate(self, uid, query, search):
+        """Read a stale user again from LDAP in background
+
+        query - see propertysearch.getPropertyQuery
+        search - LDAPDelegate.search compatible callable usable from any
+                 thread
+        """
+        self._lock.acquire()
+        try:
+            self._source = (query, search)
+            if uid in self._queued:
+                return
+            self._queued[uid] = 1
+            self._queue.append(uid)
+        finally:
+            self._lock.release()
+        self._startThread()
+        self._wakeup.set()
+
+    def _revalidateQueued(self):
+        self._lock.acquire()
+        try:
+            uids, self._queue = self._queue[:BATCH_SIZE], \
+                self._queue[BATCH_SIZE:]
+            source = self._source
+        finally:
+            self._lock.release()
+        if not uids:
+            return False
+
+        query, search = source
+        found = searchProperties(search, query, uids, BATCH_SIZE,
+            self.recorder)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for uid in uids:
+                # forgotten meanwhile because user was changed
+                if self._queued.pop(uid, None) is None:
+                    continue
+                entry = self._entries.get(uid)
+                if uid in found:
+                    if entry is None:
+                        self._entries[uid] = [now, now, found[uid]]
+                    else:
+                        entry[1:] = [now, found[uid]]
+                else:
+                    self._entries.pop(uid, None)
+        finally:
+            self._lock.release()
+        self._count('revalidated', len(uids))
+        return True
+
+    def save(self):
+        """Atomically write snapshot of kept users"""
+        if self.path is None:
+            return
+        self._lock.acquire()
+        try:
+            used = [(entry[0], uid, entry[2]) for uid, entry in
+                self._entries.items()]
+            # entries still in older snapshot are copied without decoding
+            mapped = self._mapped
+            start = self._start
+            raw = self._index.items()
+        finally:
+            self._lock.release()
+        used.sort()
+        used.reverse()
+
+        index = {}
+        blobs = []
+        offset = 0
+        for last, uid, properties in used[:self.size]:
+            try:
+                blob = marshal.dumps(properties)
+            except ValueError:
+                continue
+            index[uid] = (offset, len(blob))
+            blobs.append(blob)
+            offset += len(blob)
+        for uid, (position, length) in raw[:max(self.size - len(index), 0)]:
+            if uid in index:
+                continue
+            index[uid] = (offset, length)
+            blobs.append(mapped[start + position:start + position + length])
+            offset += length
+
+        header = marshal.dumps((self.key, self.attrs or [], time.time(),
+            index))
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            f = open(tmp, 'wb')
+            try:
+                f.write(struct.pack(HEADER, MAGIC, VERSION, len(header)))
+                f.write(header)
+                for blob in blobs:
+                    f.write(blob)
+            finally:
+                f.close()
+            # mapped older snapshot stays readable after rename
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            logger.warning('Can not write LDAP property snapshot %s' %
+                self.path)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _startThread(self):
+        if self._thread is not None:
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='ploneldap-warm-cache')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        saved = time.time()
+        while not self._stopped:
+            self._wakeup.wait(self.interval or None)
+            self._wakeup.clear()
+            try:
+                while self._revalidateQueued():
+                    pass
+            except Exception:
+                logger.exception('Error while revalidating LDAP properties')
+            if self.interval and saved + self.interval <= time.time():
+                saved = time.time()
+                self.save()
+
+    def stop(self):
+        """Stop worker thread and save snapshot"""
+        self._stopped = True
+        self._wakeup.set()
+        self.save()
+
+    def _record(self, hit):
+        recorder = self.recorder
+        if recorder is not None:
+            if hit:
+                recorder.hit('warm cache')
+            else:
+                recorder.miss('warm cache')
+
+    def _count(self, name, value=1):
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.count('warm cache %s' % name, value)
+
+# plugin key: warm cache
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _stopAll():
+    for cache in _caches.values():
+        cache.stop()
+
+atexit.register(_stopAll)
+
+def getSnapshotPath(plugin, directory=None):
+    """Return path of plugin property snapshot, None if there is no
+    directory for it
+    """
+    if directory is None:
+        directory = getattr(plugin, 'warm_snapshot_dir', '')
+    if not directory:
+        try:
+            from App.config import getConfiguration
+            directory = getConfiguration().clienthome
+        except (ImportError, AttributeError):
+            return None
+    return os.path.join(directory, 'ploneldap-properties-%s.snapshot' %
+        md5(getCacheKey(plugin)).hexdigest())
+
+def getWarmCache(plugin):
+    """Return warm cache of a given plugin or None if plugin warm_cache_size
+    is 0.
+
+    With plugin stale_while_revalidate on, entries are fresh for
+    stale_soft_ttl seconds and served stale until stale_hard_ttl. The cache
+    is kept then even with warm_cache_size 0, only in memory.
+    """
+    size = int(getattr(plugin, 'warm_cache_size', 0) or 0)
+    stale = getattr(plugin, 'stale_while_revalidate', False)
+    path = None
+    if size > 0:
+        path = getSnapshotPath(plugin)
+    elif stale:
+        size = STALE_SIZE
+    else:
+        return None
+    key = getCacheKey(plugin)
+    cache = _caches.get(key)
+    if cache is None:
+        _caches_lock.acquire()
+        try:
+            cache = _caches.get(key)
+            if cache is None:
+                acl = plugin._getLDAPUserFolder()
+                cache = WarmCache(path, '%s|%s' % (key,
+                    getSnapshotKey(acl)))
+                cache.open(getPropertyQuery(acl,
+                    getHeavyAttributes(plugin))['attrs'])
+                _caches[key] = cache
+        finally:
+            _caches_lock.release()
+    cache.size = size
+    if stale:
+        cache.ttl = getattr(plugin, 'stale_soft_ttl', 60)
+        cache.hard_ttl = getattr(plugin, 'stale_hard_ttl', 3600)
+    else:
+        cache.ttl = getattr(plugin, 'warm_cache_ttl', 300)
+        cache.hard_ttl = 0
+    cache.interval = getattr(plugin, 'warm_snapshot_interval', 0)
+    cache.recorder = getRecorder(plugin)
+    if cache.interval:
+        # saves snapshots periodically
+        cache._startThread()
+    return cache
+
+def revalidateWarmProperties(plugin, cache, uid):
+    """Read stale user properties again in background"""
+    acl = plugin._getLDAPUserFolder()
+    pool = getConnectionPool(plugin)
+    if pool is None:
+        # connections of size 0 pool are closed after each search
+        pool = ConnectionPool(getConnectionSettings(acl), 0)
+    cache.revalidate(uid, getPropertyQuery(acl, getHeavyAttributes(plugin)),
+        pool.search)
+
+def forgetWarmProperties(plugin, uid):
+    """Drop properties of a user changed in LDAP"""
+    cache = _caches.get(getCacheKey(plugin))
+    if cache is not None:
+        cache.forget(uid)
+
+def saveWarmSnapshot(plugin):
+    """Write property snapshot of a given plugin right away"""
+    cache = _caches.get(getCacheKey(plugin))
+    if cache is not None:
+        cache.save()
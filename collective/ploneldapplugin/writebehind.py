@@ -0,0 +1,335 @@
+"""Coalescing write-behind queue for frequently written properties.
+
+Properties like login_time are written on every login. Instead of a
+synchronous LDAP modify per write, changes of such properties are queued per
+user and a background thread periodically sends only the latest values to
+LDAP in batches. Queued values are visible to property reads of the process
+right away.
+"""
+import time
+import atexit
+import threading
+
+import ldap
+
+from collective.ploneldapplugin.connection import connect
+from collective.ploneldapplugin.instrumentation import timed
+from collective.ploneldapplugin import logger
+
+# writes of a user refused by LDAP before its changes are dropped
+MAX_ATTEMPTS = 5
+# seconds times of confirmed writes are kept, cache managers keep entries
+# for less than that
+WRITTEN_TTL = 86400
+
+
+class WriteBehindQueue(object):
+    """Per plugin queue of pending LDAP modifications
+
+    interval - seconds between flushes
+    max_users - maximum number of users with pending changes, writes are
+                refused when queue is full
+    batch_size - modifications sent to LDAP before waiting for results
+    hold - seconds to keep written values visible to reads after flush,
+           LDAP user folder may still cache old ones
+    """
+
+    def __init__(self, interval=30, max_users=10000, batch_size=100,
+                 hold=600):
+        self.interval = interval
+        self.max_users = max_users
+        self.batch_size = batch_size
+        self.hold = hold
+        self.settings = None
+        # instrumentation recorder of the plugin, if recording is on
+        self.recorder = None
+        # connection pool of the plugin, if it has one
+        self.pool = None
+        # function called with ids of users whose changes were written,
+        # dropping their cached properties
+        self.invalidate = None
+        # user id: (dn, {ldapname: ldap values})
+        self._pending = {}
+        # user id: (expires, {zopename: python value})
+        self._overlay = {}
+        # user id: failed writes of changes refused by LDAP
+        self._attempts = {}
+        # user id: time LDAP confirmed the last write of its changes
+        self._written = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def enqueue(self, uid, dn, changes, values, settings):
+        """Queue ldap changes of a given user
+
+        changes - {ldapname: list of ldap values}, empty list deletes
+        values - {zopename: python value} to show to reads meanwhile
+        settings - connection settings, see connection.getConnectionSettings
+
+        Returns False if queue is full and changes have to be written
+        synchronously.
+        """
+        self._lock.acquire()
+        try:
+            pending = self._pending.get(uid)
+            if pending is None and len(self._pending) >= self.max_users:
+                return False
+            if pending is None:
+                self._pending[uid] = (dn, dict(changes))
+            else:
+                pending[1].update(changes)
+
+            # readers get overlay dicts without locking, never change them
+            expires = time.time() + self.interval + self.hold
+            overlay = self._overlay.get(uid)
+            merged = {}
+            if overlay is not None:
+                merged.update(overlay[1])
+            merged.update(values)
+            self._overlay[uid] = (expires, merged)
+            self.settings = settings
+        finally:
+            self._lock.release()
+
+        self._start()
+        return True
+
+    def getPending(self, uid):
+        """Return {zopename: value} of queued or recently written values"""
+        overlay = self._overlay.get(uid)
+        if overlay is None or overlay[0] < time.time():
+            return None
+        return overlay[1]
+
+    def getWriteTime(self, uid):
+        """Return time changes of a given user were last written, 0 if
+        they weren't lately
+        """
+        return self._written.get(uid, 0)
+
+    def flush(self):
+        """Write all pending changes to LDAP"""
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, {}
+            settings = self.settings
+            now = time.time()
+            for uid, (expires, values) in self._overlay.items():
+                if expires < now:
+                    del self._overlay[uid]
+            for uid, written in self._written.items():
+                if written + WRITTEN_TTL < now:
+                    del self._written[uid]
+        finally:
+            self._lock.release()
+
+        if not pending:
+            return
+
+        items = pending.items()
+        pool = self.pool
+        try:
+            if pool is not None:
+                connection = pool.connection()
+            else:
+                connection = connect(settings)
+        except ldap.LDAPError:
+            logger.exception('Can not connect to LDAP to write queued '
+                             'properties, will retry later')
+            self._requeue(items)
+            return
+
+        written = True
+        try:
+            for start in range(0, len(items), self.batch_size):
+                written = timed(self.recorder, 'ldap', 'write-behind batch',
+                    self._writeBatch, connection, items[start:start +
+                    self.batch_size])
+                if not written:
+                    # the rest wasn't sent at all
+                    self._requeue(items[start + self.batch_size:])
+                    break
+        finally:
+            if pool is not None:
+                pool.release(connection)
+                if not written:
+                    # server dropped pooled connection
+                    pool.discard()
+            else:
+                connection.unbind_s()
+
+    def _writeBatch(self, connection, items):
+        """Write batch of pending changes, return False if server went down.
+
+        Changes whose write was not confirmed are put back to the queue.
+        """
+        # send all modifications first then collect results
+        written = True
+        sent = []
+        # changes LDAP refused and changes of unknown fate
+        refused = []
+        unconfirmed = []
+        confirmed = []
+        for index in range(len(items)):
+            uid, (dn, changes) = items[index]
+            mod_list = []
+            for ldapname, values in changes.items():
+                if values:
+                    mod_list.append((ldap.MOD_REPLACE, ldapname, values))
+                else:
+                    mod_list.append((ldap.MOD_DELETE, ldapname, None))
+            try:
+                sent.append((items[index], connection.modify(dn, mod_list)))
+            except ldap.SERVER_DOWN:
+                unconfirmed.extend(items[index:])
+                written = False
+                break
+            except ldap.LDAPError:
+                logger.exception('Error while writing queued properties of '
+                                 '%s' % dn)
+                refused.append(items[index])
+
+        for item, msgid in sent:
+            if not written:
+                # results can't be read any more
+                unconfirmed.append(item)
+                continue
+            try:
+                connection.result(msgid)
+                self._attempts.pop(item[0], None)
+                confirmed.append(item[0])
+            except ldap.SERVER_DOWN:
+                unconfirmed.append(item)
+                written = False
+            except ldap.LDAPError:
+                logger.exception('Error while writing queued properties of '
+                                 '%s' % item[1][0])
+                refused.append(item)
+
+        if not written:
+            logger.warning('LDAP server went down while writing queued '
+                           'properties, will retry later')
+        self._requeue(unconfirmed)
+        self._retry(refused)
+        self._confirm(confirmed)
+        return written
+
+    def _confirm(self, uids):
+        """Remember when changes of given users were written and drop
+        their cached properties
+        """
+        if not uids:
+            return
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for uid in uids:
+                self._written[uid] = now
+        finally:
+            self._lock.release()
+        invalidate = self.invalidate
+        if invalidate is not None:
+            try:
+                invalidate(uids)
+            except Exception:
+                logger.exception('Error while dropping cached properties of '
+                                 'users with written changes')
+
+    def _retry(self, items):
+        """Put back changes refused by LDAP unless they were refused too
+        many times already
+        """
+        retried = []
+        for item in items:
+            uid, (dn, changes) = item
+            attempts = self._attempts.get(uid, 0) + 1
+            if attempts >= MAX_ATTEMPTS:
+                logger.error('Dropping queued properties of %s refused %d '
+                             'times' % (dn, attempts))
+                self._attempts.pop(uid, None)
+                continue
+            self._attempts[uid] = attempts
+            retried.append(item)
+        self._requeue(retried)
+
+    def _requeue(self, items):
+        """Put back changes which were not written, newer ones win"""
+        self._lock.acquire()
+        try:
+            for uid, (dn, changes) in items:
+                pending = self._pending.get(uid)
+                if pending is None:
+                    self._pending[uid] = (dn, changes)
+                else:
+                    merged = dict(changes)
+                    merged.update(pending[1])
+                    self._pending[uid] = (dn, merged)
+        finally:
+            self._lock.release()
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                    name='ploneldap-write-behind')
+                self._thread.setDaemon(True)
+                self._thread.start()
+                atexit.register(self.stop)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while not self._wakeup.isSet():
+            self._wakeup.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Error while flushing write-behind queue')
+
+    def stop(self):
+        """Stop worker thread writing what is still pending"""
+        self._wakeup.set()
+        self.flush()
+
+# plugin key: write-behind queue
+_queues = {}
+_queues_lock = threading.Lock()
+
+def getWriteBehindQueue(key, interval=30, max_users=10000, recorder=None,
+                        pool=None, invalidate=None):
+    """Return write-behind queue for a given plugin key"""
+    queue = _queues.get(key)
+    if queue is None:
+        _queues_lock.acquire()
+        try:
+            queue = _queues.get(key)
+            if queue is None:
+                queue = _queues[key] = WriteBehindQueue(interval, max_users)
+        finally:
+            _queues_lock.release()
+    queue.interval = interval
+    queue.max_users = max_users
+    queue.recorder = recorder
+    queue.pool = pool
+    queue.invalidate = invalidate
+    return queue
+
+def getPendingProperties(key, uid):
+    """Return queued {zopename: value} of a given plugin key and user"""
+    queue = _queues.get(key)
+    if queue is None:
+        return None
+    return queue.getPending(uid)
+
+def getWriteTime(key, uid):
+    """Return time queued changes of a given plugin key and user were last
+    written, 0 if they weren't lately
+    """
+    queue = _queues.get(key)
+    if queue is None:
+        return 0
+    return queue.getWriteTime(uid)
@@ -32,6 +32,11 @@ setup(name='collective.ploneldapplugin',
       entry_points="""
       # -*- Entry points: -*-
 
+      [console_scripts]
+      ploneldapplugin-benchmark = collective.ploneldapplugin.benchmarks.runner:main
+      ploneldapplugin-export = collective.ploneldapplugin.export:main
+      ploneldapplugin-memory-benchmark = collective.ploneldapplugin.benchmarks.memory:main
+
       [z3c.autoinclude.plugin]
       target = plone
       """,